@@ -0,0 +1,340 @@
+from collections import deque
+from dataclasses import dataclass, fields, replace
+from typing import Callable, Deque, Dict, Optional, Tuple
+from urllib.parse import parse_qs
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+from starlette.responses import JSONResponse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('ADMISSION_CONTROL', 'true').strip().lower() not in ('0', 'false', 'no', 'off')
+# Worker processes splitting the limits between them (set by serve.py)
+WORKERS = max(int(os.environ.get('SERVE_WORKERS') or 1), 1)
+
+# Per-client token buckets idle long enough to be full again are dropped once this many are tracked
+MAX_TRACKED_CLIENTS = 10000
+# Largest POST /api/search body read to decide its lane; bigger ones go to the bulk lane
+MAX_PEEKED_BODY = 64 * 1024
+# Weight of the newest request in each lane's average service time
+SERVICE_TIME_SMOOTHING = 0.1
+
+ADMISSION_QUEUE_DEPTH = metrics.registry.gauge(
+    'admission_queue_depth', 'Requests waiting for a slot in their lane.', ('lane',))
+ADMISSION_IN_FLIGHT = metrics.registry.gauge(
+    'admission_in_flight', 'Requests holding a slot in their lane.', ('lane',))
+ADMISSION_WAIT = metrics.registry.histogram(
+    'admission_wait_seconds', 'Time admitted requests waited for a slot.', ('lane',),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+ADMISSION_REJECTED = metrics.registry.counter(
+    'admission_rejected_total', 'Requests turned away by admission control.', ('lane', 'reason'))
+
+
+@dataclass(frozen=True)
+class LaneLimits:
+    """Limits of one lane; rates are requests per second, and a rate or concurrency of 0 is unlimited.
+
+    Requests wait up to `max_wait` seconds for a slot, at most `queue` of them.
+    """
+    concurrency: int
+    queue: int
+    max_wait: float
+    user_concurrency: int
+    user_rate: float
+    user_burst: int
+    rate: float = 0.0
+    burst: int = 0
+
+    @classmethod
+    def from_env(cls, lane: str, **defaults) -> 'LaneLimits':
+        """Read ADMISSION_<LANE>_<LIMIT> overrides, e.g. ADMISSION_BULK_CONCURRENCY, and take this worker's share."""
+        values = dict(defaults)
+        for field_ in fields(cls):
+            raw = os.environ.get(f'ADMISSION_{lane.upper()}_{field_.name.upper()}')
+            if raw:
+                values[field_.name] = field_.type(raw)
+        return cls(**values).share(WORKERS)
+
+    def share(self, workers: int) -> 'LaneLimits':
+        """Limits for one of `workers` processes, so together they allow about these lane-wide.
+
+        Only the lane's slots, queue and rate are split; counts round up, so a
+        limit below the number of workers becomes one per worker. Per-client
+        limits stay whole: a client's keep-alive connection stays on one
+        worker, so splitting them would throttle it to a fraction.
+        """
+        if workers <= 1:
+            return self
+        values = {}
+        for name in ('concurrency', 'queue', 'rate', 'burst'):
+            value = getattr(self, name)
+            if value > 0:
+                values[name] = value / workers if isinstance(value, float) else math.ceil(value / workers)
+        return replace(self, **values)
+
+
+# Cheap requests (reading a snippet, autosave, tabs); the defaults leave room for a browser's connections
+INTERACTIVE = LaneLimits.from_env(
+    'interactive', concurrency=32, queue=128, max_wait=1.0, user_concurrency=16, user_rate=20.0, user_burst=40)
+# Requests that read or write a whole library: import, export, duplicate clusters, unfiltered search
+BULK = LaneLimits.from_env(
+    'bulk', concurrency=2, queue=8, max_wait=5.0, user_concurrency=1, user_rate=0.2, user_burst=5)
+# Signup and login, which spend hundreds of milliseconds of CPU hashing a password
+AUTH = LaneLimits.from_env(
+    'auth', concurrency=2, queue=16, max_wait=2.0, user_concurrency=2, user_rate=1.0, user_burst=10)
+
+# Endpoints that go to the bulk lane whatever their parameters
+BULK_ROUTES = {
+    ('POST', '/api/import'),
+    ('GET', '/api/export'),
+    ('GET', '/api/duplicates'),
+    ('POST', '/api/languages/detect'),
+    ('POST', '/api/tags/cleanup'),
+}
+AUTH_ROUTES = {('POST', '/api/auth/signup'), ('POST', '/api/auth/login')}
+# Change feed streams stay open for minutes and have their own per-user limit
+EXEMPT_ROUTES = {('GET', '/api/events')}
+
+# ============ Limits ============
+
+class Rejected(Exception):
+    """A request turned away; status 429 blames the client, 503 the server's load."""
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` per second."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token and return 0, or return the seconds until one is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Lane:
+    """A FIFO of requests sharing `concurrency` slots, with per-client caps and rates.
+
+    A client's waiting requests count against its concurrency cap, so one
+    client can't fill the queue. Slots are handed straight to the next
+    waiter on release, so a request arriving meanwhile can't jump the queue.
+    """
+
+    def __init__(self, name: str, limits: LaneLimits):
+        self.name = name
+        self.limits = limits
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._clients: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._bucket = TokenBucket(limits.rate, limits.burst) if limits.rate > 0 else None
+        self._service_time = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _retry_after(self) -> float:
+        """Rough time until a slot frees up for a request queued now."""
+        return self._service_time * (self.waiting + 1) / max(self.limits.concurrency, 1)
+
+    def _check_rates(self, client: str):
+        now = time.monotonic()
+        limits = self.limits
+        if limits.user_rate > 0:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_CLIENTS:
+                    self._buckets = {key: b for key, b in self._buckets.items() if not b.full(now)}
+                bucket = self._buckets[client] = TokenBucket(limits.user_rate, limits.user_burst)
+            wait = bucket.take(now)
+            if wait:
+                raise Rejected(429, 'user_rate', wait)
+        if self._bucket is not None:
+            wait = self._bucket.take(now)
+            if wait:
+                raise Rejected(503, 'rate', wait)
+
+    async def acquire(self, client: str):
+        """Wait for a slot; raises Rejected when the client or the lane is over its limits."""
+        limits = self.limits
+        if limits.user_concurrency > 0 and self._clients.get(client, 0) >= limits.user_concurrency:
+            raise Rejected(429, 'user_concurrency', self._service_time)
+        self._check_rates(client)
+        self._clients[client] = self._clients.get(client, 0) + 1
+        try:
+            if (limits.concurrency <= 0 or self.active < limits.concurrency) and not self._waiters:
+                self.active += 1
+            elif len(self._waiters) >= limits.queue:
+                raise Rejected(503, 'queue_full', self._retry_after())
+            else:
+                await self._wait()
+        except BaseException:
+            self._forget(client)
+            raise
+        self._update_gauges()
+
+    async def _wait(self):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(future, self.limits.max_wait)
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the request gave up
+                self._release_slot()
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            self._update_gauges()
+            if isinstance(exc, asyncio.TimeoutError):
+                raise Rejected(503, 'queue_timeout', self._retry_after()) from None
+            raise
+
+    def release(self, client: str, held: float):
+        self._service_time += SERVICE_TIME_SMOOTHING * (held - self._service_time)
+        self._forget(client)
+        self._release_slot()
+        self._update_gauges()
+
+    def _forget(self, client: str):
+        remaining = self._clients.pop(client) - 1
+        if remaining:
+            self._clients[client] = remaining
+
+    def _release_slot(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _update_gauges(self):
+        ADMISSION_QUEUE_DEPTH.set(self.waiting, lane=self.name)
+        ADMISSION_IN_FLIGHT.set(self.active, lane=self.name)
+
+
+lanes = {name: Lane(name, limits) for name, limits in (('interactive', INTERACTIVE), ('bulk', BULK), ('auth', AUTH))}
+
+# ============ Middleware ============
+
+def _is_full_search(params: dict) -> bool:
+    """A search without text or filters reads every snippet of the user."""
+    return not str(params.get('query') or params.get('q') or '').strip() \
+        and not params.get('tags') and not params.get('language')
+
+
+async def _peek_body(receive) -> Tuple[Optional[bytes], Callable]:
+    """Read the request body and return it with a receive callable that replays it.
+
+    The body is None if it is larger than MAX_PEEKED_BODY.
+    """
+    messages = []
+    size = 0
+    while True:
+        message = await receive()
+        messages.append(message)
+        size += len(message.get('body', b''))
+        if message['type'] != 'http.request' or not message.get('more_body') or size > MAX_PEEKED_BODY:
+            break
+
+    async def replay():
+        return messages.pop(0) if messages else await receive()
+
+    body = b''.join(m.get('body', b'') for m in messages) if size <= MAX_PEEKED_BODY else None
+    return body, replay
+
+
+async def classify(scope, receive) -> Tuple[Optional[str], Callable]:
+    """Lane of a request (None if it isn't limited), and the receive callable to pass on."""
+    method, path = scope['method'], scope['path'].rstrip('/')
+    if not path.startswith('/api/') or method == 'OPTIONS' or (method, path) in EXEMPT_ROUTES:
+        return None, receive
+    if (method, path) in AUTH_ROUTES:
+        return 'auth', receive
+    if (method, path) in BULK_ROUTES:
+        return 'bulk', receive
+    if path == '/api/search':
+        if method == 'GET':
+            params = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+            return ('bulk' if _is_full_search(params) else 'interactive'), receive
+        if method == 'POST':
+            body, receive = await _peek_body(receive)
+            try:
+                params = json.loads(body) if body is not None else {}
+            except ValueError:
+                return 'interactive', receive
+            full = body is None or (isinstance(params, dict) and _is_full_search(params))
+            return ('bulk' if full else 'interactive'), receive
+    return 'interactive', receive
+
+
+class AdmissionMiddleware:
+    """Admit each API request into its lane or answer 429/503 with Retry-After at once.
+
+    `identify(scope)` names the client a request counts against: the user
+    for authenticated requests, otherwise the client address. Each worker
+    process applies its share of the limits (see LaneLimits.share).
+    """
+
+    def __init__(self, app, identify: Callable[[dict], str]):
+        self.app = app
+        self.identify = identify
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        name, receive = await classify(scope, receive)
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        lane = lanes[name]
+        client = self.identify(scope)
+        start = time.monotonic()
+        try:
+            await lane.acquire(client)
+        except Rejected as rejected:
+            ADMISSION_REJECTED.inc(lane=name, reason=rejected.reason)
+            response = JSONResponse(
+                {'detail': 'Too many requests' if rejected.status == 429 else 'Server busy, try again later'},
+                status_code=rejected.status,
+                headers={'Retry-After': str(rejected.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+
+        admitted = time.monotonic()
+        ADMISSION_WAIT.observe(admitted - start, lane=name)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release(client, time.monotonic() - admitted)
@@ -0,0 +1,744 @@
+"""Online backups of the SQLite databases: snapshots, WAL shipping, retention and restores.
+
+Run from the backend directory; the README ("Backups") covers scheduling
+and restoring.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import metrics
+from database import all_engines, writes_paused, writing
+
+try:
+    import fcntl
+except ImportError:  # Windows, where serve.py runs a single process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Where snapshots are kept, one directory each
+BACKUP_DIR = Path(os.environ.get('BACKUP_DIR') or Path(__file__).parent / 'backups')
+# Minutes between snapshots taken by the server; 0 leaves backups to the CLI
+INTERVAL_MINUTES = float(os.environ.get('BACKUP_INTERVAL_MINUTES', 0))
+# Seconds between WAL shipments into the latest snapshot; 0 disables point-in-time restores
+WAL_INTERVAL_SECONDS = float(os.environ.get('BACKUP_WAL_INTERVAL_SECONDS', 60))
+# Snapshots kept by pruning (the newest verified one is always kept too)
+KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+# Pages copied per backup step, and the pause after each step
+PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))
+STEP_PAUSE_MS = int(os.environ.get('BACKUP_STEP_PAUSE_MS', 10))
+# WAL pages at which any connection checkpoints, shipped or not, so a WAL can't grow
+# without bound while shipping fails; the WAL chain of the latest snapshot then breaks
+WAL_MAX_PAGES = int(os.environ.get('BACKUP_WAL_MAX_PAGES', 100000))
+
+SHIP_WAL = INTERVAL_MINUTES > 0 and WAL_INTERVAL_SECONDS > 0
+# A step-wise copy starts over whenever the database changes. After this many
+# restarts the rest is copied in one step, which in WAL mode doesn't block writers either.
+MAX_RESTARTS = 3
+# Shipped WAL frames after which the backup task checkpoints, like SQLite's default wal_autocheckpoint
+CHECKPOINT_FRAMES = 1000
+# How long a checkpoint waits for readers before giving up until the next shipment
+CHECKPOINT_BUSY_TIMEOUT_MS = 100
+# Unfinished snapshot directories older than this are left over from a crash
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+MANIFEST = 'manifest.json'
+SEGMENT_INDEX = 'segments.jsonl'
+_PARTIAL_PREFIX = '.partial-'
+
+BACKUP_DURATION = metrics.registry.histogram(
+    'backup_duration_seconds', 'Time taken by snapshots, WAL shipments and restore checks.', ('kind',),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+BACKUP_FAILURES = metrics.registry.counter('backup_failures_total', 'Backup operations that failed.', ('kind',))
+BACKUP_LAST_SUCCESS = metrics.registry.gauge(
+    'backup_last_success_timestamp_seconds', 'Unix time of the last successful backup operation.', ('kind',),
+    multiprocess='max')
+BACKUP_BYTES = metrics.registry.counter('backup_bytes_total', 'Bytes written to backups.', ('kind',))
+BACKUP_RESTARTS = metrics.registry.counter(
+    'backup_copy_restarts_total', 'Snapshot copies that started over because the database changed.')
+BACKUP_VERIFIED = metrics.registry.gauge(
+    'backup_verified', '1 if the latest checked snapshot restored cleanly, 0 if not.', multiprocess='max')
+BACKUP_WAL_BYTES = metrics.registry.gauge(
+    'backup_wal_bytes', 'Size of the WAL file of each database.', ('file',), multiprocess='max')
+BACKUP_CHAIN_BREAKS = metrics.registry.counter(
+    'backup_wal_chain_breaks_total', 'WALs checkpointed before all their frames were shipped.')
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.isoformat().replace('+00:00', 'Z')
+
+
+def parse_timestamp(value: str) -> datetime:
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def database_files() -> List[Tuple[AsyncEngine, Path]]:
+    """(engine, file) of every SQLite database to back up."""
+    return [
+        (target, Path(target.url.database)) for target in all_engines()
+        if target.dialect.name == 'sqlite' and target.url.database not in (None, '', ':memory:')
+    ]
+
+
+def _write_json(path: Path, data):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(data, indent=2))
+    os.replace(tmp, path)
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ============ Snapshots ============
+
+@dataclass
+class Snapshot:
+    path: Path
+    manifest: dict
+
+    @property
+    def id(self) -> str:
+        return self.manifest['id']
+
+    @property
+    def finished_at(self) -> datetime:
+        return parse_timestamp(self.manifest['finishedAt'])
+
+    def segments(self, name: str) -> List[dict]:
+        """Index entries of the WAL segments shipped for one database file, in order."""
+        index = self.path / 'wal' / name / SEGMENT_INDEX
+        if not index.exists():
+            return []
+        entries = []
+        for line in index.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # Torn last line of an interrupted shipment
+        return entries
+
+    def save(self):
+        _write_json(self.path / MANIFEST, self.manifest)
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _copy_database(src: sqlite3.Connection, target: Path) -> dict:
+    """Copy one database with the online backup API (blocking; run it in a thread).
+
+    If src is inside a read transaction, the copy is of that transaction's view.
+    """
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            BACKUP_RESTARTS.inc()
+            if restarts > MAX_RESTARTS:
+                raise _Restarted
+        last_remaining = remaining
+
+    dst = sqlite3.connect(target)
+    try:
+        try:
+            src.backup(dst, pages=PAGES_PER_STEP, progress=progress, sleep=STEP_PAUSE_MS / 1000)
+        except _Restarted:
+            src.backup(dst)
+        page_size = dst.execute('PRAGMA page_size').fetchone()[0]
+        pages = dst.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        dst.close()
+    return {
+        'name': target.name, 'bytes': target.stat().st_size, 'sha256': _sha256(target),
+        'pageSize': page_size, 'pages': pages, 'restarts': restarts,
+    }
+
+
+def _pin(sources: List[Tuple[Path, sqlite3.Connection]]) -> Optional[datetime]:
+    """Open a read transaction on every WAL-mode source at one moment, with writes paused.
+
+    Returns that moment, or None if the files will be copied as of different times.
+    """
+    wal = all(src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal' for _, src in sources)
+    if not wal:
+        # A rollback journal reader would block writers for the whole copy
+        return None
+    with writes_paused() as paused:
+        for _, src in sources:
+            src.execute('BEGIN')
+            src.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        return _now() if paused else None
+
+
+def take_snapshot(directory: Path = BACKUP_DIR) -> Snapshot:
+    """Copy every database into a new snapshot directory, as of one point in time where possible.
+
+    In WAL mode writers only wait while a read transaction is opened on each
+    file; the copies then read those transactions' views while writes go on.
+    """
+    started = _now()
+    snapshot_id = started.strftime('%Y%m%dT%H%M%S%fZ')
+    partial = directory / f'{_PARTIAL_PREFIX}{snapshot_id}'
+    partial.mkdir(parents=True)
+    sources = [
+        (path, sqlite3.connect(path, check_same_thread=False, isolation_level=None))
+        for _, path in database_files() if path.exists()
+    ]
+    try:
+        consistent_at = _pin(sources)
+        files = []
+        for path, src in sources:
+            files.append(_copy_database(src, partial / path.name))
+            files[-1]['copiedAt'] = _timestamp(_now())
+        finished = _now()
+        manifest = {
+            'id': snapshot_id,
+            'startedAt': _timestamp(started),
+            'finishedAt': _timestamp(finished),
+            'seconds': round((finished - started).total_seconds(), 3),
+            # Moment all files were copied as of; None means each file is as of its own copy
+            'consistentAt': _timestamp(consistent_at) if consistent_at else None,
+            'files': files,
+        }
+        _write_json(partial / MANIFEST, manifest)
+        final = directory / snapshot_id
+        os.replace(partial, final)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    finally:
+        for _, src in sources:
+            src.close()
+    BACKUP_BYTES.inc(sum(f['bytes'] for f in files), kind='snapshot')
+    return Snapshot(final, manifest)
+
+
+def list_snapshots(directory: Path = BACKUP_DIR) -> List[Snapshot]:
+    """Finished snapshots, oldest first."""
+    if not directory.exists():
+        return []
+    snapshots = []
+    for path in sorted(directory.iterdir()):
+        if path.name.startswith(_PARTIAL_PREFIX) or not (path / MANIFEST).exists():
+            continue
+        snapshots.append(Snapshot(path, json.loads((path / MANIFEST).read_text())))
+    return snapshots
+
+
+def find_snapshot(name: Optional[str], directory: Path = BACKUP_DIR) -> Snapshot:
+    """Snapshot by id, or the newest one for None/'latest'."""
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        raise LookupError(f'No snapshots in {directory}')
+    if name in (None, 'latest'):
+        return snapshots[-1]
+    for snapshot in snapshots:
+        if snapshot.id == name:
+            return snapshot
+    raise LookupError(f'No snapshot {name} in {directory}')
+
+
+def prune(directory: Path = BACKUP_DIR, keep: int = KEEP) -> List[str]:
+    """Delete all but the newest `keep` snapshots, never the newest verified one. Returns deleted ids."""
+    snapshots = list_snapshots(directory)
+    kept = {snapshot.id for snapshot in snapshots[-keep:]} if keep > 0 else set()
+    verified = [s for s in snapshots if s.manifest.get('verified', {}).get('ok')]
+    if verified:
+        kept.add(verified[-1].id)
+    deleted = []
+    for snapshot in snapshots:
+        if snapshot.id not in kept:
+            shutil.rmtree(snapshot.path, ignore_errors=True)
+            deleted.append(snapshot.id)
+    for path in directory.glob(f'{_PARTIAL_PREFIX}*'):
+        if time.time() - path.stat().st_mtime > STALE_PARTIAL_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+    return deleted
+
+# ============ WAL Shipping ============
+
+# WAL file format (https://www.sqlite.org/fileformat.html#the_write_ahead_log)
+_WAL_HEADER = struct.Struct('>8I')
+_FRAME_HEADER = struct.Struct('>6I')
+_WAL_MAGIC = 0x377F0682  # | 1 when checksums use big-endian words
+
+
+class WalReset(Exception):
+    """The WAL was checkpointed and restarted by someone else, so frames may have been missed."""
+
+
+@dataclass
+class WalPosition:
+    """Just past the last shipped commit frame of one WAL file."""
+    salt: Tuple[int, int]
+    offset: int
+    checksum: Tuple[int, int]
+    big_endian: bool
+    page_size: int
+
+    @property
+    def frames(self) -> int:
+        return (self.offset - _WAL_HEADER.size) // (_FRAME_HEADER.size + self.page_size)
+
+
+def _wal_checksum(data: bytes, seed: Tuple[int, int], big_endian: bool) -> Tuple[int, int]:
+    words = struct.unpack(f'{">" if big_endian else "<"}{len(data) // 4}I', data)
+    s0, s1 = seed
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+
+def scan_wal(path: Path, position: Optional[WalPosition]) -> Tuple[bytes, Optional[WalPosition]]:
+    """Committed frames appended to a WAL since position, and the position after them.
+
+    None means "from the start of whatever WAL comes next" and is returned
+    while there is no WAL. Frames are checked against the salts and
+    cumulative checksums, so a frame still being written ends the scan.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        f = None
+    if f is None:
+        if position is not None:
+            raise WalReset(path)
+        return b'', None
+    with f:
+        header = f.read(_WAL_HEADER.size)
+        magic, _, page_size, _, salt1, salt2, check1, check2 = (
+            _WAL_HEADER.unpack(header) if len(header) == _WAL_HEADER.size else (0,) * 8
+        )
+        big_endian = bool(magic & 1)
+        if magic & ~1 != _WAL_MAGIC or _wal_checksum(header[:24], (0, 0), big_endian) != (check1, check2):
+            # Empty, or truncated by a checkpoint and not written to since
+            if position is not None:
+                raise WalReset(path)
+            return b'', None
+        if position is None:
+            position = WalPosition((salt1, salt2), _WAL_HEADER.size, (check1, check2), big_endian, page_size)
+        elif position.salt != (salt1, salt2):
+            raise WalReset(path)
+
+        frame_size = _FRAME_HEADER.size + page_size
+        f.seek(position.offset)
+        shipped = bytearray()
+        pending = bytearray()
+        checksum = position.checksum
+        offset = position.offset
+        committed = position
+        while True:
+            frame = f.read(frame_size)
+            if len(frame) < frame_size:
+                break
+            _, commit, frame_salt1, frame_salt2, frame_check1, frame_check2 = _FRAME_HEADER.unpack_from(frame)
+            if (frame_salt1, frame_salt2) != position.salt:
+                break
+            checksum = _wal_checksum(frame[:8] + frame[_FRAME_HEADER.size:], checksum, big_endian)
+            if checksum != (frame_check1, frame_check2):
+                break
+            pending += frame
+            offset += frame_size
+            if commit:
+                shipped += pending
+                pending.clear()
+                committed = WalPosition(position.salt, offset, checksum, big_endian, page_size)
+        return bytes(shipped), committed
+
+
+def _wal_path(path: Path) -> Path:
+    return path.with_name(path.name + '-wal')
+
+
+def write_segment(snapshot: Snapshot, name: str, frames: bytes, page_size: int):
+    """Store shipped frames of database file `name` in the snapshot and add them to its index."""
+    directory = snapshot.path / 'wal' / name
+    directory.mkdir(parents=True, exist_ok=True)
+    seq = len(snapshot.segments(name)) + 1
+    segment = f'{seq:08d}.frames'
+    tmp = directory / (segment + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(frames)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, directory / segment)
+    entry = {
+        'seq': seq, 'file': segment, 'shippedAt': _timestamp(_now()),
+        'frames': len(frames) // (_FRAME_HEADER.size + page_size), 'pageSize': page_size,
+    }
+    with open(directory / SEGMENT_INDEX, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    BACKUP_BYTES.inc(len(frames), kind='wal')
+
+
+def _limit_autocheckpoint(dbapi_connection, connection_record):
+    # Frames must stay in the WAL until they are shipped; the backup task checkpoints after
+    # shipping, and connections only do once the WAL reaches WAL_MAX_PAGES
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA wal_autocheckpoint = {WAL_MAX_PAGES}')
+    cursor.close()
+
+
+def _collect_wal_sizes():
+    for _, path in database_files():
+        try:
+            size = _wal_path(path).stat().st_size
+        except FileNotFoundError:
+            size = 0
+        BACKUP_WAL_BYTES.set(size, file=path.name)
+
+
+if SHIP_WAL:
+    for _target, _ in database_files():
+        event.listen(_target.sync_engine, 'connect', _limit_autocheckpoint)
+    metrics.registry.add_collector(_collect_wal_sizes)
+
+# ============ Restores ============
+
+def apply_frames(db: Path, frames: bytes, page_size: int):
+    """Write the pages of every complete transaction in frames into a database file."""
+    frame_size = _FRAME_HEADER.size + page_size
+    pending = []
+    with open(db, 'r+b') as f:
+        for start in range(0, len(frames) - frame_size + 1, frame_size):
+            page, commit = struct.unpack_from('>II', frames, start)
+            pending.append((page, start + _FRAME_HEADER.size))
+            if commit:
+                for page, at in pending:
+                    f.seek((page - 1) * page_size)
+                    f.write(frames[at:at + page_size])
+                f.truncate(commit * page_size)
+                pending.clear()
+
+
+def restore(snapshot: Snapshot, target: Path, until: Optional[datetime] = None) -> dict:
+    """Write the snapshot's databases into target, replaying WAL shipped up to `until` (default: all)."""
+    if until is not None and until < snapshot.finished_at:
+        raise ValueError(f'Snapshot {snapshot.id} finished at {snapshot.manifest["finishedAt"]}; '
+                         'restore an older snapshot for earlier times')
+    target.mkdir(parents=True, exist_ok=True)
+    replayed = {}
+    for info in snapshot.manifest['files']:
+        db = target / info['name']
+        shutil.copyfile(snapshot.path / info['name'], db)
+        for suffix in ('-wal', '-shm'):
+            db.with_name(db.name + suffix).unlink(missing_ok=True)
+        segments = [
+            entry for entry in snapshot.segments(info['name'])
+            if until is None or parse_timestamp(entry['shippedAt']) <= until
+        ]
+        for entry in segments:
+            frames = (snapshot.path / 'wal' / info['name'] / entry['file']).read_bytes()
+            apply_frames(db, frames, entry['pageSize'])
+        replayed[info['name']] = {
+            'segments': len(segments),
+            'until': segments[-1]['shippedAt'] if segments else snapshot.manifest['finishedAt'],
+        }
+    return replayed
+
+
+def verify(snapshot: Snapshot) -> dict:
+    """Restore the snapshot with all its WAL into a temporary directory and check the result.
+
+    The copied files must match their checksums and every restored
+    database must pass PRAGMA quick_check. The outcome is recorded in the manifest.
+    """
+    problems = []
+    with tempfile.TemporaryDirectory(dir=snapshot.path.parent) as tmp:
+        for info in snapshot.manifest['files']:
+            if _sha256(snapshot.path / info['name']) != info['sha256']:
+                problems.append(f'{info["name"]}: checksum mismatch')
+        replayed = restore(snapshot, Path(tmp))
+        for name in replayed:
+            conn = sqlite3.connect(Path(tmp) / name)
+            try:
+                result = [row[0] for row in conn.execute('PRAGMA quick_check')]
+                if result != ['ok']:
+                    problems.append(f'{name}: {"; ".join(result[:5])}')
+                if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'snippets'").fetchone():
+                    problems.append(f'{name}: no snippets table')
+            except sqlite3.DatabaseError as exc:
+                problems.append(f'{name}: {exc}')
+            finally:
+                conn.close()
+    outcome = {
+        'at': _timestamp(_now()),
+        'ok': not problems,
+        'problems': problems,
+        'segments': sum(r['segments'] for r in replayed.values()),
+    }
+    snapshot.manifest['verified'] = outcome
+    snapshot.save()
+    return outcome
+
+# ============ Scheduled Backups ============
+
+class BackupScheduler:
+    """Background task taking snapshots every INTERVAL_MINUTES and shipping WAL in between.
+
+    Only one process per backup directory runs it: the first to lock the
+    directory's scheduler lock file; the others keep trying, so a
+    replacement takes over when that worker dies. Each snapshot starts a
+    new WAL chain: under a database's write turn the remaining frames go
+    to the previous snapshot and the WAL is checkpointed, and shipping
+    continues into the new snapshot from there. If anything else
+    checkpoints a WAL (e.g. the last connection closing), the chain is
+    broken and a new snapshot is taken at once.
+    """
+
+    def __init__(self, directory: Path = BACKUP_DIR):
+        self.directory = directory
+        self._task: Optional[asyncio.Task] = None
+        self._lock_fd: Optional[int] = None
+        self._snapshot: Optional[Snapshot] = None
+        self._positions: Dict[Path, Optional[WalPosition]] = {}
+        self._connections: Dict[Path, sqlite3.Connection] = {}
+        self._broken = False
+        self._last_snapshot = 0.0
+        self._last_shipment = 0.0
+
+    def start(self):
+        if INTERVAL_MINUTES <= 0 or self._task is not None:
+            return
+        if not database_files():
+            logger.warning("Scheduled backups need a SQLite database; BACKUP_INTERVAL_MINUTES is ignored")
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def _lead(self) -> bool:
+        if self._lock_fd is not None or fcntl is None:
+            return True
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.directory / '.scheduler.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                if self._lead():
+                    await self._tick()
+            except Exception:
+                logger.exception("Scheduled backup failed")
+            await asyncio.sleep(min(WAL_INTERVAL_SECONDS if SHIP_WAL else 60, INTERVAL_MINUTES * 60))
+
+    async def _tick(self):
+        now = time.monotonic()
+        if self._snapshot is None and not SHIP_WAL:
+            # Without a WAL chain to start, a recent snapshot from before a restart will do
+            snapshots = await asyncio.to_thread(list_snapshots, self.directory)
+            if snapshots:
+                self._snapshot = snapshots[-1]
+                self._last_snapshot = now - (_now() - self._snapshot.finished_at).total_seconds()
+        if self._snapshot is None or self._broken or now - self._last_snapshot >= INTERVAL_MINUTES * 60:
+            await self.snapshot()
+        elif SHIP_WAL and now - self._last_shipment >= WAL_INTERVAL_SECONDS:
+            await self.ship()
+
+    @staticmethod
+    async def _timed(kind: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            with metrics.backup_running():
+                result = await asyncio.to_thread(fn, *args)
+        except Exception:
+            BACKUP_FAILURES.inc(kind=kind)
+            raise
+        BACKUP_DURATION.observe(time.perf_counter() - start, kind=kind)
+        BACKUP_LAST_SUCCESS.set(time.time(), kind=kind)
+        return result
+
+    def _connection(self, path: Path) -> sqlite3.Connection:
+        # Kept open, which also stops the last app connection closing from checkpointing the WAL away
+        if path not in self._connections:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            conn.execute(f'PRAGMA busy_timeout = {CHECKPOINT_BUSY_TIMEOUT_MS}')
+            conn.execute('PRAGMA wal_autocheckpoint = 0')
+            self._connections[path] = conn
+        return self._connections[path]
+
+    def _checkpoint(self, path: Path) -> Optional[WalPosition]:
+        """Checkpoint and truncate the WAL (holding the write turn); the position to ship from afterwards."""
+        conn = self._connection(path)
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if not busy:
+            # Start the next WAL with a no-op write, so its salt is known and a checkpoint
+            # restarting it before the next shipment shows up as a WalReset
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            conn.execute(f'PRAGMA user_version = {version}')
+        # Readers may have kept it from finishing: then carry on at the end of the current WAL
+        return scan_wal(_wal_path(path), None)[1]
+
+    def _ship_file(self, path: Path, snapshot: Optional[Snapshot]) -> Optional[WalPosition]:
+        frames, position = scan_wal(_wal_path(path), self._positions.get(path))
+        if frames and snapshot is not None:
+            write_segment(snapshot, path.name, frames, position.page_size)
+        self._positions[path] = position
+        return position
+
+    async def snapshot(self):
+        """Take a snapshot, start shipping WAL into it, check it and prune old ones."""
+        previous = None if self._broken else self._snapshot
+        positions = {}
+        if SHIP_WAL:
+            for target, path in database_files():
+                async with writing(target):
+                    if previous is not None:
+                        try:
+                            await self._timed('wal', self._ship_file, path, previous)
+                        except WalReset:
+                            # The previous snapshot's chain just ends at its last shipment
+                            BACKUP_CHAIN_BREAKS.inc()
+                    positions[path] = await asyncio.to_thread(self._checkpoint, path)
+        snapshot = await self._timed('snapshot', take_snapshot, self.directory)
+        self._snapshot, self._positions, self._broken = snapshot, positions, False
+        self._last_snapshot = self._last_shipment = time.monotonic()
+        logger.info("Backup snapshot %s took %.1fs", snapshot.id, snapshot.manifest['seconds'])
+
+        for checked in ([previous] if previous is not None and SHIP_WAL else []) + [snapshot]:
+            outcome = await self._timed('verify', verify, checked)
+            BACKUP_VERIFIED.set(1 if outcome['ok'] else 0)
+            if not outcome['ok']:
+                logger.error("Backup %s failed its restore check: %s", checked.id, '; '.join(outcome['problems']))
+        deleted = await asyncio.to_thread(prune, self.directory)
+        if deleted:
+            logger.info("Pruned backups %s", ', '.join(deleted))
+
+    async def ship(self):
+        """Ship new WAL frames of every database, checkpointing WALs that grew large."""
+        snapshot = self._snapshot
+        if not snapshot.path.exists():
+            self._broken = True  # Pruned by someone else
+            return
+        try:
+            for target, path in database_files():
+                position = await self._timed('wal', self._ship_file, path, snapshot)
+                if position is not None and position.frames >= CHECKPOINT_FRAMES:
+                    async with writing(target):
+                        await self._timed('wal', self._ship_file, path, snapshot)
+                        self._positions[path] = await asyncio.to_thread(self._checkpoint, path)
+        except WalReset as exc:
+            logger.error("WAL %s was checkpointed before it was shipped; taking a new snapshot", exc)
+            BACKUP_CHAIN_BREAKS.inc()
+            self._broken = True
+        self._last_shipment = time.monotonic()
+
+
+scheduler = BackupScheduler()
+
+# ============ CLI ============
+
+def _print(data):
+    print(json.dumps(data, indent=2))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', type=Path, default=BACKUP_DIR, help='Backup directory (default: $BACKUP_DIR)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot_cmd = commands.add_parser('snapshot', help='Take a snapshot of every database')
+    snapshot_cmd.add_argument('--no-verify', dest='verify', action='store_false')
+    commands.add_parser('list', help='List snapshots')
+    verify_cmd = commands.add_parser('verify', help='Restore a snapshot into a temporary directory and check it')
+    verify_cmd.add_argument('snapshot', nargs='?', default='latest')
+    restore_cmd = commands.add_parser('restore', help='Write the databases of a snapshot into a directory')
+    restore_cmd.add_argument('snapshot')
+    restore_cmd.add_argument('--to', type=Path, required=True)
+    restore_cmd.add_argument('--until', type=parse_timestamp, help='Replay WAL shipped up to this time (UTC)')
+    restore_cmd.add_argument('--force', action='store_true', help='Overwrite files in --to')
+    prune_cmd = commands.add_parser('prune', help='Delete old snapshots')
+    prune_cmd.add_argument('--keep', type=int, default=KEEP)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'snapshot':
+            if not database_files():
+                parser.error('backups need a SQLite database')
+            snapshot = take_snapshot(args.dir)
+            if args.verify:
+                verify(snapshot)
+            _print(snapshot.manifest)
+            return 0 if snapshot.manifest.get('verified', {}).get('ok', True) else 1
+        if args.command == 'list':
+            _print([
+                {
+                    'id': s.id, 'finishedAt': s.manifest['finishedAt'],
+                    'bytes': sum(f['bytes'] for f in s.manifest['files']),
+                    'walSegments': sum(len(s.segments(f['name'])) for f in s.manifest['files']),
+                    'verified': s.manifest.get('verified', {}).get('ok'),
+                }
+                for s in list_snapshots(args.dir)
+            ])
+            return 0
+        if args.command == 'verify':
+            outcome = verify(find_snapshot(args.snapshot, args.dir))
+            _print(outcome)
+            return 0 if outcome['ok'] else 1
+        if args.command == 'restore':
+            snapshot = find_snapshot(args.snapshot, args.dir)
+            existing = [f['name'] for f in snapshot.manifest['files'] if (args.to / f['name']).exists()]
+            if existing and not args.force:
+                parser.error(f'{", ".join(existing)} already exist in {args.to}; pass --force to overwrite')
+            _print(restore(snapshot, args.to, args.until))
+            return 0
+        if args.command == 'prune':
+            _print(prune(args.dir, args.keep))
+            return 0
+    except (LookupError, ValueError) as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
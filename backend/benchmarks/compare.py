@@ -0,0 +1,46 @@
+"""Compare two benchmark result files produced by benchmarks.run.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(old: float, new: float) -> str:
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+
+    baseline, candidate = load(argv[0]), load(argv[1])
+    print(f"baseline {baseline['meta']['commit']}  vs  candidate {candidate['meta']['commit']}")
+    for mode, scenarios in candidate['results'].items():
+        print(f'\n[{mode}]')
+        print(f"{'scenario':<12} {'req/s':>18} {'p50 ms':>22} {'p99 ms':>22}")
+        for name, new in scenarios.items():
+            old = baseline['results'].get(mode, {}).get(name)
+            if not old:
+                print(f"{name:<12} {new['throughput']:>9.1f} (new)")
+                continue
+            print(
+                f"{name:<12} "
+                f"{new['throughput']:>9.1f} {change(old['throughput'], new['throughput']):>8} "
+                f"{new['latencyMs']['p50']:>11.2f} {change(old['latencyMs']['p50'], new['latencyMs']['p50']):>10} "
+                f"{new['latencyMs']['p99']:>11.2f} {change(old['latencyMs']['p99'], new['latencyMs']['p99']):>10}"
+            )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""Synthetic snippet corpus used to seed benchmark databases."""
+import random
+from typing import Dict, List
+
+WORDS = [
+    'user', 'account', 'order', 'item', 'cart', 'payment', 'session', 'token',
+    'cache', 'queue', 'event', 'handler', 'request', 'response', 'config',
+    'parser', 'buffer', 'stream', 'record', 'index', 'node', 'tree', 'graph',
+    'client', 'server', 'router', 'worker', 'job', 'task', 'batch', 'file',
+    'path', 'message', 'channel', 'socket', 'retry', 'limit', 'metric', 'log',
+]
+
+TAGS = [
+    'utils', 'api', 'database', 'auth', 'testing', 'async', 'cli', 'regex',
+    'http', 'sql', 'docker', 'react', 'hooks', 'algorithms', 'parsing',
+    'performance', 'security', 'deploy', 'logging', 'config', 'strings',
+    'dates', 'files', 'network', 'cache', 'queue', 'math', 'ui', 'css', 'git',
+]
+
+FOLDERS = ['Work', 'Personal', 'Snippets', 'Scratch', 'Interview', 'Infra', 'Frontend', 'Backend']
+
+# Per-language line templates; {a}, {b} and {c} are filled with identifiers
+TEMPLATES: Dict[str, Dict[str, List[str]]] = {
+    'python': {
+        'header': ['import os', 'import json', 'from typing import List, Optional', ''],
+        'block': [
+            'def {a}_{b}({c}: str) -> Optional[dict]:',
+            '    """Return the {b} for a {a}."""',
+            '    if not {c}:',
+            '        return None',
+            '    result = {{"{a}": {c}, "{b}": len({c})}}',
+            '    for key, value in result.items():',
+            '        print(f"{{key}}={{value}}")',
+            '    return result',
+            '',
+        ],
+    },
+    'javascript': {
+        'header': ["import {{ useState }} from 'react';", ''],
+        'block': [
+            'export async function {a}{B}({c}) {{',
+            '  const response = await fetch(`/api/{a}/${{{c}}}`);',
+            '  if (!response.ok) {{',
+            "    throw new Error('Failed to load {b}');",
+            '  }}',
+            '  const data = await response.json();',
+            '  return data.{b}.map((entry) => ({{ ...entry, {c} }}));',
+            '}}',
+            '',
+        ],
+    },
+    'typescript': {
+        'header': ['', 'type Id = string;', ''],
+        'block': [
+            'interface {A}{B} {{',
+            '  id: Id;',
+            '  {c}: number;',
+            '  {b}?: string;',
+            '}}',
+            '',
+            'export function get{A}(items: {A}{B}[], {c}: number): {A}{B} | undefined {{',
+            '  return items.find((item) => item.{c} === {c});',
+            '}}',
+            '',
+        ],
+    },
+    'go': {
+        'header': ['package main', '', 'import (', '\t"fmt"', '\t"errors"', ')', ''],
+        'block': [
+            'func {a}{B}({c} string) (int, error) {{',
+            '\tif {c} == "" {{',
+            '\t\treturn 0, errors.New("empty {b}")',
+            '\t}}',
+            '\tfmt.Println("{a}", {c})',
+            '\treturn len({c}), nil',
+            '}}',
+            '',
+        ],
+    },
+    'rust': {
+        'header': ['use std::collections::HashMap;', ''],
+        'block': [
+            'pub fn {a}_{b}({c}: &str) -> HashMap<String, usize> {{',
+            '    let mut counts = HashMap::new();',
+            '    for word in {c}.split_whitespace() {{',
+            '        *counts.entry(word.to_string()).or_insert(0) += 1;',
+            '    }}',
+            '    counts',
+            '}}',
+            '',
+        ],
+    },
+    'sql': {
+        'header': ['-- {a} reporting queries', ''],
+        'block': [
+            'SELECT {a}.id, {a}.{b}, COUNT({c}.id) AS {c}_count',
+            'FROM {a}',
+            'LEFT JOIN {c} ON {c}.{a}_id = {a}.id',
+            "WHERE {a}.{b} IS NOT NULL AND {a}.created_at > NOW() - INTERVAL '7 days'",
+            'GROUP BY {a}.id, {a}.{b}',
+            'ORDER BY {c}_count DESC;',
+            '',
+        ],
+    },
+    'bash': {
+        'header': ['#!/bin/bash', 'set -euo pipefail', ''],
+        'block': [
+            '{a}_{b}() {{',
+            '  local {c}="$1"',
+            '  if [ -z "${c}" ]; then',
+            '    echo "usage: {a}_{b} <{c}>" >&2',
+            '    return 1',
+            '  fi',
+            '  grep -r "${c}" ./{b} | wc -l',
+            '}}',
+            '',
+        ],
+    },
+    'java': {
+        'header': ['import java.util.List;', 'import java.util.ArrayList;', ''],
+        'block': [
+            'public class {A}{B} {{',
+            '    private final List<String> {c} = new ArrayList<>();',
+            '',
+            '    public void add{A}(String value) {{',
+            '        {c}.add(value);',
+            '    }}',
+            '',
+            '    public int {b}Count() {{',
+            '        return {c}.size();',
+            '    }}',
+            '}}',
+            '',
+        ],
+    },
+}
+
+LANGUAGES = list(TEMPLATES)
+
+
+def _render(lines: List[str], rng: random.Random) -> str:
+    a, b, c = rng.sample(WORDS, 3)
+    return '\n'.join(lines).format(a=a, b=b, c=c, A=a.capitalize(), B=b.capitalize())
+
+
+def make_code(language: str, target_size: int, rng: random.Random) -> str:
+    """Generate roughly target_size characters of code in the given language."""
+    template = TEMPLATES[language]
+    parts = [_render(template['header'], rng)]
+    size = len(parts[0])
+    while size < target_size:
+        block = _render(template['block'], rng)
+        parts.append(block)
+        size += len(block) + 1
+    return '\n'.join(parts)
+
+
+def code_size(rng: random.Random, median: int, max_size: int) -> int:
+    """Draw a snippet size from a log-normal distribution around the median."""
+    return max(40, min(max_size, int(rng.lognormvariate(0, 1.0) * median)))
+
+
+def make_snippet(rng: random.Random, median_size: int, max_size: int, tags: List[str]) -> dict:
+    """Build one snippet payload in the shape accepted by the API."""
+    language = rng.choice(LANGUAGES)
+    a, b = rng.sample(WORDS, 2)
+    return {
+        'title': f'{a.capitalize()} {b} helper ({language})',
+        'description': f'Utilities for working with {a} {b} data',
+        'code': make_code(language, code_size(rng, median_size, max_size), rng),
+        'language': language,
+        'tags': rng.sample(tags, rng.randint(0, min(5, len(tags)))),
+    }
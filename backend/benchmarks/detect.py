@@ -0,0 +1,84 @@
+"""Benchmark server-side language detection on the synthetic corpus.
+
+Run from the backend directory:
+
+    python -m benchmarks.detect --snippets 20000
+    python -m benchmarks.detect --median-size 4000 --output detect.json
+
+Reports snippets/sec and MB/sec for detect_many() plus accuracy against
+the language each snippet was generated in, so a 20k-snippet import can be
+sized without running the API.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks import corpus
+from benchmarks.run import BACKEND_DIR, git_commit
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snippets', type=int, default=20000, help='Snippets to detect')
+    parser.add_argument('--median-size', type=int, default=600, help='Median code size in characters')
+    parser.add_argument('--max-size', type=int, default=20000, help='Largest code size in characters')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs; the best one is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, str(BACKEND_DIR))
+    import language_detection
+
+    rng = random.Random(args.seed)
+    snippets = [corpus.make_snippet(rng, args.median_size, args.max_size, []) for _ in range(args.snippets)]
+    codes = [snippet['code'] for snippet in snippets]
+    total_chars = sum(len(code) for code in codes)
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        detected = language_detection.detect_many(codes)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+
+    misses = Counter(
+        (snippet['language'], language)
+        for snippet, (language, _) in zip(snippets, detected)
+        if language != snippet['language']
+    )
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: getattr(args, key) for key in ('snippets', 'median_size', 'max_size', 'repeat', 'seed')},
+            'maxChars': language_detection.MAX_CHARS,
+        },
+        'results': {
+            'seconds': round(best, 4),
+            'snippetsPerSecond': round(len(codes) / best, 1),
+            'megabytesPerSecond': round(total_chars / best / 1e6, 2),
+            'averageChars': round(total_chars / len(codes), 1),
+            'accuracy': round(1 - sum(misses.values()) / len(codes), 4),
+            'misses': {f'{expected} -> {got}': count for (expected, got), count in misses.most_common(10)},
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+"""Benchmark the backend API against a seeded SQLite database.
+
+Run from the backend directory:
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run --users 5 --snippets 2000 --output results.json
+    python -m benchmarks.run --mode uvicorn --scenarios list,search,autosave
+    python -m benchmarks.run --mode workers --workers 1,4 --concurrency 32
+    python -m benchmarks.run --scenarios get_during_bulk --admission
+
+Results are written as JSON (throughput and latency percentiles per
+scenario) so runs from different commits can be compared with
+`python -m benchmarks.compare old.json new.json`.
+
+Admission control is off unless --admission is given, so scenarios measure
+the server rather than its limits. With it on, per-user interactive limits
+stay off too: a few benchmark accounts stand in for many users.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+@dataclass
+class BenchUser:
+    username: str
+    headers: Dict[str, str]
+    snippets: List[dict] = field(default_factory=list)
+
+
+@dataclass
+class Context:
+    users: List[BenchUser]
+    tags: List[str]
+    rng: random.Random
+
+    def user(self) -> BenchUser:
+        return self.rng.choice(self.users)
+
+    def snippet(self, user: BenchUser) -> dict:
+        return self.rng.choice(user.snippets)
+
+
+Scenario = Callable[[httpx.AsyncClient, Context], Awaitable[httpx.Response]]
+
+# ============ Scenarios ============
+
+async def list_snippets(client, ctx):
+    user = ctx.user()
+    return await client.get('/api/snippets', params={'limit': 100}, headers=user.headers)
+
+
+async def get_snippet(client, ctx):
+    user = ctx.user()
+    return await client.get(f"/api/snippets/{ctx.snippet(user)['id']}", headers=user.headers)
+
+
+async def search(client, ctx):
+    from benchmarks.corpus import WORDS
+    user = ctx.user()
+    return await client.get('/api/search', params={'q': ctx.rng.choice(WORDS)}, headers=user.headers)
+
+
+async def search_tags(client, ctx):
+    user = ctx.user()
+    return await client.post('/api/search', json={'tags': [ctx.rng.choice(ctx.tags)]}, headers=user.headers)
+
+
+async def autosave(client, ctx):
+    # Same payload shape as the editor's autosave: the whole snippet with a small code edit
+    user = ctx.user()
+    snippet = ctx.snippet(user)
+    payload = {
+        'title': snippet['title'],
+        'description': snippet['description'],
+        'code': snippet['code'] + f"\n// edit {ctx.rng.randint(0, 1_000_000)}",
+        'language': snippet['language'],
+        'tags': snippet['tags'],
+    }
+    return await client.put(f"/api/snippets/{snippet['id']}", json=payload, headers=user.headers)
+
+
+async def list_tags(client, ctx):
+    return await client.get('/api/tags', headers=ctx.user().headers)
+
+
+async def stats(client, ctx):
+    return await client.get('/api/stats', headers=ctx.user().headers)
+
+
+async def export(client, ctx):
+    return await client.get('/api/export', headers=ctx.user().headers)
+
+
+async def import_batch(client, ctx):
+    from benchmarks.corpus import make_snippet
+    snippets = [make_snippet(ctx.rng, 1500, 16384, ctx.tags) for _ in range(20)]
+    return await client.post('/api/import', json={'snippets': snippets}, headers=ctx.user().headers)
+
+
+async def share(client, ctx):
+    return await client.get(f"/api/share/{ctx.snippet(ctx.user())['id']}")
+
+
+# Scenarios measured while other clients keep running the listed scenarios in the background
+UNDER_LOAD: Dict[str, tuple] = {
+    'get_during_bulk': ('get', ('export', 'import')),
+}
+
+SCENARIOS: Dict[str, Scenario] = {
+    'list': list_snippets,
+    'get': get_snippet,
+    'search': search,
+    'search_tags': search_tags,
+    'autosave': autosave,
+    'tags': list_tags,
+    'stats': stats,
+    'export': export,
+    'import': import_batch,
+    'share': share,
+}
+SCENARIO_NAMES = [*SCENARIOS, *UNDER_LOAD]
+
+# ============ Driver ============
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latencyMs': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+            'p50': ms(percentile(latencies, 50)),
+            'p90': ms(percentile(latencies, 90)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if latencies else 0.0,
+        },
+    }
+
+
+async def run_scenario(client: httpx.AsyncClient, ctx: Context, scenario: Scenario,
+                       requests: int, concurrency: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await scenario(client, ctx)
+
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await scenario(client, ctx)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+async def run_under_load(client: httpx.AsyncClient, ctx: Context, scenario: Scenario, background: List[Scenario],
+                         requests: int, concurrency: int, warmup: int) -> dict:
+    """run_scenario while two clients per background scenario loop it, counting their statuses.
+
+    Like the frontend, the background clients wait out the Retry-After of a 429 or 503.
+    """
+    statuses: Dict[str, int] = {}
+    done = asyncio.Event()
+
+    async def loop(task: Scenario):
+        while not done.is_set():
+            retry_after = 0.0
+            try:
+                response = await task(client, ctx)
+                status = str(response.status_code)
+                if response.status_code in (429, 503):
+                    retry_after = float(response.headers.get('retry-after', 1))
+            except httpx.HTTPError:
+                status = 'error'
+            statuses[status] = statuses.get(status, 0) + 1
+            if retry_after:
+                try:
+                    await asyncio.wait_for(done.wait(), retry_after)
+                except asyncio.TimeoutError:
+                    pass
+
+    tasks = [asyncio.create_task(loop(task)) for task in background for _ in range(2)]
+    try:
+        result = await run_scenario(client, ctx, scenario, requests, concurrency, warmup)
+    finally:
+        done.set()
+        await asyncio.gather(*tasks)
+    result['background'] = dict(sorted(statuses.items()))
+    return result
+
+
+async def prepare_context(client: httpx.AsyncClient, users: int, random_seed: int) -> Context:
+    from benchmarks.seed import PASSWORD, username
+
+    bench_users = []
+    for index in range(users):
+        response = await client.post('/api/auth/login', json={'username': username(index), 'password': PASSWORD})
+        response.raise_for_status()
+        user = BenchUser(
+            username=username(index),
+            headers={'Authorization': f"Bearer {response.json()['access_token']}"},
+        )
+        response = await client.get('/api/snippets', params={'limit': 1000}, headers=user.headers)
+        response.raise_for_status()
+        user.snippets = response.json()
+        bench_users.append(user)
+
+    response = await client.get('/api/tags', headers=bench_users[0].headers)
+    response.raise_for_status()
+    tags = [tag['name'] for tag in response.json()] or ['utils']
+    return Context(users=bench_users, tags=tags, rng=random.Random(random_seed))
+
+
+async def run_all(client: httpx.AsyncClient, args) -> Dict[str, dict]:
+    ctx = await prepare_context(client, args.users, args.seed)
+    results = {}
+    for name in args.scenarios:
+        if name in UNDER_LOAD:
+            measured, background = UNDER_LOAD[name]
+            results[name] = await run_under_load(
+                client, ctx, SCENARIOS[measured], [SCENARIOS[task] for task in background],
+                args.requests, args.concurrency, args.warmup
+            )
+        else:
+            results[name] = await run_scenario(
+                client, ctx, SCENARIOS[name], args.requests, args.concurrency, args.warmup
+            )
+        print(f"  {name:<12} {results[name]['throughput']:>9.1f} req/s  "
+              f"p50 {results[name]['latencyMs']['p50']:>8.2f} ms  "
+              f"p99 {results[name]['latencyMs']['p99']:>8.2f} ms", file=sys.stderr)
+    return results
+
+
+async def run_inprocess(args) -> Dict[str, dict]:
+    from database import dispose_engines
+    from server import app
+
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+                return await run_all(client, args)
+    finally:
+        await dispose_engines()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(args) -> Dict[str, dict]:
+    port = free_port()
+    return await run_server(args, port, [
+        sys.executable, '-m', 'uvicorn', 'server:app', '--host', '127.0.0.1',
+        '--port', str(port), '--log-level', 'warning',
+    ])
+
+
+async def run_serve(args, workers: int) -> Dict[str, dict]:
+    """Run the scenarios against serve.py with the given number of worker processes."""
+    port = free_port()
+    return await run_server(args, port, [
+        sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(workers), '--log-level', 'warning', '--no-access-log',
+    ])
+
+
+async def run_server(args, port: int, command: List[str]) -> Dict[str, dict]:
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=os.environ.copy())
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    if (await client.get('/health')).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"{' '.join(command[1:3])} did not start")
+                await asyncio.sleep(0.1)
+            return await run_all(client, args)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='SQLite file to benchmark (default: a temporary file)')
+    parser.add_argument('--reuse', action='store_true', help='Reuse an already seeded --db instead of reseeding')
+    parser.add_argument('--mode', choices=['inprocess', 'uvicorn', 'both', 'workers'], default='inprocess',
+                        help='workers: serve.py once per --workers count, to compare 1 worker with N')
+    parser.add_argument('--workers', default=f'1,{min(os.cpu_count() or 1, 8)}',
+                        help='Comma-separated worker counts for --mode workers (default: %(default)s)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated scenarios (default: all of {', '.join(SCENARIOS)}; "
+                             f"also {', '.join(UNDER_LOAD)})")
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests before each scenario')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--snippets', type=int, default=1000, help='Snippets per user')
+    parser.add_argument('--tags', type=int, default=30)
+    parser.add_argument('--folders', type=int, default=8)
+    parser.add_argument('--median-size', type=int, default=1500, help='Median code size in bytes')
+    parser.add_argument('--max-size', type=int, default=65536, help='Maximum code size in bytes')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write JSON results here instead of stdout')
+    parser.add_argument('--admission', action='store_true', help='Run with admission control on')
+    args = parser.parse_args(argv)
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIO_NAMES]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    try:
+        args.workers = sorted({int(count) for count in args.workers.split(',') if count.strip()})
+    except ValueError:
+        parser.error('--workers must be comma-separated numbers')
+    if not args.workers or args.workers[0] < 1:
+        parser.error('--workers needs counts of at least 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_path = Path(args.db) if args.db else Path(tempfile.mkdtemp(prefix='tagsnip-bench-')) / 'bench.db'
+
+    # The app reads these at import time, and uvicorn workers inherit them
+    os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{db_path.resolve()}'
+    os.environ.setdefault('JWT_SECRET', 'benchmark-secret')
+    os.environ['ADMISSION_CONTROL'] = 'true' if args.admission else 'false'
+    if args.admission:
+        os.environ.setdefault('ADMISSION_INTERACTIVE_USER_RATE', '0')
+        os.environ.setdefault('ADMISSION_INTERACTIVE_USER_CONCURRENCY', '0')
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    from benchmarks.seed import seed
+
+    corpus = None
+    if not (args.reuse and db_path.exists()):
+        for suffix in ('', '-wal', '-shm'):
+            Path(f'{db_path}{suffix}').unlink(missing_ok=True)
+        print(f'Seeding {db_path} ...', file=sys.stderr)
+        start = time.perf_counter()
+        corpus = asyncio.run(seed(
+            users=args.users, snippets_per_user=args.snippets, tags=args.tags, folders=args.folders,
+            median_size=args.median_size, max_size=args.max_size,
+            duplicate_ratio=args.duplicate_ratio, random_seed=args.seed,
+        ))
+        corpus['seedSeconds'] = round(time.perf_counter() - start, 2)
+
+    results = {}
+    if args.mode in ('inprocess', 'both'):
+        print('In-process (ASGI):', file=sys.stderr)
+        results['inprocess'] = asyncio.run(run_inprocess(args))
+    if args.mode in ('uvicorn', 'both'):
+        print('Local uvicorn:', file=sys.stderr)
+        results['uvicorn'] = asyncio.run(run_uvicorn(args))
+    scaling = None
+    if args.mode == 'workers':
+        for workers in args.workers:
+            print(f'serve.py, {workers} worker(s):', file=sys.stderr)
+            results[f'workers-{workers}'] = asyncio.run(run_serve(args, workers))
+        # Throughput of each worker count relative to the smallest one
+        base = results[f'workers-{args.workers[0]}']
+        scaling = {
+            f'workers-{workers}': {
+                name: round(result['throughput'] / base[name]['throughput'], 2) if base[name]['throughput'] else None
+                for name, result in results[f'workers-{workers}'].items()
+            }
+            for workers in args.workers[1:]
+        }
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': str(db_path),
+            'dbBytes': db_path.stat().st_size if db_path.exists() else 0,
+            'config': {
+                key: getattr(args, key)
+                for key in ('mode', 'workers', 'scenarios', 'requests', 'concurrency', 'warmup', 'users',
+                            'snippets', 'tags', 'folders', 'median_size', 'max_size',
+                            'duplicate_ratio', 'seed', 'admission')
+            },
+        },
+        'corpus': corpus,
+        'results': results,
+    }
+    if scaling is not None:
+        report['scaling'] = scaling
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Seed a database with a synthetic corpus of users, folders, tags and snippets.
+
+DATABASE_URL must point at the target database before this module is
+imported, since the app's engine is created at import time.
+"""
+from datetime import datetime, timedelta, timezone
+import random
+import uuid
+
+from sqlalchemy import insert
+
+from benchmarks.corpus import FOLDERS, TAGS, make_snippet
+from database import async_session, bind_user, dispose_engines, init_db, Folder, Snippet, User, snippet_tags
+from migrations import run_migrations
+from server import hash_password
+from tag_cache import tag_cache, normalize_tag_names
+
+PASSWORD = 'benchmark-password'
+BATCH_SIZE = 500
+
+
+def username(index: int) -> str:
+    return f'bench-user-{index}'
+
+
+async def seed(
+    users: int = 5,
+    snippets_per_user: int = 1000,
+    tags: int = 30,
+    folders: int = 8,
+    median_size: int = 1500,
+    max_size: int = 65536,
+    duplicate_ratio: float = 0.1,
+    random_seed: int = 42,
+) -> dict:
+    """Create the corpus and return a summary of what was written."""
+    rng = random.Random(random_seed)
+    await init_db()
+    await run_migrations()
+
+    tag_pool = [TAGS[i % len(TAGS)] + ('' if i < len(TAGS) else f'-{i}') for i in range(tags)]
+    folder_names = [FOLDERS[i % len(FOLDERS)] + ('' if i < len(FOLDERS) else f' {i}') for i in range(folders)]
+    hashed = hash_password(PASSWORD)
+    now = datetime.now(timezone.utc)
+    total_snippets = 0
+    total_bytes = 0
+
+    for index in range(users):
+        async with async_session() as session:
+            user = User(id=str(uuid.uuid4()), username=username(index), hashed_password=hashed, created_at=now)
+            session.add(user)
+            bind_user(session, user.id)
+            folder_ids = []
+            for name in folder_names:
+                folder = Folder(id=str(uuid.uuid4()), name=name, user_id=user.id, created_at=now)
+                session.add(folder)
+                folder_ids.append(folder.id)
+            tag_ids = await tag_cache.resolve(session, tag_pool)
+
+            previous = []
+            for start in range(0, snippets_per_user, BATCH_SIZE):
+                rows = []
+                for offset in range(start, min(start + BATCH_SIZE, snippets_per_user)):
+                    if previous and rng.random() < duplicate_ratio:
+                        data = dict(rng.choice(previous))
+                    else:
+                        data = make_snippet(rng, median_size, max_size, tag_pool)
+                        previous.append(data)
+                    updated = now - timedelta(minutes=offset)
+                    snippet = Snippet(
+                        id=str(uuid.uuid4()),
+                        title=data['title'],
+                        description=data['description'],
+                        code=data['code'],
+                        language=data['language'],
+                        user_id=user.id,
+                        folder_id=rng.choice(folder_ids + [None]) if folder_ids else None,
+                        is_favorite=rng.random() < 0.1,
+                        created_at=updated,
+                        updated_at=updated,
+                    )
+                    session.add(snippet)
+                    rows.extend(
+                        {'snippet_id': snippet.id, 'tag_id': tag_ids[name]}
+                        for name in normalize_tag_names(data['tags'])
+                    )
+                    total_bytes += len(data['code'])
+                await session.flush()
+                if rows:
+                    await session.execute(insert(snippet_tags), rows)
+                total_snippets += min(BATCH_SIZE, snippets_per_user - start)
+            await session.commit()
+
+    # Close pooled connections so they don't outlive the caller's event loop
+    await dispose_engines()
+    return {
+        'users': users,
+        'snippets': total_snippets,
+        'tags': len(tag_pool),
+        'foldersPerUser': len(folder_names),
+        'codeBytes': total_bytes,
+    }
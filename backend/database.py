@@ -1,21 +1,320 @@
-from sqlalchemy import Column, String, Text, DateTime, Integer, ForeignKey, Table, Boolean, create_engine
+from sqlalchemy import Column, String, Text, DateTime, Integer, BigInteger, ForeignKey, Table, Boolean, LargeBinary, UniqueConstraint, Index, create_engine, delete, event, exists, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import relationship, sessionmaker, Session, attributes
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timezone
+import asyncio
+import hashlib
+import json
 import os
+import zlib
 from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows, where serve.py runs a single process
+    fcntl = None
+
+T = TypeVar('T')
+
+load_dotenv(Path(__file__).parent / '.env')
 
 # Database path
 DB_PATH = Path(__file__).parent / "tagsnip.db"
-DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+DATABASE_URL = os.environ.get('DATABASE_URL') or f"sqlite+aiosqlite:///{DB_PATH}"
+
+# Use the async drivers for plain sqlite:// and postgresql:// URLs
+if DATABASE_URL.startswith('sqlite://'):
+    DATABASE_URL = DATABASE_URL.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+elif DATABASE_URL.startswith(('postgresql://', 'postgres://')):
+    DATABASE_URL = 'postgresql+asyncpg://' + DATABASE_URL.split('://', 1)[1]
 
 # Create async engine
 engine = create_async_engine(DATABASE_URL, echo=False)
 
+# How long a SQLite connection waits for another process's write lock before failing
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+# WAL lets readers in every worker process run alongside the single writer
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper()
+
+
+def _sqlite_file(target: AsyncEngine) -> Optional[str]:
+    if target.dialect.name != 'sqlite' or target.url.database in (None, '', ':memory:'):
+        return None
+    return target.url.database
+
+# Code bodies at least this large are stored zlib-compressed
+CODE_COMPRESS_MIN_BYTES = int(os.environ.get('CODE_COMPRESS_MIN_BYTES', 512))
+
+
+def insert_or_ignore(model, dialect_name: str, index_elements):
+    """Build an INSERT that skips rows conflicting on the given unique columns."""
+    if dialect_name == 'postgresql':
+        return postgresql_insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    return sqlite_insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def encode_code(code: str):
+    """Return (codec, data) for storing a code body, compressing it when that pays off."""
+    raw = code.encode('utf-8')
+    if len(raw) >= CODE_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(raw, 6)
+        if len(compressed) < len(raw):
+            return 'zlib', compressed
+    return 'raw', raw
+
+
+def decode_code(codec: str, data: bytes) -> str:
+    if data is None:
+        return ''
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    return bytes(data).decode('utf-8')
+
+
+def _register_sql_functions(dbapi_connection, connection_record):
+    # code_text(codec, data) lets SQL (e.g. search) read compressed code bodies
+    dbapi_connection.create_function('code_text', 2, decode_code, deterministic=True)
+
+
+def _set_busy_timeout(dbapi_connection, connection_record):
+    # Several server processes may share the file (see serve.py): writers
+    # queue on the lock for up to busy_timeout instead of failing at once
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+
+def _set_journal_mode(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}')
+    if SQLITE_JOURNAL_MODE == 'WAL':
+        # Durable at checkpoints; a power loss can only drop the last commits
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
+
+def _configure_sqlite(target: AsyncEngine):
+    event.listen(target.sync_engine, 'connect', _register_sql_functions)
+    event.listen(target.sync_engine, 'connect', _set_busy_timeout)
+    if SQLITE_JOURNAL_MODE and _sqlite_file(target):
+        event.listen(target.sync_engine, 'connect', _set_journal_mode)
+
+
+def sqlite_engine(path) -> AsyncEngine:
+    """Engine for another SQLite file, set up like the main one."""
+    target = create_async_engine(f'sqlite+aiosqlite:///{path}', echo=False)
+    _configure_sqlite(target)
+    return target
+
+
+if engine.dialect.name == 'sqlite':
+    _configure_sqlite(engine)
+
+# ============ Shards ============
+
+# Users' snippets, folders, tags and everything hanging off them are spread
+# over this many SQLite files, each with its own writer lock, so one user's
+# import doesn't hold up everybody's autosaves. Accounts stay in the main
+# database. 0 keeps everything in one file; changing the count moves the
+# affected users' rows on the next start (see migrations.rebalance_shards).
+SHARD_COUNT = int(os.environ.get('SQLITE_SHARDS', 0)) if _sqlite_file(engine) else 0
+SHARD_DIR = Path(os.environ.get('SQLITE_SHARD_DIR') or Path(_sqlite_file(engine) or DB_PATH).parent)
+
+
+def shard_path(index: int) -> Path:
+    main = Path(_sqlite_file(engine) or DB_PATH)
+    return SHARD_DIR / f'{main.stem}-shard-{index}{main.suffix}'
+
+
+shard_engines: List[AsyncEngine] = [sqlite_engine(shard_path(index)) for index in range(SHARD_COUNT)]
+
+
+def all_engines() -> List[AsyncEngine]:
+    """Every database: the main one first, then the shards."""
+    return [engine, *shard_engines]
+
+
+def shard_index(user_id: str) -> int:
+    """Shard holding a user's rows; stable as long as SHARD_COUNT is."""
+    return zlib.crc32(user_id.encode('utf-8')) % SHARD_COUNT
+
+
+def user_engine(user_id: Optional[str]) -> AsyncEngine:
+    """Database holding user_id's rows (the main one without shards or user)."""
+    return shard_engines[shard_index(user_id)] if SHARD_COUNT and user_id else engine
+
+
+async def dispose_engines():
+    """Close every pooled connection; aiosqlite's worker threads keep the process alive otherwise."""
+    await asyncio.gather(*(target.dispose() for target in all_engines()))
+
+# ============ Sessions ============
+
+# Session.info key holding the shard of the user whose rows the session reads and writes
+_SHARD_KEY = 'shard'
+
+
+class RoutingSession(Session):
+    """Session that keeps users in the main database and sends every other
+    table to the shard picked by bind_user(). Without shards it is a plain Session.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if not SHARD_COUNT:
+            return super().get_bind(mapper, clause=clause, **kw)
+        if mapper is not None and getattr(mapper, 'class_', mapper) is User:
+            return engine.sync_engine
+        index = self.info.get(_SHARD_KEY)
+        if index is None:
+            raise RuntimeError("Session isn't bound to a shard; call bind_user() first")
+        return shard_engines[index].sync_engine
+
+
 # Create async session
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+async_session = sessionmaker(engine, class_=AsyncSession, sync_session_class=RoutingSession, expire_on_commit=False)
+
+
+def bind_user(session, user_id: str):
+    """Route the session's queries on everything but users to user_id's shard."""
+    if SHARD_COUNT:
+        session.info[_SHARD_KEY] = shard_index(user_id)
+
+
+def session_shard(session) -> Optional[int]:
+    return session.info.get(_SHARD_KEY)
+
+
+def session_engine(session) -> AsyncEngine:
+    """Database the session's user rows live in."""
+    index = session_shard(session)
+    return engine if index is None else shard_engines[index]
+
+
+async def for_each_shard(fn: Callable[[AsyncSession], Awaitable[T]]) -> List[T]:
+    """Run fn(session) concurrently on every database holding user rows and return the results.
+
+    That is each shard, or just the main database when there are none;
+    used for work spanning all users, like tag cleanup or cache warming.
+    """
+    async def run(index: Optional[int]) -> T:
+        async with async_session(info={_SHARD_KEY: index}) as session:
+            return await fn(session)
+
+    return list(await asyncio.gather(*(run(index) for index in (range(SHARD_COUNT) if SHARD_COUNT else [None]))))
+
+# ============ Writers ============
+
+class _WriterLock:
+    """Exclusive flock() on a file next to a SQLite database, shared by every process using it.
+
+    Waiting happens in the kernel, which hands the lock over as soon as it
+    is released, while SQLite's busy handler sleeps and retries and can
+    starve a writer past the busy timeout. A worker that dies releases it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _file(self) -> int:
+        # Forked workers must open their own file: flock() locks are shared through inherited descriptors
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    async def acquire(self):
+        fd = self._file()
+        waiting = asyncio.ensure_future(asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX))
+        try:
+            await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            # The thread can't be interrupted; let go of the lock once it gets it
+            waiting.add_done_callback(lambda done: done.cancelled() or done.exception() or self.release())
+            raise
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+# Per SQLite database: a queue for this process's writers, so only one of
+# them at a time waits for the lock shared with other processes, and that lock
+_writers: Dict[Engine, Tuple[asyncio.Lock, Optional[_WriterLock]]] = {
+    _target.sync_engine: (
+        asyncio.Lock(),
+        _WriterLock(f'{_sqlite_file(_target)}-writer.lock') if fcntl is not None and _sqlite_file(_target) else None,
+    )
+    for _target in all_engines() if _target.dialect.name == 'sqlite'
+}
+_write_engine: ContextVar[Optional[Engine]] = ContextVar('write_engine', default=None)
+
+
+@asynccontextmanager
+async def writing(target: AsyncEngine):
+    """Hold the write turn of a database for a block that writes to it.
+
+    On SQLite the block waits its turn among this process's writers and
+    then for the writer lock shared with other processes, and transactions
+    on the database start with BEGIN IMMEDIATE, taking SQLite's write lock
+    before the first read. A deferred transaction that read first can't
+    wait for the lock if another connection committed meanwhile (its
+    snapshot is stale) and fails with "database is locked" instead.
+    """
+    queue, lock = _writers.get(target.sync_engine, (None, None))
+    if queue is None:
+        yield
+        return
+    async with queue:
+        if lock is not None:
+            await lock.acquire()
+        token = _write_engine.set(target.sync_engine)
+        try:
+            yield
+        finally:
+            _write_engine.reset(token)
+            if lock is not None:
+                lock.release()
+
+
+@contextmanager
+def writes_paused():
+    """Hold the shared writer lock of every SQLite database (blocking; run it in a thread).
+
+    Writers in every process wait until the block ends. Returns False when
+    there are no locks to take (no fcntl), so writes weren't paused.
+    """
+    paths = [lock.path for _, lock in _writers.values() if lock is not None]
+    fds = []
+    try:
+        # Always the same order; writers only ever hold one of the locks
+        for path in paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            fds.append(fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield bool(paths)
+    finally:
+        for fd in reversed(fds):
+            os.close(fd)
+
+
+@event.listens_for(Session, 'after_begin')
+def _begin_immediate(session, transaction, connection):
+    if connection.engine is _write_engine.get() and not transaction.nested:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
 
 # Base class for models
 Base = declarative_base()
@@ -60,9 +359,9 @@ class User(Base):
     hashed_password = Column(String(255), nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     
-    # Relationships
-    snippets = relationship('Snippet', back_populates='user', lazy='selectin')
-    folders = relationship('Folder', back_populates='user', lazy='selectin')
+    # Relationships; never loaded, since with shards a user's rows live in another database
+    snippets = relationship('Snippet', back_populates='user', lazy='noload')
+    folders = relationship('Folder', back_populates='user', lazy='noload')
     
     def to_dict(self):
         return {
@@ -78,7 +377,7 @@ class Snippet(Base):
     id = Column(String, primary_key=True)
     title = Column(String(255), nullable=False, default='Untitled Snippet')
     description = Column(Text, nullable=True)
-    code = Column(Text, nullable=False, default='')
+    code_hash = Column(String(64), ForeignKey('code_blobs.hash'), nullable=True, index=True)
     language = Column(String(50), nullable=False, default='javascript')
     user_id = Column(String, ForeignKey('users.id', ondelete='CASCADE'), nullable=True)
     folder_id = Column(String, ForeignKey('folders.id', ondelete='SET NULL'), nullable=True)
@@ -90,6 +389,25 @@ class Snippet(Base):
     tags = relationship('Tag', secondary=snippet_tags, back_populates='snippets', lazy='selectin')
     user = relationship('User', back_populates='snippets')
     folder = relationship('Folder', back_populates='snippets')
+    blob = relationship('CodeBlob', lazy='selectin', viewonly=True)
+    
+    @property
+    def code(self) -> str:
+        """Code body, read from the content-addressed blob it points to."""
+        cached = self.__dict__.get('_code')
+        if cached is not None and cached[0] == self.code_hash:
+            return cached[1]
+        code = self.blob.text if self.blob is not None else ''
+        self.__dict__['_code'] = (self.code_hash, code)
+        return code
+    
+    @code.setter
+    def code(self, value: str):
+        value = value or ''
+        self.code_hash = code_hash(value)
+        self.__dict__['_code'] = (self.code_hash, value)
+        # The blob row is written by _store_code_blobs on the next flush
+        self.__dict__['_code_pending'] = True
     
     def to_dict(self):
         return {
@@ -106,6 +424,78 @@ class Snippet(Base):
             'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
         }
 
+class CodeBlob(Base):
+    """Snippet code stored once per distinct content, keyed by its SHA-256."""
+    __tablename__ = 'code_blobs'
+    
+    hash = Column(String(64), primary_key=True)
+    codec = Column(String(10), nullable=False, default='raw')  # 'raw' or 'zlib'
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)  # Uncompressed size in bytes
+    
+    @property
+    def text(self) -> str:
+        return decode_code(self.codec, self.data)
+
+class SnippetRevision(Base):
+    """One point in a snippet's code history: a full snapshot or a delta against the previous revision."""
+    __tablename__ = 'snippet_revisions'
+    __table_args__ = (UniqueConstraint('snippet_id', 'seq'),)
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    snippet_id = Column(String, ForeignKey('snippets.id', ondelete='CASCADE'), nullable=False)
+    seq = Column(Integer, nullable=False)
+    kind = Column(String(10), nullable=False)  # 'full' or 'delta'
+    base_seq = Column(Integer, nullable=False)  # Full snapshot this revision's delta chain starts from
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed code or delta
+    size = Column(Integer, nullable=False)  # Code size at this revision in bytes
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'kind': self.kind,
+            'size': self.size,
+            'storedSize': len(self.data),
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+class SnippetSignature(Base):
+    """MinHash signature of a snippet's code; empty for code too short to compare."""
+    __tablename__ = 'snippet_signatures'
+    
+    snippet_id = Column(String, ForeignKey('snippets.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(String, ForeignKey('users.id'), nullable=False, index=True)
+    signature = Column(LargeBinary, nullable=False)
+
+class SnippetLshBucket(Base):
+    """One LSH band of a signature. Snippets sharing a bucket are near-duplicate candidates."""
+    __tablename__ = 'snippet_lsh_buckets'
+    
+    user_id = Column(String, ForeignKey('users.id'), primary_key=True)
+    bucket = Column(BigInteger, primary_key=True)  # band << 32 | hash of the band's values
+    snippet_id = Column(String, ForeignKey('snippets.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+class SavedSearch(Base):
+    """A named search a user runs often; its results are kept cached."""
+    __tablename__ = 'saved_searches'
+    
+    id = Column(String, primary_key=True)
+    user_id = Column(String, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
+    query = Column(Text, nullable=False)  # SearchQuery as JSON
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'query': json.loads(self.query),
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+        }
+
 class Tag(Base):
     """Tag model for organizing snippets."""
     __tablename__ = 'tags'
@@ -125,18 +515,59 @@ class Tag(Base):
         }
 
 class OpenTab(Base):
-    """Model to persist open tabs state."""
+    """A snippet open in one of a user's editor tabs; `order` is its position, 0 first."""
     __tablename__ = 'open_tabs'
+    __table_args__ = (Index('ix_open_tabs_user_order', 'user_id', 'order'),)
     
     id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     snippet_id = Column(String, ForeignKey('snippets.id', ondelete='CASCADE'), nullable=False)
     order = Column(Integer, default=0)
     is_active = Column(Integer, default=0)  # SQLite doesn't have boolean, use 0/1
 
+@event.listens_for(Session, 'before_flush')
+def _store_code_blobs(session, flush_context, instances):
+    """Insert blobs for snippets whose code changed, skipping content that is already stored."""
+    rows = {}
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Snippet) or not obj.__dict__.pop('_code_pending', False):
+            continue
+        if obj in session.new or attributes.get_history(obj, 'code_hash').has_changes():
+            digest, code = obj.__dict__['_code']
+            if digest not in rows:
+                codec, data = encode_code(code)
+                rows[digest] = {'hash': digest, 'codec': codec, 'data': data, 'size': len(code.encode('utf-8'))}
+    if rows:
+        connection = session.connection()
+        connection.execute(
+            insert_or_ignore(CodeBlob, connection.dialect.name, ['hash']),
+            list(rows.values())
+        )
+
+@event.listens_for(Session, 'after_flush')
+def _delete_orphaned_code_blobs(session, flush_context):
+    """Drop blobs no snippet points to anymore after code changes and deletions."""
+    old_hashes = set()
+    for obj in session.dirty:
+        if isinstance(obj, Snippet):
+            old_hashes.update(attributes.get_history(obj, 'code_hash').deleted)
+    for obj in session.deleted:
+        if isinstance(obj, Snippet):
+            old_hashes.add(obj.code_hash)
+    old_hashes.discard(None)
+    if old_hashes:
+        session.connection().execute(
+            delete(CodeBlob).where(
+                CodeBlob.hash.in_(old_hashes),
+                ~exists().where(Snippet.code_hash == CodeBlob.hash)
+            )
+        )
+
 async def init_db():
-    """Initialize the database, creating tables if they don't exist."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    """Initialize the databases, creating tables if they don't exist."""
+    for target in all_engines():
+        async with target.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
 
 async def get_session():
     """Get a database session."""
@@ -0,0 +1,264 @@
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import asyncio
+import os
+import re
+import struct
+import zlib
+
+from database import Snippet, SnippetLshBucket, SnippetSignature
+
+# Default similarity (estimated Jaccard of code shingles) for calling two snippets duplicates
+THRESHOLD = float(os.environ.get('DUPLICATE_THRESHOLD', 0.85))
+# Only the start of very large snippets is compared, which bounds the cost of a signature
+MAX_CHARS = int(os.environ.get('DUPLICATE_MAX_CHARS', 20000))
+
+# Tokens per shingle
+SHINGLE_SIZE = 4
+# Signatures are BANDS * ROWS minimum hashes. Two snippets share a bucket
+# with probability 1 - (1 - s^ROWS)^BANDS for similarity s: about 0.5 at
+# s = 0.5 and over 0.99 at s = 0.8. Changing these invalidates stored signatures.
+BANDS = 16
+ROWS = 4
+NUM_HASHES = BANDS * ROWS
+# Buckets with more members than this are only compared against their first member
+MAX_PAIRWISE = 50
+
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+_PRIME = (1 << 61) - 1
+# Fixed constants: signatures are stored, so the hash must not change between runs
+_MIX_A = 0x1B873593_CC9E2D51 % _PRIME
+_MIX_B = 0x2545F491_4F6CDD1D % _PRIME
+_EMPTY = 1 << 32
+# Order in which an empty bin looks for a filled one to copy (a fixed pseudo-random order per bin)
+_PROBES = [
+    sorted(range(NUM_HASHES), key=lambda probe: zlib.crc32(bytes((slot, probe))))
+    for slot in range(NUM_HASHES)
+]
+_PACK = struct.Struct(f'<{NUM_HASHES}I')
+_BAND = struct.Struct(f'<{ROWS}I')
+
+Signature = Tuple[int, ...]
+
+# ============ Signatures ============
+
+def shingles(code: Optional[str]) -> Set[int]:
+    """Hashes of every SHINGLE_SIZE consecutive tokens; whitespace and case don't matter."""
+    tokens = _TOKEN.findall((code or '')[:MAX_CHARS].lower())
+    if len(tokens) <= SHINGLE_SIZE:
+        return {zlib.crc32(' '.join(tokens).encode('utf-8'))} if tokens else set()
+    return {
+        zlib.crc32(' '.join(tokens[i:i + SHINGLE_SIZE]).encode('utf-8'))
+        for i in range(len(tokens) - SHINGLE_SIZE + 1)
+    }
+
+
+def signature(code: Optional[str]) -> Optional[Signature]:
+    """MinHash signature of code, or None if it has no tokens.
+
+    One-permutation hashing: each shingle is hashed once and the hash picks
+    one of NUM_HASHES bins, which keep their minimum. That costs one hash
+    per shingle instead of NUM_HASHES. Bins no shingle fell into copy the
+    first filled bin of their fixed probe order ("optimal densification"),
+    so short snippets are estimated about as well as with NUM_HASHES hashes.
+    """
+    items = shingles(code)
+    if not items:
+        return None
+    mins = [_EMPTY] * NUM_HASHES
+    for x in items:
+        h = (_MIX_A * x + _MIX_B) % _PRIME
+        slot = h % NUM_HASHES
+        value = (h // NUM_HASHES) & 0xFFFFFFFF
+        if value < mins[slot]:
+            mins[slot] = value
+    if _EMPTY in mins:
+        filled = list(mins)
+        for slot, value in enumerate(filled):
+            if value == _EMPTY:
+                mins[slot] = next(filled[probe] for probe in _PROBES[slot] if filled[probe] != _EMPTY)
+    return tuple(mins)
+
+
+def similarity(a: Signature, b: Signature) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+def buckets(sig: Signature) -> List[int]:
+    return [
+        (band << 32) | zlib.crc32(_BAND.pack(*sig[band * ROWS:(band + 1) * ROWS]))
+        for band in range(BANDS)
+    ]
+
+
+def pack(sig: Optional[Signature]) -> bytes:
+    return _PACK.pack(*sig) if sig else b''
+
+
+def unpack(data: bytes) -> Optional[Signature]:
+    return _PACK.unpack(data) if len(data) == _PACK.size else None
+
+# ============ Index ============
+
+def index_rows(user_id: str, signatures: Iterable[Tuple[str, Optional[Signature]]]):
+    """(signature rows, bucket rows) to insert for (snippet_id, signature) pairs."""
+    signature_rows, bucket_rows = [], []
+    for snippet_id, sig in signatures:
+        signature_rows.append({'snippet_id': snippet_id, 'user_id': user_id, 'signature': pack(sig)})
+        if sig:
+            bucket_rows.extend(
+                {'user_id': user_id, 'bucket': bucket, 'snippet_id': snippet_id} for bucket in set(buckets(sig))
+            )
+    return signature_rows, bucket_rows
+
+
+async def write_signatures(session: AsyncSession, user_id: str, signatures: List[Tuple[str, Optional[Signature]]]):
+    """Replace the index entries of the given snippets."""
+    if not signatures:
+        return
+    await delete_index(session, [snippet_id for snippet_id, _ in signatures])
+    signature_rows, bucket_rows = index_rows(user_id, signatures)
+    await session.execute(insert(SnippetSignature), signature_rows)
+    if bucket_rows:
+        await session.execute(insert(SnippetLshBucket), bucket_rows)
+
+
+async def index_snippet(session: AsyncSession, snippet: Snippet):
+    """Index a created snippet, or re-index one whose code changed."""
+    sig = await asyncio.to_thread(signature, snippet.code)
+    await write_signatures(session, snippet.user_id, [(snippet.id, sig)])
+
+
+async def delete_index(session: AsyncSession, snippet_ids: Sequence[str]):
+    await session.execute(delete(SnippetLshBucket).where(SnippetLshBucket.snippet_id.in_(snippet_ids)))
+    await session.execute(delete(SnippetSignature).where(SnippetSignature.snippet_id.in_(snippet_ids)))
+
+# ============ Lookups ============
+
+async def _signatures(session: AsyncSession, snippet_ids: Iterable[str]) -> Dict[str, Signature]:
+    ids = list(snippet_ids)
+    found = {}
+    for start in range(0, len(ids), 500):
+        result = await session.execute(
+            select(SnippetSignature.snippet_id, SnippetSignature.signature)
+            .where(SnippetSignature.snippet_id.in_(ids[start:start + 500]))
+        )
+        for snippet_id, data in result:
+            sig = unpack(data)
+            if sig is not None:
+                found[snippet_id] = sig
+    return found
+
+
+class DuplicateFilter:
+    """Checks a batch of new snippets against a user's index and against each other.
+
+    Used by imports: load() fetches the stored signatures sharing a bucket
+    with any of the batch in a few queries, after which is_duplicate() is
+    pure computation.
+    """
+
+    def __init__(self, threshold: float = THRESHOLD):
+        self.threshold = threshold
+        self._by_bucket: Dict[int, List[Signature]] = {}
+
+    async def load(self, session: AsyncSession, user_id: str, signatures: Iterable[Optional[Signature]]):
+        wanted = sorted({bucket for sig in signatures if sig for bucket in buckets(sig)})
+        members: Dict[str, List[int]] = {}
+        for start in range(0, len(wanted), 500):
+            result = await session.execute(
+                select(SnippetLshBucket.bucket, SnippetLshBucket.snippet_id)
+                .where(SnippetLshBucket.user_id == user_id, SnippetLshBucket.bucket.in_(wanted[start:start + 500]))
+            )
+            for bucket, snippet_id in result:
+                members.setdefault(snippet_id, []).append(bucket)
+        for snippet_id, sig in (await _signatures(session, members)).items():
+            for bucket in members[snippet_id]:
+                self._by_bucket.setdefault(bucket, []).append(sig)
+
+    def is_duplicate(self, sig: Optional[Signature]) -> bool:
+        """True if sig is a near-duplicate of a stored snippet or of one add()ed earlier."""
+        if not sig:
+            return False
+        seen = set()
+        for bucket in buckets(sig):
+            for other in self._by_bucket.get(bucket, ()):
+                if id(other) not in seen:
+                    seen.add(id(other))
+                    if similarity(sig, other) >= self.threshold:
+                        return True
+        return False
+
+    def add(self, sig: Optional[Signature]):
+        if sig:
+            for bucket in buckets(sig):
+                self._by_bucket.setdefault(bucket, []).append(sig)
+
+
+def _cluster(groups: List[List[str]], signatures: Dict[str, Signature], threshold: float):
+    """Union snippets whose verified similarity reaches threshold into [(members, weakest similarity)]."""
+    parent: Dict[str, str] = {}
+
+    def find(item: str) -> str:
+        root = item
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while item != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    checked = set()
+    links: List[Tuple[str, str, float]] = []
+    for members in groups:
+        members = [m for m in members if m in signatures]
+        if len(members) <= MAX_PAIRWISE:
+            pairs = ((a, b) for i, a in enumerate(members) for b in members[i + 1:])
+        else:
+            pairs = ((members[0], b) for b in members[1:])
+        for a, b in pairs:
+            key = (a, b) if a < b else (b, a)
+            if key in checked:
+                continue
+            checked.add(key)
+            score = similarity(signatures[a], signatures[b])
+            if score >= threshold:
+                links.append((a, b, score))
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+
+    clusters: Dict[str, Set[str]] = {}
+    weakest: Dict[str, float] = {}
+    for a, b, score in links:
+        root = find(a)
+        clusters.setdefault(root, set()).update((a, b))
+        weakest[root] = min(weakest.get(root, 1.0), score)
+    return [(members, weakest[root]) for root, members in clusters.items()]
+
+
+async def find_clusters(session: AsyncSession, user_id: str, threshold: float = THRESHOLD) -> List[Tuple[Set[str], float]]:
+    """Groups of the user's snippets that are near-duplicates, each with its weakest similarity.
+
+    Only snippets sharing an LSH bucket are ever compared, so the cost
+    follows the number of candidates rather than the square of the library.
+    """
+    shared = (
+        select(SnippetLshBucket.bucket)
+        .where(SnippetLshBucket.user_id == user_id)
+        .group_by(SnippetLshBucket.bucket)
+        .having(func.count() > 1)
+    )
+    result = await session.execute(
+        select(SnippetLshBucket.bucket, SnippetLshBucket.snippet_id)
+        .where(SnippetLshBucket.user_id == user_id, SnippetLshBucket.bucket.in_(shared))
+        .order_by(SnippetLshBucket.bucket, SnippetLshBucket.snippet_id)
+    )
+    groups: Dict[int, List[str]] = {}
+    for bucket, snippet_id in result:
+        groups.setdefault(bucket, []).append(snippet_id)
+    if not groups:
+        return []
+    signatures = await _signatures(session, {m for members in groups.values() for m in members})
+    return await asyncio.to_thread(_cluster, list(groups.values()), signatures, threshold)
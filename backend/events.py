@@ -0,0 +1,434 @@
+from collections import deque
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+import uuid
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+# Events buffered per connection before it is considered too slow and told to resync
+QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 256))
+# Recent events kept per user so a reconnecting client can catch up via Last-Event-ID
+REPLAY_SIZE = int(os.environ.get('EVENTS_REPLAY_SIZE', 500))
+# Open streams allowed per user
+MAX_STREAMS_PER_USER = int(os.environ.get('EVENTS_MAX_STREAMS_PER_USER', 10))
+# Streams are closed after this many seconds; clients reconnect and resume, which
+# re-checks their token and keeps server shutdown from waiting on idle streams
+MAX_STREAM_SECONDS = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', 300))
+# Feeds of users without open streams are dropped after this many seconds without
+# events or reads; a client resuming after that gets a resync
+FEED_IDLE_SECONDS = float(os.environ.get('EVENTS_FEED_IDLE_SECONDS', 900))
+# Transactions emitting more events than this publish a single resync instead
+COLLAPSE_THRESHOLD = int(os.environ.get('EVENTS_COLLAPSE_THRESHOLD', 50))
+
+# Unix socket of the relay that forwards events between worker processes (set by serve.py)
+RELAY_SOCKET = os.environ.get('EVENTS_RELAY_SOCKET')
+# Longest relayed message in bytes; larger batches are sent on as a resync
+RELAY_MAX_BYTES = 1024 * 1024
+
+# Client reconnect delay sent to EventSource, in milliseconds
+RETRY_MS = 3000
+
+# Changes to this process's versions don't survive a restart, so event ids carry
+# an epoch and ids from an earlier process always trigger a resync
+EPOCH = uuid.uuid4().hex[:8]
+
+
+def _new_epoch():
+    # Forked workers number their feeds independently, so each needs its own epoch
+    global EPOCH
+    EPOCH = uuid.uuid4().hex[:8]
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_epoch)
+
+# Session.info key holding (user_id, event) pairs emitted inside an uncommitted transaction
+_PENDING_KEY = 'events_pending'
+
+# Request header naming the browser tab that caused a change; its own stream skips the echo
+ORIGIN_HEADER = b'x-client-id'
+
+current_origin: ContextVar[Optional[str]] = ContextVar('current_origin', default=None)
+
+EVENTS_PUBLISHED = metrics.registry.counter(
+    'events_published_total', 'Change events published to the feed.', ('type',))
+EVENT_STREAMS = metrics.registry.gauge('event_streams_open', 'Open change feed streams.')
+EVENT_RESYNCS = metrics.registry.counter(
+    'event_resyncs_total', 'Change feed clients told to reload everything.', ('reason',))
+
+
+def format_message(event_name: str, data: dict, event_id: Optional[str] = None) -> bytes:
+    """Encode one Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_name}')
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def event_id(version: int) -> str:
+    return f'{EPOCH}-{version}'
+
+
+def _change_message(version: int, data: dict) -> bytes:
+    name = 'resync' if data['op'] == 'resync' else 'change'
+    return format_message(name, data, event_id(version))
+
+
+def parse_event_id(value: Optional[str]) -> Optional[int]:
+    """Version encoded in a Last-Event-ID from this process, else None."""
+    if not value:
+        return None
+    epoch, _, version = value.partition('-')
+    if epoch != EPOCH or not version.isdigit():
+        return None
+    return int(version)
+
+# ============ Subscriptions ============
+
+class Subscription:
+    """One open stream. Events wait in a bounded queue until the stream sends them.
+
+    A slow reader never blocks publishers: once its queue is full the queued
+    events are dropped and the stream tells the client to resync instead.
+    """
+
+    def __init__(self, user_id: str, origin: Optional[str] = None):
+        self.user_id = user_id
+        self.origin = origin
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.overflowed = False
+        self.closed = False
+
+    def push(self, version: int, data: dict):
+        if self.overflowed or self.closed:
+            return
+        if self.origin is not None and data.get('origin') == self.origin:
+            return
+        try:
+            self.queue.put_nowait((version, data))
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+
+class _UserFeed:
+    def __init__(self, version: int):
+        self.version = version
+        self.recent: Deque[Tuple[int, dict]] = deque(maxlen=REPLAY_SIZE)
+        self.subscriptions: Set[Subscription] = set()
+        self.used = time.monotonic()
+
+
+class LocalBroker:
+    """In-process pub/sub of per-user change events.
+
+    Every event gets the next version of its user's feed. publish() hands
+    events straight to deliver(); RelayBroker also forwards them to the
+    other worker processes.
+
+    Feeds idle for FEED_IDLE_SECONDS without streams are dropped. A new feed
+    starts above every version a dropped one reached, so neither cached
+    search results nor Last-Event-IDs of the old feed can match it.
+    """
+    # False while changes made by other processes may go unseen; caches keyed on
+    # feed versions (search results, tag ids) must not be used then
+    in_sync = True
+
+    def __init__(self):
+        self._feeds: Dict[str, _UserFeed] = {}
+        self._listeners: List[Callable[[Optional[str], List[dict]], None]] = []
+        self._first_version = 0
+        self._swept = time.monotonic()
+
+    def _feed(self, user_id: str) -> _UserFeed:
+        feed = self._feeds.get(user_id)
+        if feed is None:
+            self._evict_idle()
+            feed = self._feeds[user_id] = _UserFeed(self._first_version)
+        feed.used = time.monotonic()
+        return feed
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        if now - self._swept < FEED_IDLE_SECONDS / 2:
+            return
+        self._swept = now
+        for user_id, feed in list(self._feeds.items()):
+            if not feed.subscriptions and now - feed.used > FEED_IDLE_SECONDS:
+                del self._feeds[user_id]
+                self._first_version = max(self._first_version, feed.version + 1)
+
+    def publish(self, user_id: Optional[str], events: List[dict]):
+        """Publish events to one user, or to every user with a feed when user_id is None."""
+        self.deliver(user_id, events)
+
+    def deliver(self, user_id: Optional[str], events: List[dict]):
+        feeds = self._feeds.values() if user_id is None else [self._feed(user_id)]
+        for feed in feeds:
+            for data in events:
+                feed.version += 1
+                data = {**data, 'version': feed.version}
+                feed.recent.append((feed.version, data))
+                for subscription in feed.subscriptions:
+                    subscription.push(feed.version, data)
+        for data in events:
+            EVENTS_PUBLISHED.inc(type=data['type'])
+        for listener in self._listeners:
+            listener(user_id, events)
+
+    def add_listener(self, listener: Callable[[Optional[str], List[dict]], None]):
+        """Call listener(user_id, events) after each delivery; user_id is None for changes sent to everyone."""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def version(self, user_id: str) -> int:
+        return self._feed(user_id).version
+
+    def open_streams(self, user_id: str) -> int:
+        feed = self._feeds.get(user_id)
+        return len(feed.subscriptions) if feed else 0
+
+    def subscribe(self, user_id: str, origin: Optional[str] = None) -> Subscription:
+        feed = self._feed(user_id)
+        subscription = Subscription(user_id, origin)
+        feed.subscriptions.add(subscription)
+        EVENT_STREAMS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        feed = self._feeds.get(subscription.user_id)
+        if feed is not None and subscription in feed.subscriptions:
+            feed.subscriptions.discard(subscription)
+            feed.used = time.monotonic()
+            EVENT_STREAMS.dec()
+
+    def replay(self, user_id: str, after: int) -> Optional[List[Tuple[int, dict]]]:
+        """Events newer than version `after`, or None if some of them are no longer buffered.
+
+        A feed recreated after being dropped starts past `after`, so the gap means None.
+        """
+        feed = self._feed(user_id)
+        if after > feed.version:
+            return None
+        missed = [(version, data) for version, data in feed.recent if version > after]
+        if feed.version - after > len(missed):
+            return None
+        return missed
+
+    async def start(self):
+        pass
+
+    def close(self):
+        """End every open stream, e.g. before the server shuts down."""
+        for feed in self._feeds.values():
+            for subscription in feed.subscriptions:
+                subscription.close()
+
+
+class RelayBroker(LocalBroker):
+    """Broker for one of several worker processes sharing a database.
+
+    publish() delivers locally and sends the events as a JSON line to the
+    relay socket served by serve.py, which forwards them to every other
+    worker; events arriving from the relay are delivered as if published
+    here. Each worker keeps its own versions (and epoch), so a client
+    reconnecting to a different worker resyncs.
+
+    Without the relay a worker would miss other workers' changes, so losing
+    it takes the worker out of sync and shuts it down gracefully; serve.py
+    starts a replacement, which connects afresh.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.in_sync = False
+        self._closed = False
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(self.path, limit=RELAY_MAX_BYTES)
+        except OSError:
+            logger.exception("Cannot reach the event relay at %s", self.path)
+            self._lost()
+            return
+        self.in_sync = True
+        self._reader_task = asyncio.create_task(self._receive(reader))
+
+    def _lost(self):
+        """Stop trusting caches, tell this worker's clients to resync, and have the worker replaced."""
+        if self._closed:
+            return
+        self.in_sync = False
+        self.deliver(None, [{'type': '*', 'op': 'resync'}])
+        logger.error("Lost the event relay; restarting this worker so it doesn't serve stale data")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def publish(self, user_id: Optional[str], events: List[dict]):
+        self.deliver(user_id, events)
+        if self._writer is None or self._writer.is_closing():
+            return
+        line = json.dumps({'user': user_id, 'events': events}, separators=(',', ':')).encode('utf-8')
+        if len(line) >= RELAY_MAX_BYTES:
+            line = json.dumps({'user': user_id, 'events': [{'type': '*', 'op': 'resync'}]}).encode('utf-8')
+        self._writer.write(line + b'\n')
+
+    async def _receive(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (OSError, ValueError):
+                line = b''
+            if not line:
+                self._lost()
+                return
+            message = json.loads(line)
+            self.deliver(message['user'], message['events'])
+
+    def close(self):
+        self._closed = True
+        super().close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+broker = RelayBroker(RELAY_SOCKET) if RELAY_SOCKET else LocalBroker()
+
+# ============ Emitting ============
+
+def emit(session: Session, user_id: Optional[str], kind: str, op: str, entity_id: str):
+    """Queue a change event to be published once the session's transaction commits.
+
+    `kind` is snippet, folder or tag, `op` is upsert or delete. A user_id of
+    None sends the event to every user (tags are shared).
+    """
+    data = {'type': kind, 'op': op, 'id': entity_id}
+    origin = current_origin.get()
+    if origin is not None:
+        data['origin'] = origin
+    session.info.setdefault(_PENDING_KEY, []).append((user_id, data))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending_events(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    by_user: Dict[Optional[str], List[dict]] = {}
+    for user_id, data in pending:
+        by_user.setdefault(user_id, []).append(data)
+    for user_id, events in by_user.items():
+        if len(events) > COLLAPSE_THRESHOLD:
+            events = [{'type': '*', 'op': 'resync'}]
+        broker.publish(user_id, events)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending_events(session):
+    session.info.pop(_PENDING_KEY, None)
+
+# ============ Streaming ============
+
+async def stream(user_id: str, origin: Optional[str] = None, last_event_id: Optional[str] = None):
+    """Subscribe to a user's feed and yield SSE messages until MAX_STREAM_SECONDS or close().
+
+    Subscribing here rather than before the response starts means a client
+    that disconnects early never leaves a subscription behind. Missed events
+    are replayed right after subscribing; `sent` skips queued events the
+    replay already covered.
+    """
+    deadline = time.monotonic() + MAX_STREAM_SECONDS
+    subscription = broker.subscribe(user_id, origin)
+    try:
+        messages = [f'retry: {RETRY_MS}\n\n'.encode()]
+        sent = broker.version(user_id)
+        if last_event_id:
+            after = parse_event_id(last_event_id)
+            missed = broker.replay(user_id, after) if after is not None else None
+            if missed is None:
+                EVENT_RESYNCS.inc(reason='replay')
+                messages.append(format_message('resync', {}, event_id(sent)))
+            else:
+                messages.extend(
+                    _change_message(version, data) for version, data in missed
+                    if subscription.origin is None or data.get('origin') != subscription.origin
+                )
+        messages.append(format_message('ready', {'version': sent}, event_id(sent)))
+        for message in messages:
+            yield message
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                item = await asyncio.wait_for(subscription.queue.get(), min(HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                yield b': ping\n\n'
+                continue
+            if item is None:
+                if subscription.closed:
+                    return
+                # Queue overflowed: everything dropped, client reloads from scratch
+                subscription.overflowed = False
+                sent = broker.version(user_id)
+                EVENT_RESYNCS.inc(reason='overflow')
+                yield format_message('resync', {}, event_id(sent))
+                continue
+            version, data = item
+            if version > sent:
+                sent = version
+                yield _change_message(version, data)
+    finally:
+        broker.unsubscribe(subscription)
+
+# ============ Middleware ============
+
+class OriginMiddleware:
+    """Remember the X-Client-Id of the request so emitted events can name their origin."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        origin = next((value.decode('latin-1') for key, value in scope['headers'] if key == ORIGIN_HEADER), None)
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+        token = current_origin.set(origin[:64])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_origin.reset(token)
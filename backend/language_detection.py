@@ -0,0 +1,236 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import os
+import re
+
+# Only the start of a snippet is looked at; it carries plenty of signal and bounds the cost
+MAX_CHARS = int(os.environ.get('LANGUAGE_DETECT_MAX_CHARS', 4000))
+# Minimum score for a confident guess; below it detect() returns None
+MIN_SCORE = 4.0
+# A token counts at most this many times, so one repeated word can't decide alone
+FREQUENCY_CAP = 8
+
+# One pass of this pattern turns code into the tokens scored below. A
+# "key:" at the start of a line must win over the plain identifier, which
+# comes next because it is by far the most common token; the lookahead lets
+# every other position skip the rarer alternatives with a single check.
+_TOKEN = re.compile(
+    r'(?m:^[ \t]*-?[ \t]*[A-Za-z_][\w.-]*:(?=[ \t]|$))'
+    r'|[A-Za-z_]\w*(?:!(?!=))?'                    # identifiers, macros!
+    r'|(?=[`\]"\'=!:\-$*<#@])(?:'
+    r'[$@][A-Za-z_]\w*'                            # $variables, @decorators
+    r'|<\?php|<\?xml|<!DOCTYPE|</?[A-Za-z][\w-]*'   # markup
+    r'|\#!|\#include|\#define|\#\[|(?m:^\#{1,6}(?=[ \t]))'
+    r'|```|\]\(|"""|\'\'\'|===|!==|::|->|=>|:=|\$\{|\$\(|\*\*'
+    r')'
+)
+
+# Tokens that suggest each language, grouped by weight. Weights are rough
+# log-odds: 4+ is close to proof, 1 is a weak hint shared with other languages.
+_LANGUAGE_TOKENS: Dict[str, Dict[float, str]] = {
+    'python': {
+        4: '__init__ __name__ __main__ elif nonlocal isinstance typing """ \'\'\'',
+        3: 'def self None True False except lambda',
+        2: 'import raise yield pass print len range dict kwargs args',
+        1: 'from with as is not and or in async await class',
+    },
+    'javascript': {
+        4: 'console document window undefined prototype',
+        3: 'const let function typeof === !== require exports',
+        2: 'export import async await then JSON Promise null new this => catch',
+        1: 'var return default from class',
+    },
+    # Dialect of javascript: only its own markers are listed
+    'typescript': {
+        4: 'interface readonly keyof Partial Record implements',
+        3: 'type number boolean string enum unknown never',
+        1: 'as void any private public',
+    },
+    'java': {
+        4: 'java System println @Override ArrayList HashMap throws extends',
+        3: 'public private protected static void final implements String',
+        2: 'new class package int boolean List null',
+        1: 'import',
+    },
+    'csharp': {
+        4: 'Console WriteLine namespace readonly async Task IEnumerable',
+        3: 'using public private static void string var override',
+        1: 'new class int bool null get set',
+    },
+    'c': {
+        5: '#include #define',
+        4: 'printf malloc free sizeof typedef NULL',
+        3: 'struct int void char unsigned',
+        1: 'return const static',
+    },
+    # Dialect of c
+    'cpp': {
+        4: 'std cout cin endl namespace template nullptr vector',
+        3: 'class public private virtual auto ::',
+        2: 'new delete const',
+    },
+    'go': {
+        5: 'fmt := chan',
+        4: 'func package defer Println Printf errors',
+        3: 'nil err struct go',
+        1: 'import interface range string',
+    },
+    'rust': {
+        5: 'fn impl mut println! vec! format! crate unwrap',
+        4: 'pub Vec Some Ok Err Option Result',
+        3: 'let use match enum struct',
+        1: '-> :: str self',
+    },
+    'ruby': {
+        5: 'puts elsif attr_accessor attr_reader',
+        3: 'end unless nil do each require',
+        1: 'def module class',
+    },
+    'php': {
+        10: '<?php',
+        4: '$this echo foreach array',
+        2: 'function public private ->',
+        1: '=>',
+    },
+    'swift': {
+        5: 'guard Foundation UIKit',
+        4: 'func let var protocol extension',
+        2: 'struct self nil ->',
+    },
+    'kotlin': {
+        5: 'fun val',
+        3: 'when data println',
+        1: 'var class',
+    },
+    'bash': {
+        4: 'fi esac done then sudo grep awk sed $( ${ #!',
+        3: 'echo local export mkdir cd',
+        2: 'if in set',
+    },
+    'sql': {
+        4: 'SELECT FROM WHERE INSERT INTO UPDATE DELETE JOIN CREATE TABLE',
+        3: 'select where join GROUP ORDER BY VALUES PRIMARY KEY',
+        2: 'insert into update delete create table group order by values NULL NOT AND LEFT',
+    },
+    'html': {
+        10: '<!DOCTYPE',
+        5: '<html <head <body <meta',
+        3: '<div </div <span </span <script <link <p </p <ul <li',
+        2: 'href src',
+    },
+    'xml': {
+        10: '<?xml',
+    },
+    'css': {
+        5: '@media @keyframes @import',
+        4: 'px rem em important hover',
+        3: 'margin padding color display background border font width height flex',
+    },
+    'json': {},
+    'yaml': {
+        2: 'true false null',
+    },
+    'markdown': {
+        4: '``` ](',
+        2: '**',
+    },
+    'dockerfile': {
+        5: 'WORKDIR ENTRYPOINT EXPOSE CMD',
+        4: 'RUN COPY ENV ARG',
+    },
+    'lua': {
+        5: 'elseif ipairs pairs',
+        2: 'local then end nil function',
+    },
+}
+
+# Child dialects: their own markers also count towards the parent, and a
+# winning parent becomes the dialect when the dialect scored at least this much
+_DIALECTS: Dict[str, Tuple[str, float]] = {
+    'typescript': ('javascript', 6.0),
+    'cpp': ('c', 4.0),
+}
+
+
+def _build_index() -> Dict[str, Tuple[Tuple[str, float], ...]]:
+    index: Dict[str, List[Tuple[str, float]]] = {}
+    for language, groups in _LANGUAGE_TOKENS.items():
+        for weight, tokens in groups.items():
+            for token in tokens.split():
+                index.setdefault(token, []).append((language, float(weight)))
+    return {token: tuple(entries) for token, entries in index.items()}
+
+
+_INDEX = _build_index()
+
+
+def _looks_like_json(code: str) -> bool:
+    if not (code[0] in '{[' and code[-1] in '}]'):
+        return False
+    try:
+        json.loads(code)
+    except ValueError:
+        return False
+    return True
+
+
+def score(code: str) -> Dict[str, float]:
+    """Token scores per language (dialects not yet folded into their parent)."""
+    scores: Dict[str, float] = {}
+    for token, count in Counter(_TOKEN.findall(code[:MAX_CHARS])).items():
+        count = min(count, FREQUENCY_CAP)
+        if token.endswith(':'):
+            # A "key:" at the start of a line: YAML-ish, and the key itself may still be a keyword
+            scores['yaml'] = scores.get('yaml', 0.0) + count
+            token = token.strip(' \t-:')
+        elif token[0] in '$<' and token not in _INDEX:
+            # Unlisted $variables and tags still hint at their family
+            for language in (('php', 'bash') if token[0] == '$' else ('html', 'xml')):
+                scores[language] = scores.get(language, 0.0) + count
+            continue
+        for language, weight in _INDEX.get(token, ()):
+            scores[language] = scores.get(language, 0.0) + weight * count
+    return scores
+
+
+def detect_with_confidence(code: Optional[str]) -> Tuple[Optional[str], float]:
+    """Return (language, confidence) for a piece of code, or (None, 0.0) if unsure.
+
+    Confidence is the winner's share of the two best scores, from 0.5 (a
+    coin flip) to 1.0.
+    """
+    code = (code or '').strip()
+    if len(code) < 10:
+        return None, 0.0
+    if _looks_like_json(code):
+        return 'json', 1.0
+
+    scores = score(code)
+    dialect_scores = {dialect: scores.pop(dialect, 0.0) for dialect in _DIALECTS}
+    for dialect, (parent, _) in _DIALECTS.items():
+        scores[parent] = scores.get(parent, 0.0) + dialect_scores[dialect]
+    if not scores:
+        return None, 0.0
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    language, best = ranked[0]
+    if best < MIN_SCORE:
+        return None, 0.0
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+
+    for dialect, (parent, threshold) in _DIALECTS.items():
+        if language == parent and dialect_scores[dialect] >= threshold:
+            language = dialect
+            break
+    return language, round(best / (best + runner_up), 3)
+
+
+def detect(code: Optional[str]) -> Optional[str]:
+    """Most likely language id for a piece of code, or None if unsure."""
+    return detect_with_confidence(code)[0]
+
+
+def detect_many(codes: Iterable[Optional[str]]) -> List[Tuple[Optional[str], float]]:
+    """detect_with_confidence() for a batch, e.g. an import."""
+    return [detect_with_confidence(code) for code in codes]
@@ -0,0 +1,500 @@
+from contextvars import ContextVar
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import bisect
+import hmac
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route label used for work that doesn't belong to a matched request
+UNMATCHED_ROUTE = '<unmatched>'
+BACKGROUND_ROUTE = '<background>'
+
+# Directory where each worker process writes its metrics (set by serve.py); /metrics merges them all
+MULTIPROCESS_DIR = os.environ.get('METRICS_MULTIPROCESS_DIR')
+# Seconds between writes of a worker's metrics, so other workers' values on /metrics lag by up to this
+FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+# Bearer token scrapers must send to read /metrics; without one, only loopback clients may
+TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+def scrape_allowed(token: Optional[str], client_host: Optional[str]) -> bool:
+    """Whether a request for /metrics may see them: right token, or a local client when none is set."""
+    if TOKEN:
+        return token is not None and hmac.compare_digest(token.encode(), TOKEN.encode())
+    try:
+        return ipaddress.ip_address(client_host or '').is_loopback
+    except ValueError:
+        return False
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self, values: dict) -> List[str]:
+        raise NotImplementedError
+
+    def render(self, values: Optional[dict] = None) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(self._values if values is None else values),
+        ]
+
+    def state(self) -> list:
+        """The values as JSON for other worker processes, see Registry.write_state."""
+        return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(states: List[Tuple[int, list]]) -> dict:
+        """Add up the values of every worker's state."""
+        merged = {}
+        for _, state in states:
+            for key, value in state:
+                key = tuple(key)
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class Counter(_Metric):
+    """Monotonically increasing value per label set."""
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """Publish a total that is counted elsewhere, e.g. by a cache."""
+        self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self, values):
+        return [f'{self.name}{self._labels(key)} {_format_value(value)}' for key, value in values.items()]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down per label set.
+
+    With several workers, `multiprocess` says how their values combine: 'sum',
+    'max', or 'worker' to keep each one under a worker label. Only running
+    workers count.
+    """
+    type = 'gauge'
+
+    def __init__(self, *args, multiprocess: str = 'sum', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.multiprocess = multiprocess
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def merge(self, states):
+        merged = {}
+        for pid, state in states:
+            if not _alive(pid):
+                continue
+            for key, value in state:
+                key = tuple(key)
+                if self.multiprocess == 'worker':
+                    merged[key + (str(pid),)] = value
+                elif self.multiprocess == 'max':
+                    merged[key] = max(merged.get(key, value), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def samples(self, values):
+        return [
+            f'{self.name}{self._labels(key, (("worker", key[-1]),) if len(key) > len(self.labelnames) else ())} '
+            f'{_format_value(value)}'
+            for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Bucketed distribution of observed values per label set."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    @staticmethod
+    def merge(states):
+        merged = {}
+        for _, state in states:
+            for key, (counts, total) in state:
+                key = tuple(key)
+                if key in merged:
+                    merged[key] = [[a + b for a, b in zip(merged[key][0], counts)], merged[key][1] + total]
+                else:
+                    merged[key] = [list(counts), total]
+        return merged
+
+    def samples(self, values):
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._labels(key, (("le", _format_value(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{self._labels(key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics.
+
+    Collectors are callbacks run right before rendering, for values that are
+    cheaper to read on scrape than to track on every change (pool sizes,
+    cache totals).
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), multiprocess='sum') -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames, multiprocess=multiprocess))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """The exposition text; under serve.py, of all workers together."""
+        if MULTIPROCESS_DIR:
+            self.write_state(MULTIPROCESS_DIR)
+            states = _read_states(MULTIPROCESS_DIR)
+            lines = []
+            for metric in self._metrics:
+                lines.extend(metric.render(metric.merge(
+                    [(pid, state[metric.name]) for pid, state in states if metric.name in state]
+                )))
+            return '\n'.join(lines) + '\n'
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_state(self, directory: str):
+        """Write this process's values to <directory>/<pid>.json for the worker serving /metrics."""
+        for collector in self._collectors:
+            collector()
+        state = {metric.name: metric.state() for metric in self._metrics}
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_states(directory: str) -> List[Tuple[int, dict]]:
+    """Every worker's last written state. Exited workers' files stay, so their counts still add up."""
+    states = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                states.append((int(name[:-5]), json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return states
+
+
+class StateWriter:
+    """Writes this worker's metrics every FLUSH_SECONDS while serve.py runs several workers."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if MULTIPROCESS_DIR and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_SECONDS)
+            try:
+                registry.write_state(MULTIPROCESS_DIR)
+            except OSError:
+                logger.exception("Writing metrics for other workers failed")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Final counts, which keep adding up after this worker exits
+        registry.write_state(MULTIPROCESS_DIR)
+
+
+registry = Registry()
+state_writer = StateWriter()
+
+# ============ Metric Definitions ============
+
+HTTP_REQUESTS = registry.counter(
+    'http_requests_total', 'HTTP requests handled.', ('method', 'route', 'status'))
+HTTP_DURATION = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency.', ('method', 'route'))
+HTTP_IN_FLIGHT = registry.gauge(
+    'http_requests_in_flight', 'HTTP requests currently being handled.', ('method', 'route'))
+
+DB_QUERIES = registry.counter(
+    'db_queries_total', 'SQL statements executed, by the route that issued them.', ('route', 'operation'))
+DB_DURATION = registry.histogram(
+    'db_query_duration_seconds', 'SQL statement execution time.', ('route', 'operation'))
+
+DB_POOL_SIZE = registry.gauge('db_pool_size', 'Configured connection pool size.', ('engine',))
+DB_POOL_CHECKED_OUT = registry.gauge('db_pool_checked_out', 'Connections currently in use.', ('engine',))
+DB_POOL_CHECKED_IN = registry.gauge('db_pool_checked_in', 'Idle connections in the pool.', ('engine',))
+DB_POOL_OVERFLOW = registry.gauge('db_pool_overflow', 'Connections opened beyond the pool size.', ('engine',))
+
+# Also timed by whether this process was running a backup (see backup.py), which shows its effect on p99
+HTTP_DURATION_BY_BACKUP = registry.histogram(
+    'http_request_duration_by_backup_seconds', 'Request latency by whether a backup was running.', ('backup',))
+PASSWORD_HASH_DURATION = registry.histogram(
+    'password_hash_duration_seconds', 'Time spent hashing or verifying passwords.', ('operation',),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0))
+
+CACHE_HITS = registry.counter('cache_hits_total', 'Cache lookups served from memory.', ('cache',))
+CACHE_MISSES = registry.counter('cache_misses_total', 'Cache lookups that went to the database.', ('cache',))
+CACHE_HIT_RATIO = registry.gauge(
+    'cache_hit_ratio', 'Share of cache lookups that were hits.', ('cache',), multiprocess='worker')
+
+# ============ Request Context ============
+
+@dataclass
+class RequestStats:
+    """Per-request bookkeeping shared by the middleware and engine events."""
+    method: str
+    route: str
+    db_queries: int = 0
+    db_seconds: float = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar('current_request', default=None)
+# Backup operations running (see backup.py). Shared memory created before serve.py forks,
+# so every worker sees the backups the scheduling worker runs
+_backups_running = multiprocessing.RawValue('i', 0)
+
+
+@contextmanager
+def backup_running():
+    _backups_running.value += 1
+    try:
+        yield
+    finally:
+        _backups_running.value -= 1
+
+
+def backups_running() -> bool:
+    return _backups_running.value > 0
+
+
+def route_template(scope) -> str:
+    """Return the path template of the route matching this request, e.g. /api/snippets/{snippet_id}."""
+    app = scope.get('app')
+    for route in getattr(app, 'routes', ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, 'path', UNMATCHED_ROUTE)
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, latencies and in-flight requests per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        stats = RequestStats(method=method, route=route_template(scope))
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method=method, route=stats.route)
+        start = time.perf_counter()
+        during_backup = backups_running()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_DURATION.observe(elapsed, method=method, route=stats.route)
+            HTTP_DURATION_BY_BACKUP.observe(
+                elapsed, backup='running' if during_backup or backups_running() else 'idle')
+            HTTP_REQUESTS.inc(method=method, route=stats.route, status=status)
+            HTTP_IN_FLIGHT.dec(method=method, route=stats.route)
+            current_request.reset(token)
+
+# ============ Instrumentation ============
+
+def _operation(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+
+
+def instrument_engine(engine, name: str = 'default'):
+    """Time every statement on an (async) engine and export its pool stats."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_query_start'].pop()
+        stats = current_request.get()
+        route = stats.route if stats else BACKGROUND_ROUTE
+        operation = _operation(statement)
+        DB_QUERIES.inc(route=route, operation=operation)
+        DB_DURATION.observe(elapsed, route=route, operation=operation)
+        if stats:
+            stats.db_queries += 1
+            stats.db_seconds += elapsed
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def _handle_error(context):
+        starts = context.connection.info.get('metrics_query_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+    def collect_pool():
+        pool = sync_engine.pool
+        for gauge, attr in ((DB_POOL_SIZE, 'size'), (DB_POOL_CHECKED_OUT, 'checkedout'),
+                            (DB_POOL_CHECKED_IN, 'checkedin'), (DB_POOL_OVERFLOW, 'overflow')):
+            if hasattr(pool, attr):
+                gauge.set(getattr(pool, attr)(), engine=name)
+
+    registry.add_collector(collect_pool)
+
+
+def register_cache(name: str, cache):
+    """Export hit/miss totals of a cache object exposing `hits` and `misses` counters."""
+    def collect():
+        hits, misses = cache.hits, cache.misses
+        CACHE_HITS.set_total(hits, cache=name)
+        CACHE_MISSES.set_total(misses, cache=name)
+        CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else 0, cache=name)
+
+    registry.add_collector(collect)
@@ -0,0 +1,360 @@
+from sqlalchemy import bindparam, column, exists, insert, inspect, select, table, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+from pathlib import Path
+from typing import Dict, List, Optional
+import logging
+import re
+
+import duplicates
+import search_index
+from database import (
+    engine as default_engine, all_engines, sqlite_engine, user_engine, SHARD_COUNT, SHARD_DIR,
+    CodeBlob, Folder, OpenTab, SavedSearch, Snippet, SnippetLshBucket, SnippetRevision, SnippetSignature, Tag,
+    code_hash, decode_code, encode_code, insert_or_ignore, snippet_tags,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# Each migration inspects the schema itself and returns True when it changed
+# anything, so running them against an up-to-date database is a no-op.
+# create_all() runs first and creates brand new tables.
+
+
+def _columns(conn, table_name: str) -> set:
+    return {col['name'] for col in inspect(conn).get_columns(table_name)}
+
+
+def move_code_to_blobs(conn) -> bool:
+    """Move inline snippets.code bodies into the content-addressed code_blobs table."""
+    columns = _columns(conn, 'snippets')
+    if 'code' not in columns:
+        return False
+
+    if 'code_hash' not in columns:
+        conn.exec_driver_sql('ALTER TABLE snippets ADD COLUMN code_hash VARCHAR(64) REFERENCES code_blobs(hash)')
+    for index in Snippet.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+    snippets = table('snippets', column('id'), column('code'), column('code_hash'))
+    moved = 0
+    while True:
+        rows = conn.execute(
+            select(snippets.c.id, snippets.c.code).where(snippets.c.code_hash.is_(None)).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+
+        blobs = {}
+        links = []
+        for snippet_id, code in rows:
+            code = code or ''
+            digest = code_hash(code)
+            if digest not in blobs:
+                codec, data = encode_code(code)
+                blobs[digest] = {'hash': digest, 'codec': codec, 'data': data, 'size': len(code.encode('utf-8'))}
+            links.append({'snippet_id': snippet_id, 'digest': digest})
+
+        conn.execute(insert_or_ignore(CodeBlob, conn.dialect.name, ['hash']), list(blobs.values()))
+        conn.execute(
+            update(snippets).where(snippets.c.id == bindparam('snippet_id')).values(code_hash=bindparam('digest')),
+            links
+        )
+        moved += len(rows)
+
+    conn.exec_driver_sql('ALTER TABLE snippets DROP COLUMN code')
+    logger.info("Moved %d snippet code bodies into code_blobs", moved)
+    return True
+
+
+def build_search_index(conn) -> bool:
+    """Create and fill the trigram search index (FTS5 on SQLite, pg_trgm on Postgres)."""
+    return search_index.install(conn)
+
+
+def build_duplicate_index(conn) -> bool:
+    """Compute near-duplicate signatures for snippets that don't have one yet."""
+    indexed = 0
+    while True:
+        rows = conn.execute(
+            select(Snippet.id, Snippet.user_id, CodeBlob.codec, CodeBlob.data)
+            .outerjoin(CodeBlob, CodeBlob.hash == Snippet.code_hash)
+            .where(~exists().where(SnippetSignature.snippet_id == Snippet.id))
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        signature_rows, bucket_rows = [], []
+        for snippet_id, user_id, codec, data in rows:
+            signatures, buckets = duplicates.index_rows(
+                user_id, [(snippet_id, duplicates.signature(decode_code(codec, data)))]
+            )
+            signature_rows.extend(signatures)
+            bucket_rows.extend(buckets)
+        conn.execute(insert(SnippetSignature), signature_rows)
+        if bucket_rows:
+            conn.execute(insert(SnippetLshBucket), bucket_rows)
+        indexed += len(rows)
+    if indexed:
+        logger.info("Computed duplicate signatures for %d snippets", indexed)
+    return indexed > 0
+
+
+def add_tab_owners(conn) -> bool:
+    """Give open tabs the user_id of their snippet's owner; tabs used to be one list shared by everyone."""
+    if 'user_id' in _columns(conn, 'open_tabs'):
+        return False
+    conn.exec_driver_sql('ALTER TABLE open_tabs ADD COLUMN user_id VARCHAR REFERENCES users(id) ON DELETE CASCADE')
+    conn.exec_driver_sql(
+        'UPDATE open_tabs SET user_id = (SELECT user_id FROM snippets WHERE snippets.id = open_tabs.snippet_id)'
+    )
+    conn.exec_driver_sql('DELETE FROM open_tabs WHERE user_id IS NULL')
+    # The shared list may have had several active tabs; keep each user's first
+    conn.exec_driver_sql("""
+        UPDATE open_tabs SET is_active = 0 WHERE is_active = 1 AND EXISTS (
+            SELECT 1 FROM open_tabs earlier WHERE earlier.user_id = open_tabs.user_id
+            AND earlier.is_active = 1 AND earlier."order" < open_tabs."order"
+        )
+    """)
+    for index in OpenTab.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    return True
+
+
+MIGRATIONS = [
+    move_code_to_blobs,
+    build_search_index,
+    build_duplicate_index,
+    add_tab_owners,
+]
+
+
+def _apply(conn) -> bool:
+    changed = False
+    for migration in MIGRATIONS:
+        changed = migration(conn) or changed
+    return changed
+
+
+async def _migrate(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        changed = await conn.run_sync(_apply)
+
+    if changed and engine.dialect.name == 'sqlite':
+        await _vacuum(engine)
+
+
+async def _vacuum(engine: AsyncEngine):
+    # Give the space freed by moved data back to the filesystem
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.exec_driver_sql('VACUUM')
+        await conn.run_sync(search_index.rebuild)
+
+
+async def run_migrations(engine: Optional[AsyncEngine] = None):
+    """Bring existing databases up to the current schema.
+
+    Without an engine that is every database (see database.all_engines),
+    after which users whose rows are in the wrong shard are moved.
+    """
+    if engine is not None:
+        await _migrate(engine)
+        return
+    for target in all_engines():
+        await _migrate(target)
+    await rebalance_shards()
+
+# ============ Shard Rebalancing ============
+
+# Tables holding users' rows, parents first. Rows are copied by explicit
+# column lists, so a database with columns in another order still matches.
+_COPIED = [Folder.__table__, Snippet.__table__, SnippetSignature.__table__, SnippetLshBucket.__table__,
+           SavedSearch.__table__]
+# Copied without their autoincrement ids, which the target assigns
+_COPIED_WITHOUT_ID = [SnippetRevision.__table__, OpenTab.__table__]
+
+
+def _columns_sql(table_, skip=()) -> str:
+    return ', '.join(f'"{col.name}"' for col in table_.columns if col.name not in skip)
+
+
+def _has_table(conn, schema: str, name: str) -> bool:
+    return conn.exec_driver_sql(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?", (name,)).first() is not None
+
+
+def _copy_users(conn) -> int:
+    """Copy the rows of the users in temp.moving_users from main to the attached target database.
+
+    Only snippets the target doesn't have yet are copied along with their
+    revisions and tabs, so copying a user twice (after an interrupted move)
+    doesn't duplicate anything.
+    """
+    conn.exec_driver_sql("""
+        CREATE TEMP TABLE new_snippets AS
+        SELECT id FROM temp.moving_snippets WHERE id NOT IN (SELECT id FROM target.snippets)
+    """)
+    conn.exec_driver_sql(f"""
+        INSERT OR IGNORE INTO target.code_blobs ({_columns_sql(CodeBlob.__table__)})
+        SELECT {_columns_sql(CodeBlob.__table__)} FROM main.code_blobs WHERE hash IN (SELECT hash FROM temp.moving_blobs)
+    """)
+    # Tags are matched by name; the target may already have one under another id
+    conn.exec_driver_sql(f"""
+        INSERT OR IGNORE INTO target.tags ({_columns_sql(Tag.__table__)})
+        SELECT {_columns_sql(Tag.__table__)} FROM main.tags
+        WHERE id IN (SELECT tag_id FROM main.snippet_tags WHERE snippet_id IN (SELECT id FROM temp.new_snippets))
+    """)
+    for table_ in _COPIED:
+        if table_ is Snippet.__table__:
+            where = 'id IN (SELECT id FROM temp.new_snippets)'
+        elif 'snippet_id' in table_.columns:
+            where = 'snippet_id IN (SELECT id FROM temp.new_snippets)'
+        else:
+            where = 'user_id IN (SELECT id FROM temp.moving_users)'
+        conn.exec_driver_sql(f"""
+            INSERT OR IGNORE INTO target.{table_.name} ({_columns_sql(table_)})
+            SELECT {_columns_sql(table_)} FROM main.{table_.name} WHERE {where}
+        """)
+    for table_ in _COPIED_WITHOUT_ID:
+        conn.exec_driver_sql(f"""
+            INSERT INTO target.{table_.name} ({_columns_sql(table_, skip=('id',))})
+            SELECT {_columns_sql(table_, skip=('id',))} FROM main.{table_.name}
+            WHERE snippet_id IN (SELECT id FROM temp.new_snippets)
+        """)
+    conn.exec_driver_sql(f"""
+        INSERT OR IGNORE INTO target.{snippet_tags.name} (snippet_id, tag_id)
+        SELECT st.snippet_id, tt.id FROM main.snippet_tags st
+        JOIN main.tags t ON t.id = st.tag_id JOIN target.tags tt ON tt.name = t.name
+        WHERE st.snippet_id IN (SELECT id FROM temp.new_snippets)
+    """)
+    if _has_table(conn, 'target', search_index.INDEX_TABLE):
+        conn.exec_driver_sql(f"""
+            INSERT INTO target.{search_index.INDEX_TABLE}(rowid, title, description, code)
+            SELECT doc_id, title, description, code FROM target.{search_index.CONTENT_VIEW}
+            WHERE snippet_id IN (SELECT id FROM temp.new_snippets)
+        """)
+    return conn.exec_driver_sql('SELECT count(*) FROM temp.new_snippets').scalar()
+
+
+def _delete_users(conn):
+    """Delete the rows of the users in temp.moving_users from main."""
+    if _has_table(conn, 'main', search_index.INDEX_TABLE):
+        # External content entries are removed with the text they were built from
+        conn.exec_driver_sql(f"""
+            INSERT INTO main.{search_index.INDEX_TABLE}({search_index.INDEX_TABLE}, rowid, title, description, code)
+            SELECT 'delete', doc_id, title, description, code FROM main.{search_index.CONTENT_VIEW}
+            WHERE snippet_id IN (SELECT id FROM temp.moving_snippets)
+        """)
+    for table_ in [snippet_tags, *reversed(_COPIED_WITHOUT_ID), *reversed(_COPIED)]:
+        key = 'id' if table_ is Snippet.__table__ else 'snippet_id' if 'snippet_id' in table_.columns else None
+        if key:
+            where = f'{key} IN (SELECT id FROM temp.moving_snippets)'
+        else:
+            where = 'user_id IN (SELECT id FROM temp.moving_users)'
+        conn.exec_driver_sql(f'DELETE FROM main.{table_.name} WHERE {where}')
+    conn.exec_driver_sql("""
+        DELETE FROM main.code_blobs WHERE hash IN (SELECT hash FROM temp.moving_blobs)
+        AND NOT EXISTS (SELECT 1 FROM main.snippets s WHERE s.code_hash = code_blobs.hash)
+    """)
+
+
+def _in_transaction(conn, step):
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+    try:
+        result = step(conn)
+    except BaseException:
+        conn.exec_driver_sql('ROLLBACK')
+        raise
+    conn.exec_driver_sql('COMMIT')
+    return result
+
+
+def _move_users(conn, target: str, user_ids: List[str]) -> int:
+    """Move users' rows from this connection's database to the SQLite file target.
+
+    The copy commits before the originals are deleted, so a crash in
+    between leaves the rows in both places and the next run finishes the move.
+    """
+    conn.exec_driver_sql('ATTACH DATABASE ? AS target', (target,))
+    try:
+        conn.exec_driver_sql('CREATE TEMP TABLE moving_users (id VARCHAR PRIMARY KEY)')
+        conn.exec_driver_sql('INSERT INTO temp.moving_users VALUES ' + ', '.join('(?)' for _ in user_ids), tuple(user_ids))
+        conn.exec_driver_sql("""
+            CREATE TEMP TABLE moving_snippets AS
+            SELECT id FROM main.snippets WHERE user_id IN (SELECT id FROM temp.moving_users)
+        """)
+        conn.exec_driver_sql("""
+            CREATE TEMP TABLE moving_blobs AS
+            SELECT DISTINCT code_hash AS hash FROM main.snippets
+            WHERE id IN (SELECT id FROM temp.moving_snippets) AND code_hash IS NOT NULL
+        """)
+        copied = _in_transaction(conn, _copy_users)
+        _in_transaction(conn, _delete_users)
+        return copied
+    finally:
+        for name in ('moving_users', 'moving_snippets', 'moving_blobs', 'new_snippets'):
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp.{name}')
+        conn.exec_driver_sql('DETACH DATABASE target')
+
+
+def _stored_users(conn) -> List[str]:
+    return [row[0] for row in conn.exec_driver_sql(
+        'SELECT user_id FROM snippets WHERE user_id IS NOT NULL '
+        'UNION SELECT user_id FROM folders UNION SELECT user_id FROM saved_searches'
+    )]
+
+
+def _stray_shards() -> List[Path]:
+    """Shard files beyond SHARD_COUNT, left over from a larger count."""
+    main = Path(default_engine.url.database)
+    pattern = re.compile(re.escape(f'{main.stem}-shard-') + r'(\d+)' + re.escape(main.suffix) + '$')
+    stray = []
+    for path in SHARD_DIR.glob(f'{main.stem}-shard-*{main.suffix}'):
+        match = pattern.match(path.name)
+        if match and int(match.group(1)) >= SHARD_COUNT:
+            stray.append(path)
+    return sorted(stray)
+
+
+async def rebalance_shards():
+    """Move users stored in another database than user_engine() picks for them.
+
+    That is everybody's rows leaving the main database when sharding is
+    turned on, and some users changing shards when SQLITE_SHARDS changes
+    (or all of them returning to the main database when it is 0).
+    """
+    if default_engine.dialect.name != 'sqlite':
+        return
+    sources = list(all_engines())
+    temporary = []
+    for path in _stray_shards():
+        source = sqlite_engine(path)
+        await _migrate(source)
+        sources.append(source)
+        temporary.append(source)
+    try:
+        for source in sources:
+            async with source.connect() as conn:
+                users = await conn.run_sync(_stored_users)
+            moving: Dict[str, List[str]] = {}
+            for user_id in users:
+                target = user_engine(user_id)
+                if target is not source:
+                    moving.setdefault(target.url.database, []).append(user_id)
+            if not moving:
+                continue
+            async with source.connect() as conn:
+                conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+                for target, user_ids in moving.items():
+                    for start in range(0, len(user_ids), BATCH_SIZE):
+                        batch = user_ids[start:start + BATCH_SIZE]
+                        copied = await conn.run_sync(_move_users, target, batch)
+                        logger.info("Moved %d users (%d snippets) from %s to %s",
+                                    len(batch), copied, source.url.database, target)
+            await _vacuum(source)
+    finally:
+        for source in temporary:
+            await source.dispose()
+    for path in _stray_shards():
+        logger.warning("%s holds no users anymore and can be deleted", path)
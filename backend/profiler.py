@@ -0,0 +1,218 @@
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('PROFILE_ENABLED', '').strip().lower() in ('1', 'true', 'yes', 'on')
+# Value of the X-Profile header that asks for a profile; without it only sampling is possible
+TOKEN = os.environ.get('PROFILE_TOKEN', '').encode()
+# Fraction of requests profiled without being asked to
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# Sampled requests faster than this are discarded; header-requested ones are always kept
+MIN_DURATION_MS = float(os.environ.get('PROFILE_MIN_MS', 500))
+INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+OUTPUT_FORMAT = os.environ.get('PROFILE_FORMAT', 'speedscope')  # or 'collapsed'
+OUTPUT_DIR = Path(os.environ.get('PROFILE_DIR', Path(__file__).parent / 'profiles'))
+MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+MAX_BYTES = int(os.environ.get('PROFILE_MAX_BYTES', 50 * 1024 * 1024))
+
+PROFILE_HEADER = b'x-profile'
+
+Frame = Tuple[str, str, int]  # (function, file, first line)
+
+
+def _frame_file(filename: str) -> str:
+    """Shorten a code path to its last two components (package/module.py)."""
+    parts = Path(filename).parts
+    return '/'.join(parts[-2:])
+
+
+class ProfileSession:
+    """Stack samples collected while one request was in flight."""
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.stacks: Counter = Counter()
+        self.started = time.perf_counter()
+
+
+class Sampler:
+    """Background thread sampling the stacks of threads with an active session.
+
+    The event loop thread runs every in-flight request, so a session sees
+    everything the loop did while its request was in flight, including other
+    concurrent requests. Time spent waiting on the database shows up as the
+    loop idling in its selector.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._sessions: Set[ProfileSession] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, session: ProfileSession):
+        with self._lock:
+            self._sessions.add(session)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, session: ProfileSession):
+        """Stop sampling for a session; its stacks aren't touched after this returns."""
+        with self._lock:
+            self._sessions.discard(session)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+            if not sessions:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+
+            frames = sys._current_frames()
+            stacks: Dict[int, Tuple[Frame, ...]] = {}
+            for session in sessions:
+                if session.thread_id != own_id and session.thread_id not in stacks:
+                    stacks[session.thread_id] = self._stack(frames.get(session.thread_id))
+            del frames
+            with self._lock:
+                # Sessions stopped meanwhile may already be being written out
+                for session in sessions:
+                    if session in self._sessions and stacks.get(session.thread_id):
+                        session.stacks[stacks[session.thread_id]] += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _stack(frame) -> Tuple[Frame, ...]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, _frame_file(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+
+sampler = Sampler(INTERVAL_MS / 1000)
+
+# ============ Output ============
+
+def _collapsed(session: ProfileSession) -> str:
+    """Brendan Gregg's collapsed-stack format, as read by flamegraph.pl and speedscope."""
+    lines = []
+    for stack, count in session.stacks.items():
+        lines.append(';'.join(f'{name} ({file}:{line})' for name, file, line in stack) + f' {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def _speedscope(session: ProfileSession, name: str, duration_ms: float) -> str:
+    frame_index: Dict[Frame, int] = {}
+    samples, weights = [], []
+    for stack, count in session.stacks.items():
+        samples.append([frame_index.setdefault(frame, len(frame_index)) for frame in stack])
+        weights.append(count * INTERVAL_MS)
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'tagsnip-profiler',
+        'shared': {
+            'frames': [{'name': fn, 'file': file, 'line': line} for fn, file, line in frame_index],
+        },
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': duration_ms,
+            'samples': samples,
+            'weights': weights,
+        }],
+    })
+
+
+def _enforce_retention():
+    files = sorted(
+        (path for path in OUTPUT_DIR.iterdir() if path.is_file()),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    total = 0
+    for index, path in enumerate(files):
+        total += path.stat().st_size
+        if index >= MAX_FILES or total > MAX_BYTES:
+            path.unlink(missing_ok=True)
+
+
+def write_profile(session: ProfileSession, method: str, route: str, duration_ms: float) -> Path:
+    """Write a session to OUTPUT_DIR and trim the directory to the retention limits."""
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    name = f'{method} {route} ({duration_ms:.0f} ms)'
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', route).strip('-') or 'root'
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{method.lower()}-{slug}-{duration_ms:.0f}ms"
+    if OUTPUT_FORMAT == 'collapsed':
+        path = OUTPUT_DIR / f'{stem}.collapsed.txt'
+        path.write_text(_collapsed(session))
+    else:
+        path = OUTPUT_DIR / f'{stem}.speedscope.json'
+        path.write_text(_speedscope(session, name, duration_ms))
+    _enforce_retention()
+    return path
+
+# ============ Middleware ============
+
+class ProfilerMiddleware:
+    """Sample stacks of requests that ask for it (X-Profile: <PROFILE_TOKEN>) or are randomly picked.
+
+    Only installed when PROFILE_ENABLED is set; unselected requests pay for
+    a header scan and one random() call.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        requested = bool(TOKEN) and any(
+            key == PROFILE_HEADER and hmac.compare_digest(value, TOKEN) for key, value in scope['headers']
+        )
+        if not requested and (SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE):
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfileSession(threading.get_ident())
+        sampler.start(session)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop(session)
+            duration_ms = (time.perf_counter() - session.started) * 1000
+            if session.stacks and (requested or duration_ms >= MIN_DURATION_MS):
+                try:
+                    path = await asyncio.to_thread(
+                        write_profile, session, scope['method'], metrics.route_template(scope), duration_ms
+                    )
+                    logger.info("Wrote profile %s", path)
+                except OSError:
+                    logger.exception("Could not write profile")
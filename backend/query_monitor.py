@@ -0,0 +1,153 @@
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+import logging
+import os
+import re
+import time
+
+from sqlalchemy import event
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Log statements slower than this many milliseconds (unset = no slow query log)
+SLOW_QUERY_MS = float(os.environ['SQL_SLOW_QUERY_MS']) if os.environ.get('SQL_SLOW_QUERY_MS') else None
+# Flag requests issuing more statements than this
+STATEMENT_BUDGET = int(os.environ.get('SQL_STATEMENT_BUDGET', 30))
+# Flag requests repeating one statement template at least this many times (likely N+1)
+REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+# Add an X-Query-Summary header to every response
+DEBUG = _env_flag('DEBUG')
+
+ENABLED = SLOW_QUERY_MS is not None or DEBUG or _env_flag('SQL_MONITOR')
+
+MAX_LOGGED_STATEMENT = 500
+
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_template(statement: str) -> str:
+    """Collapse whitespace and expanded IN lists so equivalent statements compare equal."""
+    return _IN_LIST.sub('(?, ...)', _WHITESPACE.sub(' ', statement).strip())
+
+
+def parameter_shape(parameters, executemany: bool) -> str:
+    """Describe bound parameters by type only; values may hold user code and are never logged."""
+    def shape(params):
+        if isinstance(params, dict):
+            return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+        if isinstance(params, (list, tuple)):
+            return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+        return type(params).__name__
+
+    if executemany and parameters:
+        return f'[{len(parameters)} x {shape(parameters[0])}]'
+    return shape(parameters) if parameters is not None else '()'
+
+
+@dataclass
+class RequestQueries:
+    """Statements issued while handling one request."""
+    count: int = 0
+    seconds: float = 0.0
+    templates: Counter = field(default_factory=Counter)
+
+    def most_repeated(self):
+        return self.templates.most_common(1)[0] if self.templates else (None, 0)
+
+    def summary(self) -> str:
+        _, repeats = self.most_repeated()
+        return f'count={self.count}; time-ms={self.seconds * 1000:.1f}; max-repeat={repeats}'
+
+
+current_queries: ContextVar[Optional[RequestQueries]] = ContextVar('current_queries', default=None)
+
+
+def instrument_engine(engine):
+    """Log slow statements and count statements per request on an (async) engine."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_monitor_start', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_monitor_start'].pop()
+
+        queries = current_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+            queries.templates[statement_template(statement)] += 1
+
+        if SLOW_QUERY_MS is not None and elapsed * 1000 >= SLOW_QUERY_MS:
+            stats = metrics.current_request.get()
+            logger.warning(
+                "Slow query (%.1f ms) on %s: %s params=%s",
+                elapsed * 1000,
+                f'{stats.method} {stats.route}' if stats else metrics.BACKGROUND_ROUTE,
+                statement_template(statement)[:MAX_LOGGED_STATEMENT],
+                parameter_shape(parameters, executemany),
+            )
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def _handle_error(context):
+        starts = context.connection.info.get('query_monitor_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+
+class QueryMonitorMiddleware:
+    """Flag requests that issue too many or repeated statements.
+
+    In debug mode every response also carries an X-Query-Summary header with
+    the statement count, total statement time and the highest repeat count.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+
+        async def send_with_summary(message):
+            if DEBUG and message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'x-query-summary', queries.summary().encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_summary)
+        finally:
+            current_queries.reset(token)
+            self._check(scope, queries)
+
+    def _check(self, scope, queries: RequestQueries):
+        template, repeats = queries.most_repeated()
+        if queries.count <= STATEMENT_BUDGET and repeats < REPEAT_THRESHOLD:
+            return
+        logger.warning(
+            "Possible N+1 on %s %s: %d statements in %.1f ms, most repeated x%d: %s",
+            scope['method'],
+            metrics.route_template(scope),
+            queries.count,
+            queries.seconds * 1000,
+            repeats,
+            template[:MAX_LOGGED_STATEMENT] if template else '',
+        )
@@ -0,0 +1,279 @@
+from datetime import datetime, timedelta, timezone
+from difflib import SequenceMatcher
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+import json
+import os
+import zlib
+
+from database import Snippet, SnippetRevision
+
+# Every Nth revision is a full snapshot, so rebuilding any revision replays at most N - 1 deltas
+SNAPSHOT_INTERVAL = int(os.environ.get('REVISION_SNAPSHOT_INTERVAL', 20))
+# Saves within this many seconds of the latest revision's creation overwrite it instead of adding one
+COALESCE_SECONDS = int(os.environ.get('REVISION_COALESCE_SECONDS', 60))
+# Oldest revisions beyond this count are pruned whenever a new snapshot is written
+MAX_REVISIONS = int(os.environ.get('REVISION_MAX_COUNT', 200))
+# Changed old lines x changed new lines above which an edit is stored as a full
+# snapshot: diffing is quadratic in them and runs while the write turn is held
+MAX_DELTA_WORK = int(os.environ.get('REVISION_MAX_DELTA_WORK', 250000))
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    # SQLite hands back naive datetimes; everything is stored in UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+# ============ Deltas ============
+
+def make_delta(old: str, new: str) -> Optional[list]:
+    """Line-based delta turning old into new, or None if diffing would cost more than MAX_DELTA_WORK.
+
+    A delta is a list of ops: ["=", start, end] copies old lines[start:end],
+    ["+", text] inserts text. Unchanged regions cost a few bytes each. The
+    lines both versions start and end with are matched directly, so only
+    the changed middle is diffed.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    prefix = 0
+    limit = min(len(old_lines), len(new_lines))
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+    old_end, new_end = len(old_lines) - suffix, len(new_lines) - suffix
+    if (old_end - prefix) * (new_end - prefix) > MAX_DELTA_WORK:
+        return None
+
+    ops = []
+    if prefix:
+        ops.append(['=', 0, prefix])
+    matcher = SequenceMatcher(None, old_lines[prefix:old_end], new_lines[prefix:new_end], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            _copy(ops, prefix + i1, prefix + i2)
+        elif j2 > j1:
+            text = ''.join(new_lines[prefix + j1:prefix + j2])
+            if ops and ops[-1][0] == '+':
+                ops[-1][1] += text
+            else:
+                ops.append(['+', text])
+    if suffix:
+        _copy(ops, old_end, len(old_lines))
+    return ops
+
+
+def _copy(ops: list, start: int, end: int):
+    if ops and ops[-1][0] == '=' and ops[-1][2] == start:
+        ops[-1][2] = end
+    else:
+        ops.append(['=', start, end])
+
+
+def apply_delta(old: str, ops: list) -> str:
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in ops:
+        if op[0] == '=':
+            parts.extend(old_lines[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return ''.join(parts)
+
+
+def _encode_full(code: str) -> bytes:
+    return zlib.compress(code.encode('utf-8'), 6)
+
+
+def _encode_delta(ops: list) -> bytes:
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def _decode(data: bytes) -> str:
+    return zlib.decompress(data).decode('utf-8')
+
+# ============ Reading ============
+
+async def _latest(session: AsyncSession, snippet_id: str) -> Optional[SnippetRevision]:
+    result = await session.execute(
+        select(SnippetRevision)
+        .where(SnippetRevision.snippet_id == snippet_id)
+        .order_by(SnippetRevision.seq.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+async def list_revisions(session: AsyncSession, snippet_id: str) -> List[SnippetRevision]:
+    """All revisions of a snippet, newest first."""
+    result = await session.execute(
+        select(SnippetRevision)
+        .where(SnippetRevision.snippet_id == snippet_id)
+        .order_by(SnippetRevision.seq.desc())
+    )
+    return result.scalars().all()
+
+
+async def get_revision(session: AsyncSession, snippet_id: str, seq: int):
+    """Return (revision, code) for one revision, or (None, None) if it doesn't exist.
+
+    Loads the revision's snapshot and the deltas after it in one query and
+    replays them; the chain is never longer than SNAPSHOT_INTERVAL.
+    """
+    result = await session.execute(
+        select(SnippetRevision).where(SnippetRevision.snippet_id == snippet_id, SnippetRevision.seq == seq)
+    )
+    revision = result.scalar_one_or_none()
+    if revision is None:
+        return None, None
+    return revision, await _materialize(session, revision)
+
+
+async def _materialize(session: AsyncSession, revision: SnippetRevision) -> str:
+    if revision.kind == 'full':
+        return _decode(revision.data)
+    result = await session.execute(
+        select(SnippetRevision)
+        .where(
+            SnippetRevision.snippet_id == revision.snippet_id,
+            SnippetRevision.seq >= revision.base_seq,
+            SnippetRevision.seq <= revision.seq,
+        )
+        .order_by(SnippetRevision.seq)
+    )
+    code = ''
+    for step in result.scalars():
+        if step.kind == 'full':
+            code = _decode(step.data)
+        else:
+            code = apply_delta(code, json.loads(_decode(step.data)))
+    return code
+
+# ============ Writing ============
+
+def _store(revision: SnippetRevision, old_code: str, new_code: str):
+    """Set revision's data to a delta from old_code, or to a full snapshot if the delta is too costly."""
+    ops = make_delta(old_code, new_code)
+    if ops is None:
+        revision.kind, revision.base_seq, revision.data = 'full', revision.seq, _encode_full(new_code)
+    else:
+        revision.kind, revision.data = 'delta', _encode_delta(ops)
+
+
+async def record_revision(session: AsyncSession, snippet: Snippet, new_code: str):
+    """Record an edit of snippet's code, before snippet.code is overwritten.
+
+    The first edit also stores the pre-edit code as revision 1, so history
+    costs nothing for snippets that are never edited. Edits arriving within
+    COALESCE_SECONDS of the latest revision's creation replace it, which
+    keeps an autosave burst down to one revision; the window doesn't move
+    with each save, so a long session still gets one revision per window.
+    """
+    now = datetime.now(timezone.utc)
+    size = len(new_code.encode('utf-8'))
+    latest = await _latest(session, snippet.id)
+
+    if latest is None:
+        saved_at = _aware(snippet.updated_at) or now
+        session.add(SnippetRevision(
+            snippet_id=snippet.id, seq=1, kind='full', base_seq=1,
+            data=_encode_full(snippet.code), size=len(snippet.code.encode('utf-8')),
+            created_at=saved_at, updated_at=saved_at,
+        ))
+        revision = SnippetRevision(snippet_id=snippet.id, seq=2, base_seq=1, size=size, created_at=now, updated_at=now)
+        _store(revision, snippet.code, new_code)
+        session.add(revision)
+        return
+
+    if now - _aware(latest.created_at) < timedelta(seconds=COALESCE_SECONDS):
+        if latest.kind == 'full':
+            latest.data = _encode_full(new_code)
+        else:
+            previous, previous_code = await get_revision(session, snippet.id, latest.seq - 1)
+            _store(latest, previous_code, new_code)
+        latest.size = size
+        latest.updated_at = now
+        return
+
+    seq = latest.seq + 1
+    if seq - latest.base_seq >= SNAPSHOT_INTERVAL:
+        session.add(SnippetRevision(
+            snippet_id=snippet.id, seq=seq, kind='full', base_seq=seq,
+            data=_encode_full(new_code), size=size, created_at=now, updated_at=now,
+        ))
+        await session.flush()
+        await prune_revisions(session, snippet.id, keep=MAX_REVISIONS)
+    else:
+        # The latest revision holds the current code, so the delta needs no replay
+        revision = SnippetRevision(
+            snippet_id=snippet.id, seq=seq, base_seq=latest.base_seq, size=size, created_at=now, updated_at=now,
+        )
+        _store(revision, snippet.code, new_code)
+        session.add(revision)
+
+
+async def prune_revisions(
+    session: AsyncSession,
+    snippet_id: str,
+    keep: Optional[int] = None,
+    older_than: Optional[datetime] = None,
+) -> int:
+    """Delete revisions beyond the newest `keep` and/or last saved before `older_than`.
+
+    The latest revision is always kept. If the oldest surviving revision is
+    a delta it is rewritten as a full snapshot, so every remaining revision
+    can still be rebuilt. Returns the number of revisions removed.
+    """
+    result = await session.execute(
+        select(SnippetRevision.seq, SnippetRevision.updated_at)
+        .where(SnippetRevision.snippet_id == snippet_id)
+        .order_by(SnippetRevision.seq.desc())
+    )
+    rows = result.all()
+    if not rows:
+        return 0
+
+    removed = [
+        seq for index, (seq, saved_at) in enumerate(rows)
+        if index > 0 and (
+            (keep is not None and index >= keep)
+            or (older_than is not None and _aware(saved_at) < older_than)
+        )
+    ]
+    if not removed:
+        return 0
+    first_kept = max(removed) + 1
+    removed_count = sum(1 for seq, _ in rows if seq < first_kept)
+
+    result = await session.execute(
+        select(SnippetRevision).where(SnippetRevision.snippet_id == snippet_id, SnippetRevision.seq == first_kept)
+    )
+    oldest = result.scalar_one()
+    if oldest.kind != 'full':
+        old_base = oldest.base_seq
+        oldest.data = _encode_full(await _materialize(session, oldest))
+        oldest.kind = 'full'
+        oldest.base_seq = oldest.seq
+        await session.flush()
+        await session.execute(
+            update(SnippetRevision)
+            .where(
+                SnippetRevision.snippet_id == snippet_id,
+                SnippetRevision.base_seq == old_base,
+                SnippetRevision.seq > first_kept,
+            )
+            .values(base_seq=first_kept)
+        )
+
+    await session.execute(
+        delete(SnippetRevision).where(SnippetRevision.snippet_id == snippet_id, SnippetRevision.seq < first_kept)
+    )
+    return removed_count
+
+
+async def delete_revisions(session: AsyncSession, snippet_id: str):
+    await session.execute(delete(SnippetRevision).where(SnippetRevision.snippet_id == snippet_id))
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
 from datetime import datetime
 
 # ============ Auth Schemas ============
@@ -59,6 +59,22 @@ class SnippetResponse(SnippetBase):
     class Config:
         from_attributes = True
 
+# ============ Revision Schemas ============
+
+class RevisionResponse(BaseModel):
+    seq: int
+    kind: str
+    size: int
+    storedSize: int
+    createdAt: Optional[str] = None
+    updatedAt: Optional[str] = None
+
+class RevisionDetail(RevisionResponse):
+    code: str
+
+class RevisionPruneResult(BaseModel):
+    removed: int
+
 # ============ Folder Schemas ============
 
 class FolderBase(BaseModel):
@@ -101,10 +117,75 @@ class SearchQuery(BaseModel):
     query: str = ''
     tags: List[str] = Field(default_factory=list)
     language: Optional[str] = None
+    fuzzy: bool = False
+    highlight: bool = False
+    contextLines: int = Field(default=2, ge=0, le=20)
+    maxHighlights: int = Field(default=3, ge=1, le=50)
+    includeCode: bool = True
+    facets: bool = False
+
+class SearchHighlight(BaseModel):
+    field: str
+    line: int
+    offset: int
+    text: str
+    matches: List[List[int]]
+
+class SearchResult(SnippetResponse):
+    code: Optional[str] = None
+    score: Optional[float] = None
+    matchCount: Optional[int] = None
+    highlights: Optional[List[SearchHighlight]] = None
+
+class SearchFacets(BaseModel):
+    languages: Dict[str, int]
+    tags: Dict[str, int]
+    folders: Dict[str, int]
+    unfiled: int
+    favorites: int
 
 class SearchResponse(BaseModel):
-    snippets: List[SnippetResponse]
+    snippets: List[SearchResult]
     total: int
+    facets: Optional[SearchFacets] = None
+
+class SavedSearchCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=100)
+    query: SearchQuery
+
+class SavedSearchResponse(BaseModel):
+    id: str
+    name: str
+    query: SearchQuery
+    createdAt: Optional[str] = None
+
+# ============ Duplicate Schemas ============
+
+class DuplicateSnippet(BaseModel):
+    id: str
+    title: str
+    language: str
+    updatedAt: Optional[str] = None
+
+class DuplicateCluster(BaseModel):
+    similarity: float
+    snippets: List[DuplicateSnippet]
+
+class DuplicatesResponse(BaseModel):
+    clusters: List[DuplicateCluster]
+    total: int
+
+# ============ Language Detection Schemas ============
+
+class LanguageDetectRequest(BaseModel):
+    codes: List[str] = Field(max_length=1000)
+
+class LanguageDetectResult(BaseModel):
+    language: Optional[str] = None
+    confidence: float = 0.0
+
+class LanguageDetectResponse(BaseModel):
+    results: List[LanguageDetectResult]
 
 # ============ Import/Export Schemas ============
 
@@ -116,10 +197,13 @@ class ExportData(BaseModel):
 
 class ImportData(BaseModel):
     snippets: List[SnippetCreate]
+    skipDuplicates: bool = False
+    duplicateThreshold: Optional[float] = Field(default=None, ge=0, le=1)
 
 class ImportResult(BaseModel):
     imported: int
     skipped: int
+    duplicates: int = 0
     errors: List[str] = Field(default_factory=list)
 
 # ============ Tab State Schemas ============
@@ -132,6 +216,20 @@ class TabState(BaseModel):
 class TabsState(BaseModel):
     tabs: List[TabState]
 
+class TabOperation(BaseModel):
+    """One change to the open tabs.
+
+    open adds a tab at `order` (default: last) if it isn't open yet, close
+    removes it, reorder moves it to position `order`, activate makes it the
+    active tab.
+    """
+    op: Literal['open', 'close', 'reorder', 'activate']
+    snippetId: str
+    order: Optional[int] = Field(default=None, ge=0)
+
+class TabsPatch(BaseModel):
+    ops: List[TabOperation] = Field(min_length=1, max_length=100)
+
 # ============ Stats Schema ============
 
 class StatsResponse(BaseModel):
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+import asyncio
+import json
+import logging
+import os
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Memory budget for cached result sets across all users; 0 disables the cache
+MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+# Seconds to wait after a write before re-running the writer's saved searches,
+# so a burst of autosaves refreshes them once
+WARM_DELAY_SECONDS = float(os.environ.get('SEARCH_CACHE_WARM_DELAY_SECONDS', 2))
+# Saved searches allowed per user; each one is re-run after the user's writes
+MAX_SAVED_SEARCHES = int(os.environ.get('SAVED_SEARCHES_MAX_PER_USER', 50))
+
+SEARCH_CACHE_BYTES = metrics.registry.gauge('search_cache_bytes', 'Estimated memory held by cached search results.')
+SEARCH_CACHE_EVICTIONS = metrics.registry.counter(
+    'search_cache_evictions_total', 'Cached search results dropped.', ('reason',))
+
+
+def cache_key(query: str, tags: Iterable[str], language: Optional[str], fuzzy: bool) -> str:
+    """Normalized form of the parts of a search that decide which snippets match.
+
+    Matching ignores case and tag order, so neither splits the cache.
+    Presentation options (highlighting, code, facets) aren't part of it.
+    """
+    return json.dumps(
+        [query.strip().lower(), sorted({tag.lower() for tag in tags}), language or None, bool(fuzzy)],
+        separators=(',', ':')
+    )
+
+
+@dataclass
+class CachedSearch:
+    """Matching snippet ids in result order, plus what was computed alongside them."""
+    version: int
+    ids: Tuple[str, ...]
+    scores: Optional[Dict[str, float]] = None
+    facets: Optional[dict] = None
+
+    def size(self) -> int:
+        # Rough per-object costs of the tuple, dicts and id strings
+        size = 200 + 90 * len(self.ids)
+        if self.scores is not None:
+            size += 100 * len(self.scores)
+        if self.facets is not None:
+            size += 100 * sum(len(value) for value in self.facets.values() if isinstance(value, dict))
+        return size
+
+
+class SearchCache:
+    """LRU of search results per (user, normalized query), bounded by MAX_BYTES.
+
+    Entries remember the user's change feed version they were computed at;
+    any write by the user bumps it, so a lookup at a newer version is a miss
+    and the stale entry is dropped. The version must be read before the
+    search runs, so a write committing meanwhile can't be hidden.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[Tuple[str, str], CachedSearch]' = OrderedDict()
+        self._sizes: Dict[Tuple[str, str], int] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, user_id: str, key: str, version: int) -> Optional[CachedSearch]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get((user_id, key))
+        if entry is not None and entry.version != version:
+            self._remove((user_id, key))
+            SEARCH_CACHE_EVICTIONS.inc(reason='stale')
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((user_id, key))
+        self.hits += 1
+        return entry
+
+    def put(self, user_id: str, key: str, entry: CachedSearch):
+        """Store or replace an entry; call again after adding facets so its size is updated."""
+        if not self.enabled:
+            return
+        size = entry.size()
+        if size > self.max_bytes // 4:
+            # One huge result set would flush everybody else's entries
+            self._remove((user_id, key))
+            return
+        self._remove((user_id, key))
+        self._entries[(user_id, key)] = entry
+        self._sizes[(user_id, key)] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            SEARCH_CACHE_EVICTIONS.inc(reason='memory')
+        SEARCH_CACHE_BYTES.set(self.bytes)
+
+    def _remove(self, cache_key: Tuple[str, str]):
+        if self._entries.pop(cache_key, None) is not None:
+            self.bytes -= self._sizes.pop(cache_key)
+            SEARCH_CACHE_BYTES.set(self.bytes)
+
+    def users(self) -> Set[str]:
+        """Users with results in this process's cache, stale ones included."""
+        return {user_id for user_id, _ in self._entries}
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.bytes = 0
+        SEARCH_CACHE_BYTES.set(0)
+
+
+cache = SearchCache()
+
+# ============ Saved Search Warming ============
+
+class SavedSearchWarmer:
+    """Re-runs saved searches shortly after their owner writes, so they stay cached.
+
+    Listens to the change feed broker: every delivered change marks its user
+    (or, for shared changes like tag deletions, everyone) as needing a
+    refresh. One background task drains the marks after WARM_DELAY_SECONDS
+    and hands the runner those users that have results in this process's
+    cache; the cache is per worker, so each worker refreshes only the users
+    it has been serving. Everyone else's entries are already stale and are
+    recomputed on their next search.
+    """
+
+    def __init__(self):
+        self._runner: Optional[Callable[[Set[str]], Awaitable[None]]] = None
+        self._users: Set[str] = set()
+        self._everyone = False
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, runner: Callable[[Set[str]], Awaitable[None]]):
+        if not cache.enabled or self._task is not None:
+            return
+        self._runner = runner
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self, user_id: Optional[str], events: Iterable[dict] = ()):
+        if self._task is None:
+            return
+        if user_id is None:
+            self._everyone = True
+        else:
+            self._users.add(user_id)
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(WARM_DELAY_SECONDS)
+            self._wake.clear()
+            cached = cache.users()
+            users = cached if self._everyone else self._users & cached
+            self._users, self._everyone = set(), False
+            if not users:
+                continue
+            try:
+                await self._runner(users)
+            except Exception:
+                logger.exception("Refreshing saved searches failed")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+warmer = SavedSearchWarmer()
@@ -0,0 +1,477 @@
+from sqlalchemy import String, bindparam, column, event, exists, func, literal, literal_column, or_, select, table, text, union_all
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, attributes
+from bisect import bisect_right
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+import os
+import re
+
+from database import CodeBlob, Snippet, Tag, decode_code, snippet_tags
+
+logger = logging.getLogger(__name__)
+
+# Queries shorter than this can't use a trigram index and fall back to a scan
+MIN_INDEXED_LENGTH = 3
+# Fuzzy matches need at least this word similarity (0..1) to a word of the snippet
+FUZZY_THRESHOLD = float(os.environ.get('SEARCH_FUZZY_THRESHOLD', 0.5))
+# Best index candidates scored for a fuzzy query
+FUZZY_CANDIDATES = int(os.environ.get('SEARCH_FUZZY_CANDIDATES', 200))
+# Longest highlight window; longer ones (e.g. minified code) are cut around their first match
+HIGHLIGHT_MAX_CHARS = int(os.environ.get('SEARCH_HIGHLIGHT_MAX_CHARS', 400))
+
+# SQLite: FTS5 table with the trigram tokenizer. It reads its text from
+# CONTENT_VIEW (external content), so the index doesn't keep a second,
+# uncompressed copy of every code body.
+INDEX_TABLE = 'snippet_search'
+CONTENT_VIEW = 'snippet_search_content'
+# Postgres: plain table of searchable text with a pg_trgm GIN index
+DOCUMENT_TABLE = 'snippet_search'
+
+FTS5 = 'fts5'
+PG_TRGM = 'pg_trgm'
+
+search_documents = table(DOCUMENT_TABLE, column('snippet_id'), column('document'))
+search_content = table(
+    CONTENT_VIEW, column('doc_id'), column('snippet_id'), column('user_id'),
+    column('title'), column('description'), column('code'),
+)
+_snippet_rowid = literal_column('snippets.rowid')
+
+# Engine -> index kind (None: no index, search scans)
+_kinds: Dict[Engine, Optional[str]] = {}
+
+# ============ Similarity ============
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+def _word_trigrams(word: str) -> Set[str]:
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigrams(text: str) -> Set[str]:
+    """pg_trgm-style trigrams: lowercase words padded with two spaces in front and one behind."""
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        grams |= _word_trigrams(word)
+    return grams
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def word_similarity(query: str, text: str) -> float:
+    """Average over the query's words of their best similarity to a word of text.
+
+    Close to pg_trgm's word_similarity(): "usrname" scores about 0.55 against
+    code containing "username" and 1.0 when the word is present.
+    """
+    query_words = [_word_trigrams(word) for word in _WORD.findall(query.lower())]
+    if not query_words:
+        return 0.0
+    text_words = {word for word in _WORD.findall(text.lower())}
+    total = 0.0
+    for query_grams in query_words:
+        size = len(query_grams)
+        best = 0.0
+        for word in text_words:
+            # Words much shorter or longer than the query word can't clear the threshold
+            if not size / 3 <= len(word) + 2 <= size * 3:
+                continue
+            best = max(best, similarity(query_grams, _word_trigrams(word)))
+            if best == 1.0:
+                break
+        total += best
+    return total / len(query_words)
+
+# ============ Setup ============
+
+def _create_fts5(conn: Connection) -> bool:
+    """Create the FTS5 index and its content view. False if this SQLite lacks FTS5 or trigram."""
+    exists_ = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = ?", (INDEX_TABLE,)
+    ).first()
+    if exists_:
+        return False
+    conn.exec_driver_sql(f'DROP VIEW IF EXISTS {CONTENT_VIEW}')
+    conn.exec_driver_sql(f"""
+        CREATE VIEW {CONTENT_VIEW} AS
+        SELECT s.rowid AS doc_id, s.id AS snippet_id, s.user_id AS user_id,
+               s.title AS title, s.description AS description,
+               code_text(b.codec, b.data) AS code
+        FROM snippets s LEFT JOIN code_blobs b ON b.hash = s.code_hash
+    """)
+    conn.exec_driver_sql(f"""
+        CREATE VIRTUAL TABLE {INDEX_TABLE} USING fts5(
+            title, description, code,
+            tokenize = 'trigram', content = '{CONTENT_VIEW}', content_rowid = 'doc_id'
+        )
+    """)
+    conn.exec_driver_sql(f"INSERT INTO {INDEX_TABLE}({INDEX_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+def _create_pg_trgm(conn: Connection) -> bool:
+    created = not conn.exec_driver_sql(f"SELECT to_regclass('{DOCUMENT_TABLE}')").scalar()
+    if created:
+        conn.exec_driver_sql(f"""
+            CREATE TABLE {DOCUMENT_TABLE} (
+                snippet_id VARCHAR PRIMARY KEY REFERENCES snippets(id) ON DELETE CASCADE,
+                document TEXT NOT NULL
+            )
+        """)
+        rows = conn.execute(
+            select(Snippet.id, Snippet.title, Snippet.description, CodeBlob.codec, CodeBlob.data)
+            .outerjoin(CodeBlob, CodeBlob.hash == Snippet.code_hash)
+        )
+        batch = []
+        for snippet_id, title, description, codec, data in rows:
+            batch.append({'snippet_id': snippet_id, 'document': _document(title, description, decode_code(codec, data))})
+            if len(batch) >= 500:
+                conn.execute(search_documents.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(search_documents.insert(), batch)
+    try:
+        with conn.begin_nested():
+            conn.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            conn.exec_driver_sql(
+                f'CREATE INDEX IF NOT EXISTS ix_{DOCUMENT_TABLE}_trgm '
+                f'ON {DOCUMENT_TABLE} USING gin (document gin_trgm_ops)'
+            )
+    except Exception:
+        logger.warning("pg_trgm is not available; search will scan %s", DOCUMENT_TABLE)
+    return created
+
+
+def install(conn: Connection) -> bool:
+    """Create the search index if the database supports one. Returns True if anything was created."""
+    created = False
+    kind = None
+    if conn.dialect.name == 'sqlite':
+        try:
+            with conn.begin_nested():
+                created = _create_fts5(conn)
+            kind = FTS5
+        except Exception as exc:
+            logger.warning("SQLite FTS5 trigram index unavailable (%s); search will scan code", exc)
+    elif conn.dialect.name == 'postgresql':
+        created = _create_pg_trgm(conn)
+        kind = PG_TRGM
+    _kinds[conn.engine] = kind
+    return created
+
+
+def rebuild(conn: Connection):
+    """Re-read every entry of the SQLite index from its content view.
+
+    The index refers to snippets by rowid, which isn't a declared key of
+    the table, so VACUUM may renumber them; rebuild after every VACUUM.
+    """
+    if conn.dialect.name == 'sqlite' and _kind(conn) == FTS5:
+        conn.exec_driver_sql(f"INSERT INTO {INDEX_TABLE}({INDEX_TABLE}) VALUES ('rebuild')")
+
+
+def _kind(conn: Connection) -> Optional[str]:
+    engine = conn.engine
+    if engine not in _kinds:
+        if conn.dialect.name == 'sqlite':
+            found = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (INDEX_TABLE,)
+            ).first()
+            _kinds[engine] = FTS5 if found else None
+        elif conn.dialect.name == 'postgresql':
+            found = conn.exec_driver_sql(f"SELECT to_regclass('{DOCUMENT_TABLE}')").scalar()
+            _kinds[engine] = PG_TRGM if found else None
+        else:
+            _kinds[engine] = None
+    return _kinds[engine]
+
+
+def _document(title: Optional[str], description: Optional[str], code: Optional[str]) -> str:
+    return '\n'.join(part for part in (title, description, code) if part)
+
+# ============ Maintenance ============
+
+_TEXT_FIELDS = ('title', 'description', 'code_hash')
+# Session.info key holding ids of flushed snippets whose entries must be rebuilt after the flush
+_REINDEX_KEY = 'search_index_reindex'
+
+_fts_remove = text(
+    f"INSERT INTO {INDEX_TABLE}({INDEX_TABLE}, rowid, title, description, code) "
+    f"SELECT 'delete', doc_id, title, description, code FROM {CONTENT_VIEW} WHERE snippet_id IN :ids"
+).bindparams(bindparam('ids', expanding=True))
+_fts_add = text(
+    f"INSERT INTO {INDEX_TABLE}(rowid, title, description, code) "
+    f"SELECT doc_id, title, description, code FROM {CONTENT_VIEW} WHERE snippet_id IN :ids"
+).bindparams(bindparam('ids', expanding=True))
+
+
+def _text_changed(snippet: Snippet) -> bool:
+    return any(attributes.get_history(snippet, name).has_changes() for name in _TEXT_FIELDS)
+
+
+@event.listens_for(Session, 'before_flush')
+def _unindex_changed_snippets(session, flush_context, instances):
+    """Remove entries of snippets about to change or disappear, while their old text is still readable."""
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Snippet)]
+    changed = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, Snippet) and obj not in session.deleted and _text_changed(obj)
+    ]
+    session.info[_REINDEX_KEY] = changed
+    if not deleted and not changed:
+        return
+    conn = session.connection()
+    kind = _kind(conn)
+    if kind == FTS5:
+        # External content entries are removed by handing FTS5 the exact text they were built from
+        conn.execute(_fts_remove, {'ids': deleted + changed})
+    elif kind == PG_TRGM:
+        conn.execute(search_documents.delete().where(search_documents.c.snippet_id.in_(deleted + changed)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _index_flushed_snippets(session, flush_context):
+    """Index snippets inserted by this flush and re-index the ones whose text changed."""
+    changed = session.info.pop(_REINDEX_KEY, [])
+    new = [obj for obj in session.new if isinstance(obj, Snippet)]
+    if not changed and not new:
+        return
+    conn = session.connection()
+    kind = _kind(conn)
+    if kind == FTS5:
+        conn.execute(_fts_add, {'ids': [obj.id for obj in new] + changed})
+    elif kind == PG_TRGM:
+        snippets = new + [session.get(Snippet, snippet_id) for snippet_id in changed]
+        conn.execute(search_documents.insert(), [
+            {'snippet_id': obj.id, 'document': _document(obj.title, obj.description, obj.code)}
+            for obj in snippets if obj is not None
+        ])
+
+# ============ Queries ============
+
+def _phrase(term: str) -> str:
+    """Quote term as an FTS5 phrase; with the trigram tokenizer that is a substring match."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+async def index_kind(session: AsyncSession) -> Optional[str]:
+    conn = await session.connection()
+    return await conn.run_sync(_kind)
+
+
+async def substring_condition(session: AsyncSession, term: str):
+    """WHERE clause for snippets whose title, description or code contains term, ignoring case."""
+    kind = await index_kind(session)
+    if kind == FTS5 and len(term) >= MIN_INDEXED_LENGTH:
+        matches = (
+            select(literal_column('rowid'))
+            .select_from(table(INDEX_TABLE))
+            .where(literal_column(INDEX_TABLE).op('MATCH')(_phrase(term)))
+        )
+        return _snippet_rowid.in_(matches)
+
+    pattern = f"%{term.lower()}%"
+    if kind == PG_TRGM:
+        return Snippet.id.in_(
+            select(search_documents.c.snippet_id).where(search_documents.c.document.ilike(pattern))
+        )
+    # No usable index: decode and scan every code body (code_text() is SQLite's)
+    return or_(
+        Snippet.title.ilike(pattern),
+        Snippet.description.ilike(pattern),
+        exists().where(
+            CodeBlob.hash == Snippet.code_hash,
+            func.code_text(CodeBlob.codec, CodeBlob.data).ilike(pattern)
+        )
+    )
+
+
+async def _fts5_candidates(session: AsyncSession, user_id: str, term: str) -> List[Tuple[str, str]]:
+    grams = {word[i:i + 3] for word in _WORD.findall(term.lower()) for i in range(len(word) - 2)}
+    if not grams:
+        return await _scan_candidates(session, user_id)
+    # Rank on the index first and only decode the code of the best candidates
+    result = await session.execute(
+        text(
+            f"SELECT s.id FROM {INDEX_TABLE} f JOIN snippets s ON s.rowid = f.rowid "
+            f"WHERE {INDEX_TABLE} MATCH :match AND s.user_id = :user_id "
+            f"ORDER BY bm25({INDEX_TABLE}) LIMIT :limit"
+        ),
+        {'match': ' OR '.join(_phrase(gram) for gram in sorted(grams)), 'user_id': user_id, 'limit': FUZZY_CANDIDATES}
+    )
+    ids = result.scalars().all()
+    if not ids:
+        return []
+    result = await session.execute(
+        select(search_content.c.snippet_id, search_content.c.title, search_content.c.description, search_content.c.code)
+        .where(search_content.c.snippet_id.in_(ids))
+    )
+    return [(snippet_id, _document(title, description, code)) for snippet_id, title, description, code in result]
+
+
+async def _scan_candidates(session: AsyncSession, user_id: str) -> List[Tuple[str, str]]:
+    result = await session.execute(
+        select(Snippet.id, Snippet.title, Snippet.description, CodeBlob.codec, CodeBlob.data)
+        .outerjoin(CodeBlob, CodeBlob.hash == Snippet.code_hash)
+        .where(Snippet.user_id == user_id)
+    )
+    return [
+        (snippet_id, _document(title, description, decode_code(codec, data)))
+        for snippet_id, title, description, codec, data in result
+    ]
+
+
+def _score_candidates(term: str, candidates: List[Tuple[str, str]]) -> Dict[str, float]:
+    scores = {}
+    for snippet_id, document in candidates:
+        score = word_similarity(term, document)
+        if score >= FUZZY_THRESHOLD:
+            scores[snippet_id] = round(score, 3)
+    return scores
+
+
+async def fuzzy_scores(session: AsyncSession, user_id: str, term: str) -> Dict[str, float]:
+    """Typo-tolerant match: snippet id -> word similarity for the user's snippets above FUZZY_THRESHOLD."""
+    kind = await index_kind(session)
+    if kind == PG_TRGM:
+        score = func.word_similarity(term, search_documents.c.document)
+        result = await session.execute(
+            select(search_documents.c.snippet_id, score)
+            .join(Snippet, Snippet.id == search_documents.c.snippet_id)
+            .where(Snippet.user_id == user_id, literal(term).op('<%')(search_documents.c.document))
+            .order_by(score.desc())
+            .limit(FUZZY_CANDIDATES)
+        )
+        return {snippet_id: round(value, 3) for snippet_id, value in result if value >= FUZZY_THRESHOLD}
+
+    if kind == FTS5:
+        candidates = await _fts5_candidates(session, user_id, term)
+    else:
+        candidates = await _scan_candidates(session, user_id)
+    return await asyncio.to_thread(_score_candidates, term, candidates)
+
+# ============ Facets ============
+
+async def facet_counts(session: AsyncSession, conditions: list) -> dict:
+    """Language, tag, folder and favorite counts over the snippets matching conditions.
+
+    One statement: the matches are a CTE and each facet is a GROUP BY over
+    it, so nothing but the counts leaves the database.
+    """
+    matched = select(Snippet.id, Snippet.language, Snippet.folder_id, Snippet.is_favorite).where(*conditions).cte('matched')
+    count = func.count().label('count')
+    facets = union_all(
+        select(literal('language').label('facet'), matched.c.language.label('value'), count)
+        .group_by(matched.c.language),
+        select(literal('tag'), Tag.name, count)
+        .select_from(matched.join(snippet_tags, snippet_tags.c.snippet_id == matched.c.id).join(Tag, Tag.id == snippet_tags.c.tag_id))
+        .group_by(Tag.name),
+        select(literal('folder'), matched.c.folder_id, count)
+        .group_by(matched.c.folder_id),
+        select(literal('favorite'), literal(None, String), count)
+        .where(matched.c.is_favorite.is_(True)),
+    )
+    counts = {'languages': {}, 'tags': {}, 'folders': {}, 'unfiled': 0, 'favorites': 0}
+    for facet, value, number in await session.execute(facets):
+        if facet == 'favorite':
+            counts['favorites'] = number
+        elif facet == 'folder' and value is None:
+            counts['unfiled'] = number
+        else:
+            counts[facet + 's'][value] = number
+    return counts
+
+# ============ Highlighting ============
+
+def find_matches(text: Optional[str], term: str, fuzzy: bool = False) -> List[Tuple[int, int]]:
+    """[start, end) character spans of term in text.
+
+    Plain search matches case-insensitive substrings, like the index does;
+    fuzzy search matches the words similar to one of term's words.
+    """
+    if not text or not term:
+        return []
+    if not fuzzy:
+        return [match.span() for match in re.finditer(re.escape(term), text, re.IGNORECASE)]
+    query_words = [_word_trigrams(word) for word in _WORD.findall(term.lower())]
+    verdicts: Dict[str, bool] = {}
+    spans = []
+    for match in _WORD.finditer(text):
+        word = match.group().lower()
+        hit = verdicts.get(word)
+        if hit is None:
+            grams = _word_trigrams(word)
+            hit = verdicts[word] = any(similarity(query, grams) >= FUZZY_THRESHOLD for query in query_words)
+        if hit:
+            spans.append(match.span())
+    return spans
+
+
+def context_windows(text: str, spans: List[Tuple[int, int]], context_lines: int = 2, limit: int = 3) -> List[dict]:
+    """Group match spans into up to `limit` windows of whole lines, context_lines around each match.
+
+    A window has the 1-based number of its first line, the character offset
+    of its text within `text`, the text, and its matches as [start, end)
+    offsets into the window text.
+    """
+    line_starts = [0] + [match.end() for match in re.finditer('\n', text)]
+    end_of_text = len(text)
+    if len(line_starts) > 1 and line_starts[-1] == end_of_text:
+        # A trailing newline doesn't start another line
+        line_starts.pop()
+        end_of_text -= 1
+    windows = []
+    for start, end in spans:
+        first = bisect_right(line_starts, start) - 1
+        last = bisect_right(line_starts, max(start, end - 1)) - 1
+        low, high = max(0, first - context_lines), min(len(line_starts) - 1, last + context_lines)
+        if windows and low <= windows[-1][1] + 1:
+            windows[-1][1] = max(windows[-1][1], high)
+            windows[-1][2].append((start, end))
+        elif len(windows) < limit:
+            windows.append([low, high, [(start, end)]])
+        else:
+            break
+
+    result = []
+    for low, high, matches in windows:
+        offset = line_starts[low]
+        stop = line_starts[high + 1] - 1 if high + 1 < len(line_starts) else end_of_text
+        if stop - offset > HIGHLIGHT_MAX_CHARS:
+            offset = max(offset, min(matches[0][0] - HIGHLIGHT_MAX_CHARS // 4, stop - HIGHLIGHT_MAX_CHARS))
+            stop = offset + HIGHLIGHT_MAX_CHARS
+        result.append({
+            'line': low + 1 + text.count('\n', line_starts[low], offset),
+            'offset': offset,
+            'text': text[offset:stop],
+            'matches': [[start - offset, min(end, stop) - offset] for start, end in matches if offset <= start < stop],
+        })
+    return result
+
+
+def highlight(
+    term: str,
+    fields: Dict[str, Optional[str]],
+    fuzzy: bool = False,
+    context_lines: int = 2,
+    limit: int = 3,
+) -> Tuple[List[dict], int]:
+    """Context windows around term's matches in each field, and the total number of matches."""
+    windows = []
+    total = 0
+    for field, text in fields.items():
+        spans = find_matches(text, term, fuzzy)
+        total += len(spans)
+        if spans:
+            windows.extend({'field': field, **window} for window in context_windows(text, spans, context_lines, limit))
+    return windows, total
@@ -0,0 +1,330 @@
+"""Production entry point: runs the API in several worker processes.
+
+Run from the backend directory:
+
+    python serve.py                      # one worker per CPU (at most 8)
+    python serve.py --workers 4 --port 8000
+
+The master process migrates the database once, imports the app (so workers
+share its memory copy-on-write), binds the port and forks the workers, which
+all accept from that socket. It restarts workers that die and forwards
+SIGTERM/SIGINT for a graceful shutdown: open change feed streams are ended,
+in-flight requests get --graceful-timeout seconds, then the app's shutdown
+handlers stop background tasks and close the database.
+
+Workers keep per-process caches and change feeds; the master relays every
+published change event between them over a Unix socket, so caches are
+invalidated and streams are notified whichever worker handled the write.
+On SQLite, workers share the file in WAL mode and writes queue on its lock
+(see SQLITE_BUSY_TIMEOUT_MS), one queue per shard with SQLITE_SHARDS. uvloop and httptools are used when installed.
+"""
+import argparse
+import asyncio
+import importlib.util
+import logging
+import os
+import selectors
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+
+logger = logging.getLogger('uvicorn.error')
+
+# Upper bound for the default worker count; SQLite allows one writer at a time anyway
+MAX_DEFAULT_WORKERS = 8
+# Extra seconds granted after the graceful timeout before workers are killed
+KILL_GRACE_SECONDS = 5
+# Bytes buffered for a worker that stops reading relayed events before it is cut off
+RELAY_MAX_BUFFER = 64 * 1024 * 1024
+# Worker exit status when the app fails to start; respawning would fail again
+STARTUP_FAILURE = 3
+
+
+def default_workers() -> int:
+    return max(1, min(os.cpu_count() or 1, MAX_DEFAULT_WORKERS))
+
+
+def module_available(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY') or default_workers()),
+                        help='Worker processes (default: $WEB_CONCURRENCY, else the CPU count up to '
+                             f'{MAX_DEFAULT_WORKERS})')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('GRACEFUL_TIMEOUT_SECONDS', 30)),
+                        help='Seconds in-flight requests get to finish on shutdown')
+    parser.add_argument('--loop', choices=['auto', 'uvloop', 'asyncio'], default='auto')
+    parser.add_argument('--http', choices=['auto', 'httptools', 'h11'], default='auto')
+    parser.add_argument('--log-level', default=os.environ.get('LOG_LEVEL', 'info'))
+    parser.add_argument('--no-access-log', dest='access_log', action='store_false')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.loop == 'auto':
+        args.loop = 'uvloop' if module_available('uvloop') else 'asyncio'
+    if args.http == 'auto':
+        args.http = 'httptools' if module_available('httptools') else 'h11'
+    return args
+
+# ============ Workers ============
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that ends change feed streams before draining connections.
+
+    Streams stay open for minutes, so without this every shutdown would
+    wait out the whole graceful timeout.
+    """
+
+    async def shutdown(self, sockets: Optional[List[socket.socket]] = None):
+        import events
+        events.broker.close()
+        await super().shutdown(sockets)
+
+
+def make_config(app, args) -> uvicorn.Config:
+    return uvicorn.Config(
+        app, host=args.host, port=args.port, loop=args.loop, http=args.http, lifespan='on',
+        log_level=args.log_level, access_log=args.access_log, timeout_graceful_shutdown=args.graceful_timeout,
+    )
+
+
+def run_worker(config: uvicorn.Config, sock: Optional[socket.socket] = None) -> int:
+    server = DrainingServer(config)
+    server.run(sockets=[sock] if sock is not None else None)
+    return 0 if server.started else STARTUP_FAILURE
+
+# ============ Event Relay ============
+
+class EventRelay:
+    """Unix socket in the master that copies each line a worker sends to every other worker.
+
+    Lines are the JSON messages of events.RelayBroker. It runs inside the
+    master's supervision loop (no thread, so forking stays safe) and never
+    blocks on a slow worker: output is buffered and sent as it drains.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self._incoming: Dict[socket.socket, bytearray] = {}
+        self._outgoing: Dict[socket.socket, bytearray] = {}
+
+    def poll(self, timeout: float):
+        for key, mask in self.selector.select(timeout):
+            conn = key.fileobj
+            if conn is self.listener:
+                self._accept()
+                continue
+            if mask & selectors.EVENT_READ:
+                self._read(conn)
+            if mask & selectors.EVENT_WRITE and conn in self._outgoing:
+                self._flush(conn)
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self._incoming[conn] = bytearray()
+        self._outgoing[conn] = bytearray()
+        self.selector.register(conn, selectors.EVENT_READ)
+
+    def _read(self, conn: socket.socket):
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buffer = self._incoming[conn]
+        buffer += data
+        end = buffer.rfind(b'\n') + 1
+        if end:
+            lines = bytes(buffer[:end])
+            del buffer[:end]
+            for other in list(self._outgoing):
+                if other is not conn:
+                    self._outgoing[other] += lines
+                    self._flush(other)
+
+    def _flush(self, conn: socket.socket):
+        buffer = self._outgoing[conn]
+        if buffer:
+            try:
+                del buffer[:conn.send(buffer)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._drop(conn)
+                return
+        if len(buffer) > RELAY_MAX_BUFFER:
+            logger.error("Worker stopped reading relayed events; disconnecting it")
+            self._drop(conn)
+            return
+        self.selector.modify(conn, selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0))
+
+    def _drop(self, conn: socket.socket):
+        self.selector.unregister(conn)
+        self._incoming.pop(conn, None)
+        self._outgoing.pop(conn, None)
+        conn.close()
+
+    def close(self):
+        """Close every socket; also called in forked workers, which must not keep the master's."""
+        for conn in list(self._outgoing):
+            self._drop(conn)
+        self.selector.close()
+        self.listener.close()
+
+# ============ Supervisor ============
+
+class Supervisor:
+    """Forks the workers, restarts the ones that die and shuts them all down on a signal."""
+
+    def __init__(self, config: uvicorn.Config, sock: socket.socket, relay: EventRelay, workers: int,
+                 graceful_timeout: int):
+        self.config = config
+        self.sock = sock
+        self.relay = relay
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.children: Dict[int, float] = {}
+        self.stopping = False
+        self.exit_code = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        code = 1
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            self.relay.close()
+            code = run_worker(self.config, self.sock)
+        except BaseException:
+            logger.exception("Worker %s crashed", os.getpid())
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def handle_signal(self, sig, frame):
+        if not self.stopping:
+            logger.info("Received %s, stopping workers", signal.Signals(sig).name)
+        self.stopping = True
+
+    def run(self) -> int:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_signal)
+        for _ in range(self.workers):
+            self.spawn()
+
+        deadline = None
+        while self.children:
+            if self.stopping and deadline is None:
+                for pid in self.children:
+                    self._kill(pid, signal.SIGTERM)
+                deadline = time.monotonic() + self.graceful_timeout + KILL_GRACE_SECONDS
+            elif deadline is not None and time.monotonic() > deadline:
+                logger.error("Killing %d workers still running after the graceful timeout", len(self.children))
+                for pid in self.children:
+                    self._kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+
+            self.relay.poll(0.2)
+            self._reap()
+        return self.exit_code
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if not pid:
+                return
+            if pid not in self.children:
+                continue
+            del self.children[pid]
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                continue
+            if code == STARTUP_FAILURE:
+                logger.error("Worker %s failed to start; shutting down", pid)
+                self.exit_code = 1
+                self.stopping = True
+                continue
+            logger.warning("Worker %s exited with status %s; starting a new one", pid, code)
+            self.spawn()
+
+    @staticmethod
+    def _kill(pid: int, sig: int):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+async def prepare_database():
+    """Create and migrate the schema once, before any worker opens the database."""
+    from database import dispose_engines, init_db
+    from migrations import run_migrations
+    await init_db()
+    await run_migrations()
+    await dispose_engines()
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        print('Several workers need os.fork(); starting one', file=sys.stderr)
+        args.workers = 1
+
+    if args.workers == 1:
+        import server
+        return run_worker(make_config(server.app, args))
+
+    relay_dir = tempfile.mkdtemp(prefix='tagsnip-')
+    relay = EventRelay(os.path.join(relay_dir, 'events.sock'))
+    try:
+        # Inherited by the workers; events and metrics read these at import
+        os.environ['EVENTS_RELAY_SOCKET'] = relay.path
+        os.environ['METRICS_MULTIPROCESS_DIR'] = os.path.join(relay_dir, 'metrics')
+        os.mkdir(os.environ['METRICS_MULTIPROCESS_DIR'])
+        os.environ['RUN_MIGRATIONS_ON_STARTUP'] = 'false'
+        os.environ['SERVE_WORKERS'] = str(args.workers)
+        import server
+
+        config = make_config(server.app, args)
+        asyncio.run(prepare_database())
+        sock = config.bind_socket()
+        logger.info("Starting %d workers (loop: %s, http: %s)", args.workers, args.loop, args.http)
+        return Supervisor(config, sock, relay, args.workers, args.graceful_timeout).run()
+    finally:
+        relay.close()
+        shutil.rmtree(relay_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Header
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Header, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
+import asyncio
 import os
 import logging
+import re
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 import uuid
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import select, delete, func, or_, update
+from sqlalchemy import select, delete, func, update, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from passlib.context import CryptContext
 import jwt
 
-from database import init_db, get_session, Snippet, Tag, OpenTab, User, Folder, snippet_tags
+from database import (
+    init_db, get_session, async_session, engine, shard_engines, all_engines, dispose_engines,
+    bind_user, session_engine, user_engine, for_each_shard, writing,
+)
+from database import Snippet, Tag, OpenTab, User, Folder, SavedSearch, snippet_tags
+from migrations import run_migrations
+from tag_cache import tag_cache, normalize_tag_names
+import admission
+import backup
+import duplicates
+import events
+import language_detection
+import metrics
+import revisions
+import search_cache
+import search_index
+import query_monitor
+import profiler
 from schemas import (
     SnippetCreate, SnippetUpdate, SnippetResponse,
+    RevisionResponse, RevisionDetail, RevisionPruneResult,
     TagCreate, TagResponse,
-    SearchQuery, SearchResponse,
+    SearchQuery, SearchResponse, SavedSearchCreate, SavedSearchResponse,
+    DuplicatesResponse,
+    LanguageDetectRequest, LanguageDetectResponse, LanguageDetectResult,
     ExportData, ImportData, ImportResult,
-    TabState, TabsState,
+    TabState, TabsState, TabOperation, TabsPatch,
     StatsResponse,
     UserCreate, UserLogin, UserResponse, Token, RefreshToken,
     FolderCreate, FolderUpdate, FolderResponse
@@ -39,6 +62,7 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 REFRESH_TOKEN_EXPIRE_DAYS = 30
+STREAM_TICKET_EXPIRE_SECONDS = 60  # only has to last until the EventSource connects
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -55,9 +79,27 @@ async def root_health_check():
     """Root health check for deployment platforms."""
     return {"status": "healthy", "version": "2.0.0"}
 
+# Prometheus metrics (no /api prefix, like /health)
+metrics.instrument_engine(engine)
+for index, shard in enumerate(shard_engines):
+    metrics.instrument_engine(shard, f'shard{index}')
+metrics.register_cache('tags', tag_cache)
+metrics.register_cache('search', search_cache.cache)
+
 # Security
 security = HTTPBearer(auto_error=False)
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Expose request, database, password hashing and cache metrics to scrapers allowed to see them."""
+    token = credentials.credentials if credentials else None
+    if not metrics.scrape_allowed(token, request.client.host if request.client else None):
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -65,13 +107,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class RedactCredentials(logging.Filter):
+    """Blank out credentials in the query strings of access log lines."""
+    PATTERN = re.compile(r'([?&](?:ticket|token)=)[^&\s]*')
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        # uvicorn logs (client, method, path with query, http version, status)
+        if isinstance(record.args, tuple) and len(record.args) > 2 and isinstance(record.args[2], str):
+            args = list(record.args)
+            args[2] = self.PATTERN.sub(r'\1[redacted]', args[2])
+            record.args = tuple(args)
+        return True
+
+logging.getLogger("uvicorn.access").addFilter(RedactCredentials())
+
 # ============ Auth Utilities ============
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    with metrics.PASSWORD_HASH_DURATION.time(operation='hash'):
+        return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    with metrics.PASSWORD_HASH_DURATION.time(operation='verify'):
+        return pwd_context.verify(plain_password, hashed_password)
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -85,6 +143,10 @@ def create_refresh_token(data: dict) -> str:
     to_encode.update({"exp": expire, "type": "refresh"})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def create_stream_ticket(user_id: str) -> str:
+    expire = datetime.now(timezone.utc) + timedelta(seconds=STREAM_TICKET_EXPIRE_SECONDS)
+    return jwt.encode({"sub": user_id, "exp": expire, "type": "stream"}, SECRET_KEY, algorithm=ALGORITHM)
+
 def decode_token(token: str) -> Optional[dict]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -110,7 +172,10 @@ async def get_current_user(
         return None
     
     result = await session.execute(select(User).where(User.id == user_id))
-    return result.scalar_one_or_none()
+    user = result.scalar_one_or_none()
+    if user:
+        bind_user(session, user.id)
+    return user
 
 async def require_auth(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -125,13 +190,63 @@ async def require_auth(
     
     return user
 
+def admission_client(scope) -> str:
+    """Who a request counts against in admission control: its token's user, else its address."""
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            scheme, _, token = value.decode('latin-1').partition(' ')
+            payload = decode_token(token) if scheme.lower() == 'bearer' else None
+            if payload and payload.get("type") == "access" and payload.get("sub"):
+                return f"user:{payload['sub']}"
+            break
+    client = scope.get('client')
+    return f"addr:{client[0]}" if client else "addr:unknown"
+
+async def write_transaction(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Route dependency of endpoints that write: holds the write turn of the
+    caller's database (see database.writing) until the endpoint returns.
+
+    The caller is taken from the token alone, before authentication, so
+    anonymous requests (like signup) queue on the main database.
+    """
+    payload = decode_token(credentials.credentials) if credentials else None
+    user_id = payload.get("sub") if payload and payload.get("type") == "access" else None
+    async with writing(user_engine(user_id)):
+        yield
+
+# ============ Tag Utilities ============
+
+async def add_snippet_tags(session: AsyncSession, snippet_id: str, tag_ids):
+    """Insert snippet_tags rows linking a snippet to the given tag ids."""
+    rows = [{'snippet_id': snippet_id, 'tag_id': tag_id} for tag_id in tag_ids]
+    if rows:
+        await session.execute(insert(snippet_tags), rows)
+
 # ============ Startup Event ============
 
 @app.on_event("startup")
 async def startup():
-    await init_db()
+    # serve.py migrates once before starting its worker processes
+    if os.environ.get('RUN_MIGRATIONS_ON_STARTUP', 'true').lower() != 'false':
+        await init_db()
+        await run_migrations()
+    await for_each_shard(tag_cache.warm)
+    await events.broker.start()
+    events.broker.add_listener(tag_cache.forget_deleted)
+    events.broker.add_listener(search_cache.warmer.notify)
+    search_cache.warmer.start(warm_saved_searches)
+    backup.scheduler.start()
+    metrics.state_writer.start()
     logger.info("Database initialized")
 
+@app.on_event("shutdown")
+async def shutdown():
+    events.broker.close()
+    await search_cache.warmer.stop()
+    await backup.scheduler.stop()
+    await metrics.state_writer.stop()
+    await dispose_engines()
+
 # ============ Health Check ============
 
 @api_router.get("/")
@@ -150,20 +265,24 @@ async def signup(
     session: AsyncSession = Depends(get_session)
 ):
     """Register a new user."""
-    # Check if username exists
-    result = await session.execute(select(User).where(User.username == data.username.lower()))
-    if result.scalar_one_or_none():
-        raise HTTPException(status_code=400, detail="Username already exists")
+    # Hash off the event loop and before taking the write turn, which other workers wait on
+    hashed_password = await asyncio.to_thread(hash_password, data.password)
     
-    # Create user
-    user = User(
-        id=str(uuid.uuid4()),
-        username=data.username.lower(),
-        hashed_password=hash_password(data.password),
-        created_at=datetime.now(timezone.utc)
-    )
-    session.add(user)
-    await session.commit()
+    async with writing(engine):
+        # Check if username exists
+        result = await session.execute(select(User).where(User.username == data.username.lower()))
+        if result.scalar_one_or_none():
+            raise HTTPException(status_code=400, detail="Username already exists")
+        
+        # Create user
+        user = User(
+            id=str(uuid.uuid4()),
+            username=data.username.lower(),
+            hashed_password=hashed_password,
+            created_at=datetime.now(timezone.utc)
+        )
+        session.add(user)
+        await session.commit()
     await session.refresh(user)
     
     return UserResponse(
@@ -181,7 +300,7 @@ async def login(
     result = await session.execute(select(User).where(User.username == data.username.lower()))
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(data.password, user.hashed_password):
+    if not user or not await asyncio.to_thread(verify_password, data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     access_token = create_access_token({"sub": user.id})
@@ -259,7 +378,7 @@ async def get_snippet(
         raise HTTPException(status_code=404, detail="Snippet not found")
     return snippet.to_dict()
 
-@api_router.post("/snippets", response_model=SnippetResponse, status_code=201)
+@api_router.post("/snippets", response_model=SnippetResponse, status_code=201, dependencies=[Depends(write_transaction)])
 async def create_snippet(
     data: SnippetCreate,
     session: AsyncSession = Depends(get_session),
@@ -279,12 +398,16 @@ async def create_snippet(
         if folder:
             folder_id = folder.id
     
+    language = data.language
+    if 'language' not in data.model_fields_set:
+        language = language_detection.detect(data.code) or language
+    
     snippet = Snippet(
         id=snippet_id,
         title=data.title,
         description=data.description,
         code=data.code,
-        language=data.language,
+        language=language,
         user_id=user.id,
         folder_id=folder_id,
         is_favorite=data.isFavorite,
@@ -292,26 +415,22 @@ async def create_snippet(
         updated_at=now
     )
     
+    session.add(snippet)
+    
     # Handle tags
     if data.tags:
-        for tag_name in data.tags:
-            tag_name = tag_name.strip().lower()
-            if not tag_name:
-                continue
-            result = await session.execute(select(Tag).where(Tag.name == tag_name))
-            tag = result.scalar_one_or_none()
-            if not tag:
-                tag = Tag(id=str(uuid.uuid4()), name=tag_name)
-                session.add(tag)
-            snippet.tags.append(tag)
+        tag_ids = await tag_cache.resolve(session, data.tags)
+        await session.flush()
+        await add_snippet_tags(session, snippet_id, tag_ids.values())
     
-    session.add(snippet)
+    await duplicates.index_snippet(session, snippet)
+    events.emit(session, user.id, 'snippet', 'upsert', snippet_id)
     await session.commit()
     await session.refresh(snippet)
     
     return snippet.to_dict()
 
-@api_router.put("/snippets/{snippet_id}", response_model=SnippetResponse)
+@api_router.put("/snippets/{snippet_id}", response_model=SnippetResponse, dependencies=[Depends(write_transaction)])
 async def update_snippet(
     snippet_id: str,
     data: SnippetUpdate,
@@ -333,7 +452,12 @@ async def update_snippet(
     if data.description is not None:
         snippet.description = data.description
     if data.code is not None:
+        code_changed = data.code != snippet.code
+        if code_changed:
+            await revisions.record_revision(session, snippet, data.code)
         snippet.code = data.code
+        if code_changed:
+            await duplicates.index_snippet(session, snippet)
     if data.language is not None:
         snippet.language = data.language
     if data.isFavorite is not None:
@@ -353,25 +477,34 @@ async def update_snippet(
     
     snippet.updated_at = datetime.now(timezone.utc)
     
+    # Only touch snippet_tags when the tag set actually changed
+    tags_changed = False
     if data.tags is not None:
-        snippet.tags = []
-        for tag_name in data.tags:
-            tag_name = tag_name.strip().lower()
-            if not tag_name:
-                continue
-            result = await session.execute(select(Tag).where(Tag.name == tag_name))
-            tag = result.scalar_one_or_none()
-            if not tag:
-                tag = Tag(id=str(uuid.uuid4()), name=tag_name)
-                session.add(tag)
-            snippet.tags.append(tag)
+        current = {tag.name: tag.id for tag in snippet.tags}
+        wanted = normalize_tag_names(data.tags)
+        if set(wanted) != set(current):
+            removed_ids = [tag_id for name, tag_id in current.items() if name not in wanted]
+            if removed_ids:
+                await session.execute(
+                    delete(snippet_tags).where(
+                        snippet_tags.c.snippet_id == snippet.id,
+                        snippet_tags.c.tag_id.in_(removed_ids)
+                    )
+                )
+            added = [name for name in wanted if name not in current]
+            if added:
+                tag_ids = await tag_cache.resolve(session, added)
+                await add_snippet_tags(session, snippet.id, tag_ids.values())
+            tags_changed = True
     
+    events.emit(session, user.id, 'snippet', 'upsert', snippet.id)
     await session.commit()
-    await session.refresh(snippet)
+    if tags_changed:
+        await session.refresh(snippet, attribute_names=['tags'])
     
     return snippet.to_dict()
 
-@api_router.delete("/snippets/{snippet_id}")
+@api_router.delete("/snippets/{snippet_id}", dependencies=[Depends(write_transaction)])
 async def delete_snippet(
     snippet_id: str,
     session: AsyncSession = Depends(get_session),
@@ -385,12 +518,16 @@ async def delete_snippet(
     if not snippet:
         raise HTTPException(status_code=404, detail="Snippet not found")
     
+    await revisions.delete_revisions(session, snippet_id)
+    await duplicates.delete_index(session, [snippet_id])
+    await session.execute(delete(OpenTab).where(OpenTab.user_id == user.id, OpenTab.snippet_id == snippet_id))
     await session.delete(snippet)
+    events.emit(session, user.id, 'snippet', 'delete', snippet_id)
     await session.commit()
     
     return {"message": "Snippet deleted", "id": snippet_id}
 
-@api_router.post("/snippets/{snippet_id}/favorite")
+@api_router.post("/snippets/{snippet_id}/favorite", dependencies=[Depends(write_transaction)])
 async def toggle_favorite(
     snippet_id: str,
     session: AsyncSession = Depends(get_session),
@@ -407,11 +544,65 @@ async def toggle_favorite(
         raise HTTPException(status_code=404, detail="Snippet not found")
     
     snippet.is_favorite = not snippet.is_favorite
+    events.emit(session, user.id, 'snippet', 'upsert', snippet.id)
     await session.commit()
     await session.refresh(snippet)
     
     return snippet.to_dict()
 
+# ============ Revisions ============
+
+async def get_owned_snippet_id(session: AsyncSession, snippet_id: str, user: User) -> str:
+    result = await session.execute(
+        select(Snippet.id).where(Snippet.id == snippet_id, Snippet.user_id == user.id)
+    )
+    if result.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Snippet not found")
+    return snippet_id
+
+@api_router.get("/snippets/{snippet_id}/revisions", response_model=List[RevisionResponse])
+async def get_revisions(
+    snippet_id: str,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """List a snippet's code revisions, newest first."""
+    await get_owned_snippet_id(session, snippet_id, user)
+    return [r.to_dict() for r in await revisions.list_revisions(session, snippet_id)]
+
+@api_router.get("/snippets/{snippet_id}/revisions/{seq}", response_model=RevisionDetail)
+async def get_revision(
+    snippet_id: str,
+    seq: int,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Get the code of a snippet as of one revision."""
+    await get_owned_snippet_id(session, snippet_id, user)
+    revision, code = await revisions.get_revision(session, snippet_id, seq)
+    if revision is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    return {**revision.to_dict(), 'code': code}
+
+@api_router.delete("/snippets/{snippet_id}/revisions", response_model=RevisionPruneResult, dependencies=[Depends(write_transaction)])
+async def prune_revisions(
+    snippet_id: str,
+    keep: Optional[int] = Query(None, ge=1, description="Keep at most this many recent revisions"),
+    older_than_days: Optional[int] = Query(None, ge=0, description="Remove revisions older than this"),
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Prune a snippet's revision history by count and/or age. The latest revision is always kept."""
+    await get_owned_snippet_id(session, snippet_id, user)
+    if keep is None and older_than_days is None:
+        raise HTTPException(status_code=400, detail="Specify keep and/or older_than_days")
+    older_than = None
+    if older_than_days is not None:
+        older_than = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    removed = await revisions.prune_revisions(session, snippet_id, keep=keep, older_than=older_than)
+    await session.commit()
+    return RevisionPruneResult(removed=removed)
+
 # ============ Folders ============
 
 @api_router.get("/folders", response_model=List[FolderResponse])
@@ -446,7 +637,7 @@ async def get_folder(
         raise HTTPException(status_code=404, detail="Folder not found")
     return folder.to_dict()
 
-@api_router.post("/folders", response_model=FolderResponse, status_code=201)
+@api_router.post("/folders", response_model=FolderResponse, status_code=201, dependencies=[Depends(write_transaction)])
 async def create_folder(
     data: FolderCreate,
     session: AsyncSession = Depends(get_session),
@@ -461,12 +652,13 @@ async def create_folder(
         created_at=datetime.now(timezone.utc)
     )
     session.add(folder)
+    events.emit(session, user.id, 'folder', 'upsert', folder.id)
     await session.commit()
     await session.refresh(folder)
     
     return folder.to_dict()
 
-@api_router.put("/folders/{folder_id}", response_model=FolderResponse)
+@api_router.put("/folders/{folder_id}", response_model=FolderResponse, dependencies=[Depends(write_transaction)])
 async def update_folder(
     folder_id: str,
     data: FolderUpdate,
@@ -488,12 +680,13 @@ async def update_folder(
     if data.color is not None:
         folder.color = data.color
     
+    events.emit(session, user.id, 'folder', 'upsert', folder.id)
     await session.commit()
     await session.refresh(folder)
     
     return folder.to_dict()
 
-@api_router.delete("/folders/{folder_id}")
+@api_router.delete("/folders/{folder_id}", dependencies=[Depends(write_transaction)])
 async def delete_folder(
     folder_id: str,
     session: AsyncSession = Depends(get_session),
@@ -513,6 +706,7 @@ async def delete_folder(
     )
     
     await session.delete(folder)
+    events.emit(session, user.id, 'folder', 'delete', folder_id)
     await session.commit()
     
     return {"message": "Folder deleted", "id": folder_id}
@@ -546,7 +740,7 @@ async def get_tags(
         for t in tag_counts.values()
     ]
 
-@api_router.post("/tags", response_model=TagResponse, status_code=201)
+@api_router.post("/tags", response_model=TagResponse, status_code=201, dependencies=[Depends(write_transaction)])
 async def create_tag(
     data: TagCreate,
     session: AsyncSession = Depends(get_session),
@@ -562,12 +756,14 @@ async def create_tag(
     
     tag = Tag(id=str(uuid.uuid4()), name=tag_name)
     session.add(tag)
+    events.emit(session, user.id, 'tag', 'upsert', tag.id)
     await session.commit()
     await session.refresh(tag)
+    tag_cache.add(session, tag.name, tag.id)
     
     return tag.to_dict()
 
-@api_router.delete("/tags/{tag_id}")
+@api_router.delete("/tags/{tag_id}", dependencies=[Depends(write_transaction)])
 async def delete_tag(
     tag_id: str,
     session: AsyncSession = Depends(get_session),
@@ -580,12 +776,91 @@ async def delete_tag(
         raise HTTPException(status_code=404, detail="Tag not found")
     
     await session.delete(tag)
+    # Tags are shared, so every user's feed hears about the deletion
+    events.emit(session, None, 'tag', 'delete', tag_id)
     await session.commit()
+    tag_cache.discard(session, [tag.name])
     
     return {"message": "Tag deleted", "id": tag_id}
 
 # ============ Search ============
 
+async def search_conditions(
+    session: AsyncSession,
+    user_id: str,
+    query: SearchQuery,
+    scores: Optional[dict] = None
+):
+    """WHERE conditions selecting the user's snippets that match query, and fuzzy scores if any."""
+    conditions = [Snippet.user_id == user_id]
+    
+    if query.query:
+        if query.fuzzy:
+            if scores is None:
+                scores = await search_index.fuzzy_scores(session, user_id, query.query)
+            conditions.append(Snippet.id.in_(list(scores)))
+        else:
+            conditions.append(await search_index.substring_condition(session, query.query))
+    
+    if query.language:
+        conditions.append(Snippet.language == query.language)
+    
+    for tag_name in {t.lower() for t in query.tags}:
+        conditions.append(Snippet.tags.any(Tag.name == tag_name))
+    
+    return conditions, scores
+
+async def load_snippets(session: AsyncSession, snippet_ids) -> List[Snippet]:
+    """Snippets by id, in the given order; ids that no longer exist are skipped."""
+    ids = list(snippet_ids)
+    found = {}
+    for start in range(0, len(ids), 500):
+        result = await session.execute(
+            select(Snippet).options(selectinload(Snippet.tags)).where(Snippet.id.in_(ids[start:start + 500]))
+        )
+        found.update((s.id, s) for s in result.scalars())
+    return [found[snippet_id] for snippet_id in ids if snippet_id in found]
+
+async def run_search(session: AsyncSession, user_id: str, query: SearchQuery, load: bool = True):
+    """Return (cached search, snippets) for query, reusing cached results while the user hasn't written.
+    
+    With load=False only the cache is filled and no snippets are returned. The
+    cache is bypassed while the change feed misses other workers' writes.
+    """
+    key = search_cache.cache_key(query.query, query.tags, query.language, query.fuzzy)
+    # Read the version before searching: a write committing meanwhile then makes this entry stale
+    version = events.broker.version(user_id)
+    use_cache = events.broker.in_sync
+    entry = search_cache.cache.get(user_id, key, version) if use_cache else None
+    conditions = None
+    snippets = []
+    changed = entry is None
+    
+    if entry is None:
+        conditions, scores = await search_conditions(session, user_id, query)
+        stmt = select(Snippet).options(selectinload(Snippet.tags)) if load else select(Snippet.id)
+        result = await session.execute(stmt.where(*conditions).order_by(Snippet.updated_at.desc()))
+        rows = result.scalars().all()
+        if scores is not None:
+            # Best matches first; equal scores keep the most recently updated first
+            rows = sorted(rows, key=lambda row: scores[row.id if load else row], reverse=True)
+        snippets = rows if load else []
+        entry = search_cache.CachedSearch(
+            version=version, ids=tuple(row.id if load else row for row in rows), scores=scores
+        )
+    elif load:
+        snippets = await load_snippets(session, entry.ids)
+    
+    if query.facets and entry.facets is None:
+        if conditions is None:
+            conditions, _ = await search_conditions(session, user_id, query, entry.scores)
+        entry.facets = await search_index.facet_counts(session, conditions)
+        changed = True
+    
+    if changed and use_cache:
+        search_cache.cache.put(user_id, key, entry)
+    return entry, snippets
+
 @api_router.post("/search", response_model=SearchResponse)
 async def search_snippets(
     query: SearchQuery,
@@ -593,34 +868,28 @@ async def search_snippets(
     user: User = Depends(require_auth)
 ):
     """Search snippets for current user."""
-    stmt = select(Snippet).options(selectinload(Snippet.tags)).where(Snippet.user_id == user.id)
+    entry, snippets = await run_search(session, user.id, query)
+    scores = entry.scores
     
-    if query.query:
-        search_term = f"%{query.query.lower()}%"
-        stmt = stmt.where(
-            or_(
-                Snippet.title.ilike(search_term),
-                Snippet.code.ilike(search_term),
-                Snippet.description.ilike(search_term)
-            )
-        )
+    results = [s.to_dict() for s in snippets]
+    for result in results:
+        result['score'] = scores.get(result['id']) if scores is not None else None
     
-    if query.language:
-        stmt = stmt.where(Snippet.language == query.language)
+    if query.highlight and query.query:
+        def add_highlights():
+            for result in results:
+                fields = {name: result[name] for name in ('title', 'description', 'code')}
+                result['highlights'], result['matchCount'] = search_index.highlight(
+                    query.query, fields, query.fuzzy, query.contextLines, query.maxHighlights
+                )
+        await run_in_threadpool(add_highlights)
     
-    result = await session.execute(stmt.order_by(Snippet.updated_at.desc()))
-    snippets = result.scalars().all()
-    
-    if query.tags:
-        query_tags = [t.lower() for t in query.tags]
-        snippets = [
-            s for s in snippets
-            if all(tag in [t.name for t in s.tags] for tag in query_tags)
-        ]
+    if not query.includeCode:
+        for result in results:
+            result['code'] = None
     
     return SearchResponse(
-        snippets=[s.to_dict() for s in snippets],
-        total=len(snippets)
+        snippets=results, total=len(snippets), facets=entry.facets if query.facets else None
     )
 
 @api_router.get("/search")
@@ -628,14 +897,155 @@ async def search_snippets_get(
     q: str = Query('', description="Search query"),
     tags: str = Query('', description="Comma-separated tag names"),
     language: str = Query('', description="Filter by language"),
+    fuzzy: bool = Query(False, description="Tolerate typos in the query"),
+    highlight: bool = Query(False, description="Include context windows around matches"),
+    context: int = Query(2, ge=0, le=20, description="Lines of context around each match"),
+    max_highlights: int = Query(3, ge=1, le=50, description="Windows per field"),
+    include_code: bool = Query(True, description="Include each snippet's full code"),
+    facets: bool = Query(False, description="Include language, tag, folder and favorite counts"),
     session: AsyncSession = Depends(get_session),
     user: User = Depends(require_auth)
 ):
     """Search snippets (GET method)."""
     tag_list = [t.strip() for t in tags.split(',') if t.strip()] if tags else []
-    query = SearchQuery(query=q, tags=tag_list, language=language if language else None)
+    query = SearchQuery(
+        query=q, tags=tag_list, language=language if language else None, fuzzy=fuzzy,
+        highlight=highlight, contextLines=context, maxHighlights=max_highlights, includeCode=include_code,
+        facets=facets
+    )
     return await search_snippets(query, session, user)
 
+# ============ Saved Searches ============
+
+async def get_saved_search(session: AsyncSession, saved_id: str, user_id: str) -> SavedSearch:
+    result = await session.execute(
+        select(SavedSearch).where(SavedSearch.id == saved_id, SavedSearch.user_id == user_id)
+    )
+    saved = result.scalar_one_or_none()
+    if saved is None:
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    return saved
+
+@api_router.get("/saved-searches", response_model=List[SavedSearchResponse])
+async def list_saved_searches(
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Get the current user's saved searches."""
+    result = await session.execute(
+        select(SavedSearch).where(SavedSearch.user_id == user.id).order_by(SavedSearch.name)
+    )
+    return [s.to_dict() for s in result.scalars().all()]
+
+@api_router.post("/saved-searches", response_model=SavedSearchResponse, dependencies=[Depends(write_transaction)])
+async def create_saved_search(
+    data: SavedSearchCreate,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Save a search; its results are kept cached and refreshed after each write."""
+    count = await session.scalar(
+        select(func.count(SavedSearch.id)).where(SavedSearch.user_id == user.id)
+    )
+    if count >= search_cache.MAX_SAVED_SEARCHES:
+        raise HTTPException(
+            status_code=400, detail=f"At most {search_cache.MAX_SAVED_SEARCHES} saved searches allowed"
+        )
+    
+    saved = SavedSearch(
+        id=str(uuid.uuid4()),
+        user_id=user.id,
+        name=data.name,
+        query=data.query.model_dump_json(),
+        created_at=datetime.now(timezone.utc)
+    )
+    session.add(saved)
+    await session.commit()
+    await run_search(session, user.id, data.query, load=False)
+    
+    return saved.to_dict()
+
+@api_router.delete("/saved-searches/{saved_id}", dependencies=[Depends(write_transaction)])
+async def delete_saved_search(
+    saved_id: str,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Delete a saved search."""
+    saved = await get_saved_search(session, saved_id, user.id)
+    await session.delete(saved)
+    await session.commit()
+    
+    return {"message": "Saved search deleted", "id": saved_id}
+
+@api_router.get("/saved-searches/{saved_id}/results", response_model=SearchResponse)
+async def run_saved_search(
+    saved_id: str,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Run a saved search."""
+    saved = await get_saved_search(session, saved_id, user.id)
+    return await search_snippets(SearchQuery.model_validate_json(saved.query), session, user)
+
+async def warm_saved_searches(user_ids: set):
+    """Re-run saved searches of the given users so they are cached at their latest version."""
+    async def warm(session: AsyncSession):
+        result = await session.execute(
+            select(SavedSearch.user_id, SavedSearch.query).where(SavedSearch.user_id.in_(list(user_ids)))
+        )
+        for user_id, query in result.all():
+            await run_search(session, user_id, SearchQuery.model_validate_json(query), load=False)
+
+    await for_each_shard(warm)
+
+# ============ Duplicates ============
+
+@api_router.get("/duplicates", response_model=DuplicatesResponse)
+async def list_duplicates(
+    threshold: float = Query(duplicates.THRESHOLD, ge=0.3, le=1, description="Minimum similarity"),
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Clusters of near-duplicate snippets, largest first."""
+    clusters = await duplicates.find_clusters(session, user.id, threshold)
+    ids = {snippet_id for members, _ in clusters for snippet_id in members}
+    snippets = {}
+    if ids:
+        result = await session.execute(
+            select(Snippet.id, Snippet.title, Snippet.language, Snippet.updated_at).where(Snippet.id.in_(list(ids)))
+        )
+        snippets = {
+            row.id: {
+                'id': row.id,
+                'title': row.title,
+                'language': row.language,
+                'updatedAt': row.updated_at.isoformat() if row.updated_at else None,
+            }
+            for row in result
+        }
+    response = []
+    for members, similarity in clusters:
+        entries = sorted((snippets[m] for m in members if m in snippets), key=lambda s: s['updatedAt'] or '', reverse=True)
+        if len(entries) > 1:
+            response.append({'similarity': round(similarity, 3), 'snippets': entries})
+    response.sort(key=lambda c: (len(c['snippets']), c['similarity']), reverse=True)
+    return DuplicatesResponse(clusters=response, total=len(response))
+
+# ============ Language Detection ============
+
+@api_router.post("/languages/detect", response_model=LanguageDetectResponse)
+async def detect_languages(
+    data: LanguageDetectRequest,
+    user: User = Depends(require_auth)
+):
+    """Guess the language of up to 1000 pieces of code. Unsure guesses come back as null."""
+    detected = await run_in_threadpool(language_detection.detect_many, data.codes)
+    return LanguageDetectResponse(results=[
+        LanguageDetectResult(language=language, confidence=confidence)
+        for language, confidence in detected
+    ])
+
 # ============ Import/Export ============
 
 @api_router.get("/export")
@@ -666,7 +1076,7 @@ async def export_all(
     
     return export_data
 
-@api_router.post("/import", response_model=ImportResult)
+@api_router.post("/import", response_model=ImportResult, dependencies=[Depends(write_transaction)])
 async def import_snippets(
     data: ImportData,
     session: AsyncSession = Depends(get_session),
@@ -675,9 +1085,40 @@ async def import_snippets(
     """Import snippets for current user."""
     imported = 0
     skipped = 0
+    duplicate_count = 0
     errors = []
     
-    for snippet_data in data.snippets:
+    # Resolve every tag used by the import in one batch
+    tag_ids = await tag_cache.resolve(
+        session, [name for snippet_data in data.snippets for name in snippet_data.tags]
+    )
+    tag_rows = []
+    
+    # Detect languages the export didn't record, off the event loop
+    undetected = [s for s in data.snippets if 'language' not in s.model_fields_set]
+    detected = await run_in_threadpool(
+        language_detection.detect_many, [s.code for s in undetected]
+    )
+    languages = {id(s): language for s, (language, _) in zip(undetected, detected)}
+    
+    signatures = await run_in_threadpool(
+        lambda: [duplicates.signature(s.code) for s in data.snippets]
+    )
+    duplicate_filter = None
+    if data.skipDuplicates:
+        duplicate_filter = duplicates.DuplicateFilter(
+            data.duplicateThreshold if data.duplicateThreshold is not None else duplicates.THRESHOLD
+        )
+        await duplicate_filter.load(session, user.id, signatures)
+    indexed = []
+    
+    for snippet_data, signature in zip(data.snippets, signatures):
+        if duplicate_filter is not None:
+            if duplicate_filter.is_duplicate(signature):
+                duplicate_count += 1
+                skipped += 1
+                continue
+            duplicate_filter.add(signature)
         try:
             snippet_id = str(uuid.uuid4())
             now = datetime.now(timezone.utc)
@@ -687,45 +1128,66 @@ async def import_snippets(
                 title=snippet_data.title,
                 description=snippet_data.description,
                 code=snippet_data.code,
-                language=snippet_data.language,
+                language=languages.get(id(snippet_data)) or snippet_data.language,
                 user_id=user.id,
                 created_at=now,
                 updated_at=now
             )
             
-            for tag_name in snippet_data.tags:
-                tag_name = tag_name.strip().lower()
-                if not tag_name:
-                    continue
-                result = await session.execute(select(Tag).where(Tag.name == tag_name))
-                tag = result.scalar_one_or_none()
-                if not tag:
-                    tag = Tag(id=str(uuid.uuid4()), name=tag_name)
-                    session.add(tag)
-                snippet.tags.append(tag)
-            
             session.add(snippet)
+            indexed.append((snippet_id, signature))
+            events.emit(session, user.id, 'snippet', 'upsert', snippet_id)
+            tag_rows.extend(
+                (snippet_id, tag_ids[name]) for name in normalize_tag_names(snippet_data.tags)
+            )
             imported += 1
         except Exception as e:
             errors.append(f"Error importing '{snippet_data.title}': {str(e)}")
             skipped += 1
     
+    await session.flush()
+    if tag_rows:
+        await session.execute(
+            insert(snippet_tags),
+            [{'snippet_id': snippet_id, 'tag_id': tag_id} for snippet_id, tag_id in tag_rows]
+        )
+    await duplicates.write_signatures(session, user.id, indexed)
     await session.commit()
     
-    return ImportResult(imported=imported, skipped=skipped, errors=errors)
+    return ImportResult(imported=imported, skipped=skipped, duplicates=duplicate_count, errors=errors)
 
 # ============ Tab State ============
 
-@api_router.get("/tabs", response_model=TabsState)
-async def get_tabs(
-    session: AsyncSession = Depends(get_session),
-    user: User = Depends(require_auth)
-):
-    """Get current tab state."""
+async def _load_tabs(session: AsyncSession, user_id: str) -> List[OpenTab]:
+    result = await session.execute(
+        select(OpenTab).where(OpenTab.user_id == user_id).order_by(OpenTab.order, OpenTab.id)
+    )
+    return list(result.scalars().all())
+
+
+async def _check_snippets_owned(session: AsyncSession, user_id: str, snippet_ids: Set[str]):
+    if not snippet_ids:
+        return
     result = await session.execute(
-        select(OpenTab).order_by(OpenTab.order)
+        select(func.count(Snippet.id)).where(Snippet.user_id == user_id, Snippet.id.in_(snippet_ids))
     )
-    tabs = result.scalars().all()
+    if result.scalar() != len(snippet_ids):
+        raise HTTPException(status_code=404, detail="Snippet not found")
+
+
+def _store_tab_positions(session: AsyncSession, tabs: List[OpenTab], active_id: Optional[str]):
+    """Number tabs by list position and mark the active one, touching only rows that change."""
+    for position, tab in enumerate(tabs):
+        if tab.id is None:
+            session.add(tab)
+        if tab.order != position:
+            tab.order = position
+        is_active = 1 if tab.snippet_id == active_id else 0
+        if tab.is_active != is_active:
+            tab.is_active = is_active
+
+
+def _tabs_state(tabs: List[OpenTab]) -> TabsState:
     return TabsState(
         tabs=[TabState(
             snippetId=t.snippet_id,
@@ -734,26 +1196,86 @@ async def get_tabs(
         ) for t in tabs]
     )
 
-@api_router.put("/tabs")
+@api_router.get("/tabs", response_model=TabsState)
+async def get_tabs(
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Get the user's open tabs in order."""
+    return _tabs_state(await _load_tabs(session, user.id))
+
+@api_router.put("/tabs", dependencies=[Depends(write_transaction)])
 async def save_tabs(
     data: TabsState,
     session: AsyncSession = Depends(get_session),
     user: User = Depends(require_auth)
 ):
-    """Save tab state."""
-    await session.execute(delete(OpenTab))
-    
-    for tab in data.tabs:
-        open_tab = OpenTab(
-            snippet_id=tab.snippetId,
-            order=tab.order,
-            is_active=1 if tab.isActive else 0
-        )
-        session.add(open_tab)
+    """Replace the user's tab state, writing only the rows that differ from what is stored."""
+    stored: Dict[str, OpenTab] = {}
+    for tab in await _load_tabs(session, user.id):
+        if tab.snippet_id in stored:
+            await session.delete(tab)
+        else:
+            stored[tab.snippet_id] = tab
+
+    wanted: Dict[str, TabState] = {}
+    for tab in sorted(data.tabs, key=lambda t: t.order):
+        wanted.setdefault(tab.snippetId, tab)
+    await _check_snippets_owned(session, user.id, wanted.keys() - stored.keys())
+
+    tabs = [stored.pop(snippet_id, None) or OpenTab(user_id=user.id, snippet_id=snippet_id) for snippet_id in wanted]
+    for tab in stored.values():
+        await session.delete(tab)
+    _store_tab_positions(session, tabs, next((t.snippetId for t in wanted.values() if t.isActive), None))
     
     await session.commit()
     return {"message": "Tabs saved"}
 
+@api_router.patch("/tabs", response_model=TabsState, dependencies=[Depends(write_transaction)])
+async def update_tabs(
+    data: TabsPatch,
+    session: AsyncSession = Depends(get_session),
+    user: User = Depends(require_auth)
+):
+    """Apply tab operations in order and return the resulting tab state.
+
+    Opening an open tab, or closing, moving or activating one that isn't
+    open, does nothing, so a retried or overtaken request is harmless.
+    Closing the active tab leaves no tab active.
+    """
+    tabs = await _load_tabs(session, user.id)
+    active_id = next((t.snippet_id for t in tabs if t.is_active), None)
+    closed: List[OpenTab] = []
+    await _check_snippets_owned(
+        session, user.id, {op.snippetId for op in data.ops if op.op == 'open'} - {t.snippet_id for t in tabs}
+    )
+
+    for op in data.ops:
+        index = next((i for i, t in enumerate(tabs) if t.snippet_id == op.snippetId), None)
+        position = len(tabs) if op.order is None else op.order
+        if op.op == 'open':
+            if index is None:
+                tabs.insert(position, OpenTab(user_id=user.id, snippet_id=op.snippetId))
+        elif op.op == 'close':
+            if index is not None:
+                closed.append(tabs.pop(index))
+                if active_id == op.snippetId:
+                    active_id = None
+        elif index is None:
+            continue
+        elif op.op == 'reorder':
+            tabs.insert(position, tabs.pop(index))
+        else:
+            active_id = op.snippetId
+
+    for tab in closed:
+        if tab.id is not None:
+            await session.delete(tab)
+    _store_tab_positions(session, tabs, active_id)
+    
+    await session.commit()
+    return _tabs_state(tabs)
+
 # ============ Stats ============
 
 @api_router.get("/stats", response_model=StatsResponse)
@@ -799,46 +1321,99 @@ async def get_stats(
 # ============ Cleanup orphaned tags ============
 
 @api_router.post("/tags/cleanup")
-async def cleanup_tags(
-    session: AsyncSession = Depends(get_session),
-    user: User = Depends(require_auth)
-):
+async def cleanup_tags(user: User = Depends(require_auth)):
     """Remove tags with no associated snippets."""
-    result = await session.execute(
-        select(Tag).options(selectinload(Tag.snippets))
-    )
-    tags = result.scalars().all()
-    
-    removed = 0
-    for tag in tags:
-        if not tag.snippets:
-            await session.delete(tag)
-            removed += 1
+    async def cleanup(session: AsyncSession) -> int:
+        # Every shard has its own tags, so each one is cleaned under its own write turn
+        async with writing(session_engine(session)):
+            result = await session.execute(
+                select(Tag).options(selectinload(Tag.snippets))
+            )
+            tags = result.scalars().all()
+            
+            removed = []
+            for tag in tags:
+                if not tag.snippets:
+                    await session.delete(tag)
+                    # Other workers drop the id from their tag caches; big batches collapse into a resync
+                    events.emit(session, None, 'tag', 'delete', tag.id)
+                    removed.append(tag.name)
+            
+            await session.commit()
+        tag_cache.discard(session, removed)
+        return len(removed)
     
-    await session.commit()
+    removed = sum(await for_each_shard(cleanup))
     return {"message": f"Removed {removed} orphaned tags"}
 
+# ============ Change Feed ============
+
+@api_router.post("/events/ticket")
+async def create_event_ticket(user: User = Depends(require_auth)):
+    """Issue a short-lived ticket that opens the change feed.
+
+    EventSource can't send headers, so the ticket travels in the URL, where
+    access and proxy logs keep it; it is only good for /events and only for a minute.
+    """
+    return {"ticket": create_stream_ticket(user.id), "expiresIn": STREAM_TICKET_EXPIRE_SECONDS}
+
+@api_router.get("/events")
+async def change_feed(
+    ticket: Optional[str] = Query(None, description="Ticket from POST /events/ticket, for EventSource clients that can't send headers"),
+    client_id: Optional[str] = Query(None, alias="clientId", max_length=64),
+    last_event_id: Optional[str] = Header(None),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Stream snippet, folder and tag changes of the current user as Server-Sent Events."""
+    if credentials:
+        payload, kind = decode_token(credentials.credentials), "access"
+    else:
+        payload, kind = decode_token(ticket or ''), "stream"
+    if not payload or payload.get("type") != kind or not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    
+    # A stream stays open for minutes, so don't hold a request-scoped session
+    async with async_session() as session:
+        result = await session.execute(select(User.id).where(User.id == payload["sub"]))
+        user_id = result.scalar_one_or_none()
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    if events.broker.open_streams(user_id) >= events.MAX_STREAMS_PER_USER:
+        raise HTTPException(status_code=429, detail="Too many open event streams")
+    
+    return StreamingResponse(
+        events.stream(user_id, client_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ============ Public Share Endpoint (No Auth Required) ============
 
 @api_router.get("/share/{snippet_id}")
-async def get_shared_snippet(
-    snippet_id: str,
-    session: AsyncSession = Depends(get_session)
-):
+async def get_shared_snippet(snippet_id: str):
     """Get a snippet for public sharing (read-only, no auth required)."""
-    result = await session.execute(
-        select(Snippet)
-        .options(selectinload(Snippet.tags))
-        .where(Snippet.id == snippet_id)
-    )
-    snippet = result.scalar_one_or_none()
-    if not snippet:
+    async def find(session: AsyncSession) -> Optional[dict]:
+        result = await session.execute(
+            select(Snippet)
+            .options(selectinload(Snippet.tags))
+            .where(Snippet.id == snippet_id)
+        )
+        snippet = result.scalar_one_or_none()
+        return snippet.to_dict() if snippet else None
+    
+    # The link doesn't say whose snippet it is, so every shard is asked
+    found = [snippet for snippet in await for_each_shard(find) if snippet]
+    if not found:
         raise HTTPException(status_code=404, detail="Snippet not found")
-    return snippet.to_dict()
+    return found[0]
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Per-lane and per-user limits; inside CORS so browsers can read 429/503 responses
+if admission.ENABLED:
+    app.add_middleware(admission.AdmissionMiddleware, identify=admission_client)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -846,4 +1421,21 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
-)
\ No newline at end of file
+    expose_headers=["Retry-After"],
+)
+
+# Tags change events with the X-Client-Id of the tab that caused them
+app.add_middleware(events.OriginMiddleware)
+
+# Opt-in sampling profiler for slow or explicitly requested requests
+if profiler.ENABLED:
+    app.add_middleware(profiler.ProfilerMiddleware)
+
+# Opt-in slow query log and N+1 detector
+if query_monitor.ENABLED:
+    for target in all_engines():
+        query_monitor.instrument_engine(target)
+    app.add_middleware(query_monitor.QueryMonitorMiddleware)
+
+# Outermost, so request metrics include time spent in the other middleware
+app.add_middleware(metrics.MetricsMiddleware)
\ No newline at end of file
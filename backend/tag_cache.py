@@ -0,0 +1,125 @@
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional
+import uuid
+
+import events
+from database import Tag, insert_or_ignore, session_shard
+
+# Session.info key holding name -> id pairs resolved inside an uncommitted transaction
+_PENDING_KEY = 'tag_cache_pending'
+
+
+def normalize_tag_names(names: Iterable[str]) -> List[str]:
+    """Strip, lowercase and de-duplicate tag names, keeping their order."""
+    normalized = {}
+    for name in names:
+        name = name.strip().lower()
+        if name:
+            normalized[name] = None
+    return list(normalized)
+
+
+class TagCache:
+    """Process-wide tag name -> tag id cache.
+
+    Tags are global and rarely change, so names are resolved from memory and
+    only misses hit the database, in a single batch. Ids of tags resolved
+    inside a transaction are kept on the session until it commits, so a
+    rolled back insert never leaks into the cache. Every shard has its own
+    tags table, so names are cached per shard (None without shards). While
+    the change feed is out of sync with other workers, every name is looked
+    up in the database.
+    """
+
+    def __init__(self):
+        self._ids: Dict[Optional[int], Dict[str, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _shard_ids(self, session) -> Dict[str, str]:
+        return self._ids.setdefault(session_shard(session), {})
+
+    async def warm(self, session: AsyncSession):
+        """Load every existing tag of the session's database into the cache."""
+        result = await session.execute(select(Tag.name, Tag.id))
+        self._ids[session_shard(session)] = dict(result.all())
+
+    async def resolve(self, session: AsyncSession, names: Iterable[str]) -> Dict[str, str]:
+        """Map tag names to ids, creating tags that don't exist yet.
+
+        Names are normalized first; the returned dict keeps their order.
+        """
+        names = normalize_tag_names(names)
+        pending = session.info.setdefault(_PENDING_KEY, {})
+        cached = self._shard_ids(session) if events.broker.in_sync else {}
+
+        resolved = {}
+        missing = []
+        for name in names:
+            tag_id = cached.get(name) or pending.get(name)
+            if tag_id:
+                resolved[name] = tag_id
+            else:
+                missing.append(name)
+
+        self.hits += len(resolved)
+        self.misses += len(missing)
+
+        if missing:
+            await session.execute(
+                insert_or_ignore(Tag, session.get_bind().dialect.name, ['name']),
+                [{'id': str(uuid.uuid4()), 'name': name} for name in missing]
+            )
+            result = await session.execute(
+                select(Tag.name, Tag.id).where(Tag.name.in_(missing))
+            )
+            found = dict(result.all())
+            pending.update(found)
+            resolved.update(found)
+
+        return {name: resolved[name] for name in names}
+
+    def add(self, session, name: str, tag_id: str):
+        """Record a tag that was just committed in the session's database."""
+        self._shard_ids(session)[name] = tag_id
+
+    def discard(self, session, names: Iterable[str]):
+        """Forget tags that were deleted from the session's database."""
+        cached = self._shard_ids(session)
+        for name in names:
+            cached.pop(name, None)
+
+    def forget_deleted(self, user_id: Optional[str], events: List[dict]):
+        """Change feed listener: drop tags deleted by any worker process.
+
+        A stale entry would link snippets to a tag id that no longer exists.
+        """
+        if user_id is None and any(data['type'] == '*' for data in events):
+            # A collapsed batch of shared changes, e.g. a large tag cleanup
+            self.clear()
+            return
+        deleted = {data['id'] for data in events if data['type'] == 'tag' and data['op'] == 'delete'}
+        if deleted:
+            # Tag ids are unique across shards, so the shard doesn't matter
+            for shard, cached in self._ids.items():
+                self._ids[shard] = {name: tag_id for name, tag_id in cached.items() if tag_id not in deleted}
+
+    def clear(self):
+        self._ids.clear()
+
+
+tag_cache = TagCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _promote_pending_tags(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        tag_cache._shard_ids(session).update(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_pending_tags(session):
+    session.info.pop(_PENDING_KEY, None)
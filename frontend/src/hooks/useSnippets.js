@@ -1,5 +1,5 @@
 import { useState, useEffect, useCallback, useRef } from 'react';
-import { snippetApi, tagApi, folderApi } from '@/lib/api';
+import { snippetApi, tagApi, folderApi, changeFeed } from '@/lib/api';
 import Fuse from 'fuse.js';
 
 export function useSnippets(isAuthenticated = true) {
@@ -70,6 +70,93 @@ export function useSnippets(isAuthenticated = true) {
     loadData();
   }, [loadData, isAuthenticated]);
 
+  // Tag and folder counts follow snippet changes; a burst of changes
+  // (e.g. autosaves) refreshes them once
+  const listRefreshTimerRef = useRef(null);
+  const scheduleListRefresh = useCallback(() => {
+    clearTimeout(listRefreshTimerRef.current);
+    listRefreshTimerRef.current = setTimeout(async () => {
+      try {
+        const [tags, foldersData] = await Promise.all([
+          tagApi.getAll(),
+          folderApi.getAll(),
+        ]);
+        setAllTags(tags);
+        setFolders(foldersData);
+      } catch (err) {
+        console.error('Error refreshing tags and folders:', err);
+      }
+    }, 300);
+  }, []);
+
+  useEffect(() => () => clearTimeout(listRefreshTimerRef.current), []);
+
+  // Apply a change made in another tab or browser
+  const applyChange = useCallback(async (change) => {
+    if (change.type === 'snippet') {
+      if (change.op === 'delete') {
+        setSnippets(prev => prev.filter(s => s.id !== change.id));
+      } else {
+        try {
+          const snippet = await snippetApi.getById(change.id);
+          setSnippets(prev =>
+            [snippet, ...prev.filter(s => s.id !== snippet.id)]
+              .sort((a, b) => new Date(b.updatedAt) - new Date(a.updatedAt))
+          );
+        } catch (err) {
+          // Deleted again before we got to it; its delete event follows
+        }
+      }
+    } else if (change.type === 'folder' && change.op === 'delete') {
+      setSnippets(prev =>
+        prev.map(s => s.folderId === change.id ? { ...s, folderId: null } : s)
+      );
+    }
+    scheduleListRefresh();
+  }, [scheduleListRefresh]);
+
+  // Subscribe to the server's change feed instead of refetching on a timer
+  useEffect(() => {
+    if (!isAuthenticated) return undefined;
+
+    let source = null;
+    let retryTimer = null;
+    let stopped = false;
+
+    const retry = () => {
+      if (!stopped) retryTimer = setTimeout(connect, 5000);
+    };
+
+    const connect = async () => {
+      let opened;
+      try {
+        opened = await changeFeed.subscribe({
+          onChange: applyChange,
+          // Missed too much to catch up event by event
+          onResync: loadData,
+          onError: (closed) => {
+            // EventSource retries dropped connections by itself but gives up on
+            // HTTP errors such as an expired ticket; start over with a fresh one
+            if (closed.readyState === EventSource.CLOSED) retry();
+          },
+        });
+      } catch (err) {
+        // Couldn't get a stream ticket
+        retry();
+        return;
+      }
+      if (stopped) opened?.close();
+      else source = opened;
+    };
+    connect();
+
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      source?.close();
+    };
+  }, [isAuthenticated, applyChange, loadData]);
+
   // Filter snippets when search, tags, folder, or favorites change
   useEffect(() => {
     let results = snippets;
@@ -107,21 +194,14 @@ export function useSnippets(isAuthenticated = true) {
     try {
       const created = await snippetApi.create(snippetData);
       setSnippets(prev => [created, ...prev]);
-      
-      // Refresh tags and folders
-      const [tags, foldersData] = await Promise.all([
-        tagApi.getAll(),
-        folderApi.getAll(),
-      ]);
-      setAllTags(tags);
-      setFolders(foldersData);
+      scheduleListRefresh();
       
       return created;
     } catch (err) {
       console.error('Error creating snippet:', err);
       throw err;
     }
-  }, []);
+  }, [scheduleListRefresh]);
 
   // Update a snippet
   const updateSnippet = useCallback(async (id, updates) => {
@@ -131,42 +211,28 @@ export function useSnippets(isAuthenticated = true) {
         prev.map(s => s.id === id ? updated : s)
           .sort((a, b) => new Date(b.updatedAt) - new Date(a.updatedAt))
       );
-      
-      // Refresh tags and folders
-      const [tags, foldersData] = await Promise.all([
-        tagApi.getAll(),
-        folderApi.getAll(),
-      ]);
-      setAllTags(tags);
-      setFolders(foldersData);
+      scheduleListRefresh();
       
       return updated;
     } catch (err) {
       console.error('Error updating snippet:', err);
       throw err;
     }
-  }, []);
+  }, [scheduleListRefresh]);
 
   // Delete a snippet
   const deleteSnippet = useCallback(async (id) => {
     try {
       await snippetApi.delete(id);
       setSnippets(prev => prev.filter(s => s.id !== id));
-      
-      // Refresh tags and folders
-      const [tags, foldersData] = await Promise.all([
-        tagApi.getAll(),
-        folderApi.getAll(),
-      ]);
-      setAllTags(tags);
-      setFolders(foldersData);
+      scheduleListRefresh();
       
       return true;
     } catch (err) {
       console.error('Error deleting snippet:', err);
       throw err;
     }
-  }, []);
+  }, [scheduleListRefresh]);
 
   // Toggle favorite
   const toggleFavorite = useCallback(async (id) => {
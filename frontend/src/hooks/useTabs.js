@@ -1,4 +1,4 @@
-import { useState, useCallback, useEffect } from 'react';
+import { useState, useCallback, useEffect, useRef } from 'react';
 import { tabApi } from '@/lib/api';
 
 export function useTabs(onTabChange) {
@@ -24,34 +24,35 @@ export function useTabs(onTabChange) {
     loadTabs();
   }, []);
   
-  // Save tabs when they change
-  const saveTabs = useCallback(async (newTabs, activeId) => {
-    try {
-      const tabsToSave = newTabs.map((snippetId, index) => ({
-        snippetId,
-        order: index,
-        isActive: snippetId === activeId,
-      }));
-      await tabApi.saveTabs(tabsToSave);
-    } catch (err) {
-      console.error('Error saving tabs:', err);
-    }
+  // Tab requests go out one at a time, in order, so a close can't overtake the open before it
+  const queue = useRef(Promise.resolve());
+  const enqueue = useCallback((request) => {
+    queue.current = queue.current
+      .then(request)
+      .catch(err => console.error('Error saving tabs:', err));
+    return queue.current;
   }, []);
   
+  // Send tab changes as operations, so the server only touches the rows involved
+  const sendOps = useCallback(
+    (ops) => enqueue(() => tabApi.updateTabs(ops)),
+    [enqueue]
+  );
+  
   // Open a new tab or activate existing
   const openTab = useCallback((snippetId) => {
     setTabs(prev => {
       if (!prev.includes(snippetId)) {
         const newTabs = [...prev, snippetId];
         setActiveTabId(snippetId);
-        saveTabs(newTabs, snippetId);
+        sendOps([{ op: 'open', snippetId }, { op: 'activate', snippetId }]);
         return newTabs;
       }
       setActiveTabId(snippetId);
-      saveTabs(prev, snippetId);
+      sendOps([{ op: 'activate', snippetId }]);
       return prev;
     });
-  }, [saveTabs]);
+  }, [sendOps]);
   
   // Close a tab
   const closeTab = useCallback((snippetId) => {
@@ -66,41 +67,41 @@ export function useTabs(onTabChange) {
         const newActiveIndex = Math.min(index, newTabs.length - 1);
         const newActiveId = newTabs[newActiveIndex];
         setActiveTabId(newActiveId);
-        saveTabs(newTabs, newActiveId);
+        sendOps([{ op: 'close', snippetId }, { op: 'activate', snippetId: newActiveId }]);
         if (onTabChange) onTabChange(newActiveId);
       } else if (newTabs.length === 0) {
         setActiveTabId(null);
-        saveTabs(newTabs, null);
+        sendOps([{ op: 'close', snippetId }]);
         if (onTabChange) onTabChange(null);
       } else {
-        saveTabs(newTabs, activeTabId);
+        sendOps([{ op: 'close', snippetId }]);
       }
       
       return newTabs;
     });
-  }, [activeTabId, onTabChange, saveTabs]);
+  }, [activeTabId, onTabChange, sendOps]);
   
   // Set active tab
   const setActiveTab = useCallback((snippetId) => {
     setActiveTabId(snippetId);
-    saveTabs(tabs, snippetId);
+    sendOps([{ op: 'activate', snippetId }]);
     if (onTabChange) onTabChange(snippetId);
-  }, [tabs, onTabChange, saveTabs]);
+  }, [onTabChange, sendOps]);
   
   // Close all tabs
   const closeAllTabs = useCallback(() => {
     setTabs([]);
     setActiveTabId(null);
-    saveTabs([], null);
+    enqueue(() => tabApi.saveTabs([]));
     if (onTabChange) onTabChange(null);
-  }, [onTabChange, saveTabs]);
+  }, [onTabChange, enqueue]);
   
   // Close other tabs
   const closeOtherTabs = useCallback((keepId) => {
     setTabs([keepId]);
     setActiveTabId(keepId);
-    saveTabs([keepId], keepId);
-  }, [saveTabs]);
+    enqueue(() => tabApi.saveTabs([{ snippetId: keepId, order: 0, isActive: true }]));
+  }, [enqueue]);
   
   // Reorder tabs
   const reorderTabs = useCallback((fromIndex, toIndex) => {
@@ -108,10 +109,10 @@ export function useTabs(onTabChange) {
       const newTabs = [...prev];
       const [removed] = newTabs.splice(fromIndex, 1);
       newTabs.splice(toIndex, 0, removed);
-      saveTabs(newTabs, activeTabId);
+      sendOps([{ op: 'reorder', snippetId: removed, order: toIndex }]);
       return newTabs;
     });
-  }, [activeTabId, saveTabs]);
+  }, [sendOps]);
   
   return {
     tabs,
@@ -11,12 +11,16 @@ const api = axios.create({
   },
 });
 
+// Identifies this browser tab; the change feed doesn't echo a tab's own changes back to it
+export const CLIENT_ID = Math.random().toString(36).slice(2, 12);
+
 // Add auth token to requests
 api.interceptors.request.use((config) => {
   const token = localStorage.getItem('accessToken');
   if (token) {
     config.headers.Authorization = `Bearer ${token}`;
   }
+  config.headers['X-Client-Id'] = CLIENT_ID;
   return config;
 });
 
@@ -51,6 +55,16 @@ api.interceptors.response.use(
       }
     }
     
+    // Turned away by admission control before running, so retrying once is safe
+    const status = error.response?.status;
+    const retryAfter = error.response?.headers['retry-after'];
+    if ((status === 429 || status === 503) && retryAfter && originalRequest && !originalRequest._admissionRetry) {
+      originalRequest._admissionRetry = true;
+      const seconds = Number(retryAfter) || 1;
+      await new Promise(resolve => setTimeout(resolve, Math.min(seconds, 10) * 1000));
+      return api(originalRequest);
+    }
+    
     return Promise.reject(error);
   }
 );
@@ -118,18 +132,51 @@ export const snippetApi = {
     return response.data;
   },
 
-  // Search snippets
-  async search(query = '', tags = [], language = '') {
+  // Search snippets. options: { fuzzy, highlight, context, maxHighlights, includeCode, facets }
+  async search(query = '', tags = [], language = '', options = {}) {
     const params = new URLSearchParams();
     if (query) params.append('q', query);
     if (tags.length > 0) params.append('tags', tags.join(','));
     if (language) params.append('language', language);
+    if (options.fuzzy) params.append('fuzzy', 'true');
+    if (options.highlight) {
+      params.append('highlight', 'true');
+      if (options.context !== undefined) params.append('context', options.context);
+      if (options.maxHighlights !== undefined) params.append('max_highlights', options.maxHighlights);
+    }
+    if (options.includeCode === false) params.append('include_code', 'false');
+    if (options.facets) params.append('facets', 'true');
     
     const response = await api.get(`/search?${params.toString()}`);
     return response.data;
   },
 };
 
+// ============ Saved Search API ============
+
+export const savedSearchApi = {
+  async getAll() {
+    const response = await api.get('/saved-searches');
+    return response.data;
+  },
+
+  // query: the body of POST /search, e.g. { tags: ['react'], facets: true }
+  async create(name, query) {
+    const response = await api.post('/saved-searches', { name, query });
+    return response.data;
+  },
+
+  async delete(id) {
+    const response = await api.delete(`/saved-searches/${id}`);
+    return response.data;
+  },
+
+  async run(id) {
+    const response = await api.get(`/saved-searches/${id}/results`);
+    return response.data;
+  },
+};
+
 // ============ Folder API ============
 
 export const folderApi = {
@@ -206,6 +253,12 @@ export const tabApi = {
     const response = await api.put('/tabs', { tabs });
     return response.data;
   },
+
+  // Apply open/close/reorder/activate operations
+  async updateTabs(ops) {
+    const response = await api.patch('/tabs', { ops });
+    return response.data;
+  },
 };
 
 // ============ Import/Export API ============
@@ -217,9 +270,16 @@ export const dataApi = {
     return response.data;
   },
 
-  // Import snippets
-  async importSnippets(snippets) {
-    const response = await api.post('/import', { snippets });
+  // Import snippets. options: { skipDuplicates, duplicateThreshold }
+  async importSnippets(snippets, options = {}) {
+    const response = await api.post('/import', { snippets, ...options });
+    return response.data;
+  },
+
+  // Clusters of near-duplicate snippets
+  async getDuplicates(threshold) {
+    const params = threshold !== undefined ? { threshold } : {};
+    const response = await api.get('/duplicates', { params });
     return response.data;
   },
 };
@@ -233,6 +293,28 @@ export const statsApi = {
   },
 };
 
+// ============ Change Feed ============
+
+export const changeFeed = {
+  // Open a Server-Sent Events stream of snippet, folder and tag changes.
+  // EventSource can't send headers, so it gets a one-minute stream ticket in
+  // the URL rather than the access token, which would end up in access logs.
+  // Resolves to null when there is no token or the browser lacks EventSource.
+  async subscribe({ onChange, onResync, onOpen, onError }) {
+    const token = localStorage.getItem('accessToken');
+    if (!token || typeof EventSource === 'undefined') return null;
+
+    const response = await api.post('/events/ticket');
+    const params = new URLSearchParams({ ticket: response.data.ticket, clientId: CLIENT_ID });
+    const source = new EventSource(`${API_URL}/events?${params.toString()}`);
+    source.addEventListener('change', (e) => onChange?.(JSON.parse(e.data)));
+    source.addEventListener('resync', () => onResync?.());
+    source.addEventListener('ready', () => onOpen?.());
+    source.onerror = () => onError?.(source);
+    return source;
+  },
+};
+
 // ============ Health Check ============
 
 export const healthApi = {